@@ -2,17 +2,19 @@
 """ Signet ring cell detection """
 
 from challenge.classes import MyModel
-from challenge.utils import initial_validation_cleaning, process_input_files
+from challenge.pipeline import run_pipeline
+from challenge.utils import initial_validation_cleaning
 
 
 def main():
     """
     Processes images from input folder using sliding window technique and saves
-    the images along with the predicitons (if configured so) into output folder
+    the images along with the predicitons (if configured so) into output folder.
+    Decoding, model evaluation and saving run in parallel (see challenge.pipeline)
     """
     initial_validation_cleaning()
     model = MyModel()
-    process_input_files(
+    run_pipeline(
         model,
         create_save_img_predictions=True,
         draw_annotations=True
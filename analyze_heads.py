@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+""" analyze_heads """
+
+import argparse
+import yaml
+
+import numpy as np
+import torch
+
+from constants import Dataset
+from models.yolov3 import YOLOv3
+import settings
+from utils.evaluators.evaluators import SignetRingEvaluator
+from utils.utils import get_autocast, get_conv_flops, normalize_images, postprocess
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='config/yolov3_eval_digestpath.cfg',
+                        help='config file. see readme')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='pytorch checkpoint file path')
+    parser.add_argument('--data_dir', type=str, default=settings.SIGNET_TEST_PATH,
+                        help='SignetRing dataset evaluated')
+    parser.add_argument('--ap', action='store_true',
+                        help='also evaluates the AP30 of the model without each head')
+    return parser.parse_args()
+
+
+def get_head_contributions(model, evaluator):
+    """
+    Evaluates the model on the images of the evaluator (with its thresholds) and
+    returns the number of final detections (after postprocess) coming from each head
+    Args:
+        model (YOLOv3): model in evaluation mode with all the heads selected
+        evaluator (SignetRingEvaluator): evaluator
+    Returns:
+        counts (numpy.ndarray): number of detections per head
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    yolo_layers = [model.module_list[idx] for idx in model.yolo_layers]
+    counts = np.zeros(len(yolo_layers), dtype=int)
+
+    for img, *_ in evaluator.dataloader:
+        img = normalize_images(img, device)
+        height, width = img.shape[2:]
+        # detections of the heads are concatenated in order by YOLOv3.forward
+        limits = torch.tensor(np.cumsum([
+            layer.n_anchors * (height // layer.stride) * (width // layer.stride)
+            for layer in yolo_layers
+        ]), device=device)
+
+        with torch.no_grad():
+            with get_autocast(evaluator.precision, device.type):
+                outputs = model(img)
+            detections = postprocess(
+                outputs.clone(), Dataset.NUM_CLASSES[Dataset.SIGNET_RING], evaluator.confthre,
+                evaluator.nmsthre
+            )[0]
+
+        if detections is None:
+            continue
+
+        # each detection is the box of the prediction with the same corners and objectness
+        boxes = outputs[0]
+        corners = torch.cat((boxes[:, :2] - boxes[:, 2:4] / 2, boxes[:, :2] + boxes[:, 2:4] / 2), 1)
+        matches = (corners[None] == detections[:, None, :4]).all(2) & \
+            (boxes[None, :, 4] == detections[:, None, 4])
+        heads = torch.bucketize(matches.float().argmax(1), limits, right=True)
+        counts += np.bincount(heads.cpu().numpy(), minlength=len(yolo_layers))
+
+    return counts
+
+
+def main():
+    """
+    Reports how many final detections each YOLO head contributes on the SignetRing
+    dataset evaluated by SignetRingEvaluator, along with the FLOPs (and optionally the
+    AP30) of the model without each head. See the HEADS key of the config files and
+    YOLOv3.select_heads
+    """
+    args = parse_args()
+    print("Setting Arguments.. : ", args)
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f)
+
+    imgsize = cfg['TEST']['IMGSIZE']
+    model = YOLOv3(cfg['MODEL'])
+    state = torch.load(args.checkpoint, map_location='cpu')
+    if 'model_state_dict' in state.keys():
+        model.load_state_dict(state['model_state_dict'])
+    else:
+        model.load_state_dict(state)
+
+    if torch.cuda.is_available():
+        model.cuda()
+
+    model.fuse()
+
+    evaluator = SignetRingEvaluator(model_type=cfg['MODEL']['TYPE'], img_size=imgsize,
+                                    confthre=cfg['TEST']['CONFTHRE'],
+                                    nmsthre=cfg['TEST']['NMSTHRE'], data_dir=args.data_dir,
+                                    precision=cfg['TEST'].get('PRECISION', 'fp32'),
+                                    rect=cfg['TEST'].get('RECT', False))
+
+    counts = get_head_contributions(model, evaluator)
+    gflops = get_conv_flops(model, imgsize, imgsize) / 1e9
+    results = []
+
+    for head in model.heads:
+        model.select_heads([other for other in model.heads if other != head])
+        ap30 = evaluator.evaluate(model)[0] if args.ap else float('nan')
+        results.append((get_conv_flops(model, imgsize, imgsize) / 1e9, ap30))
+        model.select_heads()
+
+    ap30 = evaluator.evaluate(model)[0] if args.ap else float('nan')
+
+    print('all heads: {:.2f} GFLOPs | AP30 {:.4f} | {} detections'.format(
+        gflops, ap30, counts.sum()))
+    print('head | stride | detections | share | GFLOPs without it | AP30 without it')
+    for head, (head_gflops, head_ap30) in zip(model.heads, results):
+        print('{:>4} | {:>6} | {:>10} | {:>5.3f} | {:>17.2f} | {:.4f}'.format(
+            head, model.module_list[model.yolo_layers[head]].stride, counts[head],
+            counts[head] / max(counts.sum(), 1), head_gflops, head_ap30))
+
+
+if __name__ == '__main__':
+    main()
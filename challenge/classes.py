@@ -12,8 +12,11 @@ import matplotlib.pyplot as plt
 
 
 from constants import BOX_COLOR, Dataset
+from models.backends import get_backend_class
+from models.quantization import load_quantized_state
 from models.yolov3 import YOLOv3
-from utils.utils import preprocess, postprocess, yolobox2label
+from utils.utils import get_autocast, preprocess, preprocess_padded, postprocess, \
+    stack_letterboxes, yolobox2label
 from utils.vis_bbox import vis_bbox
 from .utils import use_cuda
 from . import settings
@@ -28,7 +31,12 @@ class MyModel:
 
     def load_model(self):
         """
-        Load the model using settings.CONFIG_FILE and settings.MODEL_CHECKPOINT
+        Load the model using settings.CONFIG_FILE and settings.MODEL_CHECKPOINT.
+        The batchnorm layers are folded into the convolutions if settings.FUSE_CONV_BN
+        is True. The predictions are calculated using settings.INFERENCE_BACKEND
+        (see models.backends) and decoded sparsely if settings.SPARSE_DECODING is
+        True. Only the YOLO heads listed in the HEADS key of the config file are evaluated.
+        Quantized checkpoints (see models.quantization) are always evaluated on CPU
         """
         with open(settings.CONFIG_FILE, 'r') as f:
             cfg = yaml.load(f)
@@ -37,19 +45,43 @@ class MyModel:
         self.model = YOLOv3(cfg['MODEL'])
         self.confthre = cfg['TEST']['CONFTHRE']
         self.nmsthre = cfg['TEST']['NMSTHRE']
-
-        if use_cuda():
-            print("Using cuda")
-            self.model = self.model.cuda()
+        self.precision = cfg['TEST'].get('PRECISION', 'fp32')
+        self.memory_format = torch.channels_last if cfg['TEST'].get('CHANNELS_LAST', False) \
+            else torch.contiguous_format
+        self.rect = cfg['TEST'].get('RECT', False)
 
         print("Loading checkpoint {}".format(settings.MODEL_CHECKPOINT))
-        state = torch.load(settings.MODEL_CHECKPOINT)
-        if 'model_state_dict' in state.keys():
-            self.model.load_state_dict(state['model_state_dict'])
+        state = torch.load(settings.MODEL_CHECKPOINT, map_location='cpu')
+        self.use_cuda = use_cuda() and not state.get('quantized', False)
+
+        if state.get('quantized', False):
+            print("Using INT8 quantized model")
+            self.model = load_quantized_state(self.model, state)
         else:
-            self.model.load_state_dict(state)
+            if 'model_state_dict' in state.keys():
+                self.model.load_state_dict(state['model_state_dict'])
+            else:
+                self.model.load_state_dict(state)
+
+            if self.use_cuda:
+                print("Using cuda")
+                self.model = self.model.cuda()
+
+            self.model.eval()
+
+            if settings.FUSE_CONV_BN:
+                self.model.fuse()
+
+            self.model = self.model.to(memory_format=self.memory_format)
+
+        self.model.select_heads(cfg['TEST'].get('HEADS'))
+
+        self.backend = get_backend_class(settings.INFERENCE_BACKEND)(
+            self.model, self.imgsize, settings.INFERENCE_BACKEND_FILE)
 
-        self.model.eval()
+        # enabled after exporting the model, so only the eager graphs are sparse
+        if settings.SPARSE_DECODING:
+            self.model.set_sparse_decoding(self.confthre)
 
     def get_predictions(self, img_name='', image=None, plot=False):
         """
@@ -63,17 +95,21 @@ class MyModel:
             img = image
 
         img_raw = img.copy()[:, :, ::-1].transpose((2, 0, 1))
-        img, info_img = preprocess(img, self.imgsize, jitter=0)  # info = (h, w, nh, nw, dx, dy)
+        # info = (h, w, nh, nw, dx, dy)
+        img, info_img = preprocess(img, self.imgsize, jitter=0, rect=self.rect)
         img = np.transpose(img / 255., (2, 0, 1))
         img = torch.from_numpy(img).float().unsqueeze(0)
 
-        if use_cuda():
+        if self.use_cuda:
             img = Variable(img.type(torch.cuda.FloatTensor))
         else:
             img = Variable(img.type(torch.FloatTensor))
 
+        img = img.contiguous(memory_format=self.memory_format)
+
         with torch.no_grad():
-            outputs = self.model(img)
+            with get_autocast(self.precision, img.device.type):
+                outputs = self.backend(img)
             outputs = postprocess(
                 outputs, Dataset.NUM_CLASSES[Dataset.SIGNET_RING], self.confthre, self.nmsthre)
 
@@ -98,3 +134,70 @@ class MyModel:
             plt.show()
 
         return torch.FloatTensor(bboxes_with_scores)
+
+    def get_batch_predictions(self, images):
+        """
+        Gets the bounding box predictions for several images (e.g. the tiles of a slide)
+        running a single forward pass and returns a list with a numpy array per image
+        in the format:
+           [[x1, y1, x2, y2, score], ...]
+        """
+        batch = []
+        infos_img = []
+
+        for image in images:
+            img, info_img = preprocess(image, self.imgsize, jitter=0, rect=self.rect)
+            batch.append(img)
+            infos_img.append(info_img)
+
+        return self.get_preprocessed_batch_predictions(stack_letterboxes(batch), infos_img)
+
+    def get_padded_batch_predictions(self, images):
+        """
+        Same as get_batch_predictions but for images of any size with the same shape
+        (e.g. whole slides or large chunks of them). They are resized by
+        imgsize / settings.CUT_SIZE, so the objects have the scale of the tiles, and
+        padded to a multiple of 32 (see utils.utils.preprocess_padded)
+        """
+        batch = []
+        infos_img = []
+
+        for image in images:
+            img, info_img = preprocess_padded(image, self.imgsize / settings.CUT_SIZE)
+            batch.append(img)
+            infos_img.append(info_img)
+
+        return self.get_preprocessed_batch_predictions(np.stack(batch), infos_img)
+
+    def get_preprocessed_batch_predictions(self, imgs, infos_img):
+        """
+        Same as get_batch_predictions but for images already preprocessed (see
+        utils.utils.preprocess and utils.utils.preprocess_padded). imgs is an uint8 numpy
+        array whose shape is (N, H, W, 3) and infos_img the list of their info_img tuples
+        """
+        # the NHWC images are already a channels_last NCHW tensor
+        imgs = torch.from_numpy(imgs.transpose((0, 3, 1, 2))).float() / 255.
+        imgs = imgs.contiguous(memory_format=self.memory_format)
+
+        if self.use_cuda:
+            imgs = imgs.cuda()
+
+        with torch.no_grad():
+            with get_autocast(self.precision, imgs.device.type):
+                outputs = self.backend(imgs)
+            outputs = postprocess(
+                outputs, Dataset.NUM_CLASSES[Dataset.SIGNET_RING], self.confthre, self.nmsthre)
+
+        predictions = []
+
+        for output, info_img in zip(outputs, infos_img):
+            if output is None:
+                predictions.append(np.zeros((0, 5), dtype=np.float32))
+                continue
+
+            output = output.cpu().numpy()
+            y1, x1, y2, x2 = yolobox2label(
+                [output[:, 1], output[:, 0], output[:, 3], output[:, 2]], info_img)
+            predictions.append(np.stack((x1, y1, x2, y2, output[:, 4] * output[:, 5]), axis=1))
+
+        return predictions
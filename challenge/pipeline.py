@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" challenge pipeline """
+
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing as mp
+import os
+
+import cv2
+
+from utils.utils import preprocess, preprocess_padded, stack_letterboxes
+from .utils import DetectionBuffer, Tile, evaluate_tiles, get_chunk_origins, get_tile_origins, \
+    save_predictions, stitch_chunks
+from . import settings
+
+
+PreparedSlide = namedtuple(
+    'PreparedSlide',
+    ['fileimg', 'width', 'height', 'cut_size', 'origins', 'images', 'infos_img', 'image']
+)
+
+
+def prepare_slide(input_folder, fileimg, imgsize, cut_size, overlap, inference_mode='tiles',
+                  chunk_size=None, chunk_overlap=0, keep_image=False, rect=False):
+    """
+    Decodes a slide and preprocesses all its tiles, or all its chunks when the
+    inference_mode is not 'tiles' (see settings.INFERENCE_MODE and
+    challenge.utils.get_chunk_origins). The tiles use rectangular letterboxes if
+    rect is True (see TEST.RECT). Runs on the decoding processes
+
+    Returns:
+        PreparedSlide whose images are stacked in an uint8 numpy array with shape
+        (num_tiles, H, W, 3) or (num_chunks, H, W, 3). Its image is the
+        decoded slide if keep_image is True (so the writers do not decode it again),
+        otherwise None
+    """
+    img = cv2.imread(os.path.join(input_folder, fileimg))
+
+    if img is None:
+        raise FileNotFoundError('{} could not be decoded'.format(fileimg))
+
+    h, w, _ = img.shape
+
+    if inference_mode == 'tiles':
+        origins = get_tile_origins(w, h, cut_size, overlap)
+    else:
+        scale = imgsize / cut_size
+        cut_size, origins = get_chunk_origins(w, h, chunk_size, chunk_overlap)
+
+    images = []
+    infos_img = []
+
+    for x, y in origins:
+        if inference_mode == 'tiles':
+            tile, info_img = preprocess(
+                img[y:y+cut_size, x:x+cut_size], imgsize, jitter=0, rect=rect)
+        else:
+            tile, info_img = preprocess_padded(img[y:y+cut_size, x:x+cut_size], scale)
+        images.append(tile)
+        infos_img.append(info_img)
+
+    return PreparedSlide(fileimg, w, h, cut_size, origins, stack_letterboxes(images), infos_img,
+                         img if keep_image else None)
+
+
+def get_prepared_slides(executor, fileimgs, imgsize, queue_size, keep_image=False,
+                        rect=False):
+    """
+    Generator that submits the slides to the decoding executor keeping at most
+    queue_size slides in flight and yields them (PreparedSlide) in order
+    """
+    pending = deque()
+    fileimgs = iter(fileimgs)
+
+    while True:
+        for fileimg in fileimgs:
+            pending.append(executor.submit(
+                prepare_slide, settings.INPUT_FOLDER, fileimg, imgsize, settings.CUT_SIZE,
+                settings.OVERLAP, settings.INFERENCE_MODE,
+                settings.CHUNK_SIZE if settings.INFERENCE_MODE == 'chunks' else None,
+                settings.CHUNK_OVERLAP, keep_image, rect
+            ))
+            if len(pending) >= queue_size:
+                break
+
+        if not pending:
+            return
+
+        yield pending.popleft().result()
+
+
+def get_tile_batches(slides, batch_size):
+    """
+    Generator that groups the tiles of the prepared slides into lists of batch_size
+    (PreparedSlide, tile index) tuples. A batch can contain tiles from several slides,
+    except when settings.INFERENCE_MODE is not 'tiles' (the chunks of different slides
+    can have different sizes)
+    """
+    batch = []
+
+    for slide in slides:
+        if batch and settings.INFERENCE_MODE != 'tiles':
+            yield batch
+            batch = []
+
+        for idx in range(len(slide.origins)):
+            batch.append((slide, idx))
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def run_pipeline(model, create_save_img_predictions=False, draw_annotations=False):
+    """
+    Same as challenge.utils.process_input_files but running a staged pipeline:
+
+    * settings.DECODING_WORKERS processes decode the slides and preprocess their tiles
+      (or chunks, see settings.INFERENCE_MODE)
+    * the calling thread evaluates the tiles in batches of settings.BATCH_SIZE
+    * settings.OUTPUT_WORKERS threads apply the slide-level NMS and save the XML
+      files and images (the decoded slides are passed by the decoding processes, so
+      they are not decoded again)
+
+    The stages are connected by queues of at most settings.PIPELINE_QUEUE_SIZE slides
+    """
+    fileimgs = tuple(filter(lambda x: x.endswith('.jpeg'), os.listdir(settings.INPUT_FOLDER)))
+    predictions = {}  # {fileimg: DetectionBuffer, ...}
+    pending_outputs = deque()
+
+    # spawn avoids forking a process that has already initialized torch/CUDA
+    with ProcessPoolExecutor(settings.DECODING_WORKERS, mp.get_context('spawn')) as decoders, \
+            ThreadPoolExecutor(settings.OUTPUT_WORKERS) as writers:
+        slides = get_prepared_slides(
+            decoders, fileimgs, model.imgsize, settings.PIPELINE_QUEUE_SIZE,
+            create_save_img_predictions, model.rect)
+
+        for batch in get_tile_batches(slides, settings.BATCH_SIZE):
+            tiles = [
+                Tile(slide.fileimg, *slide.origins[idx], slide.width, slide.height, None,
+                     idx == len(slide.origins) - 1)
+                for slide, idx in batch
+            ]
+            batch_results = model.get_preprocessed_batch_predictions(
+                stack_letterboxes([slide.images[idx] for slide, idx in batch]),
+                [slide.infos_img[idx] for slide, idx in batch]
+            )
+
+            if settings.INFERENCE_MODE == 'tiles':
+                batch_results = evaluate_tiles(tiles, batch_results, settings.CUT_SIZE)
+            else:
+                # the chunks of a batch always belong to the same slide
+                slide = batch[0][0]
+                batch_results = stitch_chunks(
+                    slide.origins, batch_results, slide.cut_size, [idx for _, idx in batch])
+
+            for (slide, _), tile, results in zip(batch, tiles, batch_results):
+                predictions.setdefault(tile.fileimg, DetectionBuffer()).append(results)
+
+                if tile.is_last:
+                    pending_outputs.append(writers.submit(
+                        save_predictions, tile.fileimg,
+                        predictions.pop(tile.fileimg, DetectionBuffer()).view, model.nmsthre,
+                        create_save_img_predictions, draw_annotations, (tile.width, tile.height),
+                        slide.image
+                    ))
+
+                    # raises the errors of the writers and bounds the output queue
+                    while pending_outputs and (pending_outputs[0].done() or len(
+                            pending_outputs) > settings.PIPELINE_QUEUE_SIZE):
+                        pending_outputs.popleft().result()
+
+        for future in pending_outputs:
+            future.result()
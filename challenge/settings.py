@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+""" challenge settings  """
+
+INPUT_FOLDER = 'input'
+
+OUTPUT_FOLDER = 'output'
+
+MODEL_CHECKPOINT = 'checkpoints/logs_test_size_0_2_512x512_pos_neg_sample/snapshot9350.ckpt'
+
+CONFIG_FILE = 'config/yolov3_eval_digestpath.cfg'
+
+USE_CUDA = True
+
+# Fold the batchnorm layers into the convolutions of the loaded model (inference only)
+FUSE_CONV_BN = True
+
+# Inference backend: eager, torchscript, onnxruntime or compile (see models.backends).
+# INFERENCE_BACKEND_FILE is the exported model used by torchscript and onnxruntime; it
+# is created from MODEL_CHECKPOINT if it does not exist (remove it after changing
+# the checkpoint). The exported graphs only accept IMGSIZE x IMGSIZE inputs, so they
+# cannot be used with RECT or the 'chunks' and 'slide' inference modes
+INFERENCE_BACKEND = 'eager'
+
+INFERENCE_BACKEND_FILE = ''
+
+# Decode only the cells whose objectness reaches the confidence threshold of the
+# config file (same detections, see YOLOv3.set_sparse_decoding). Used by the eager
+# and compile backends; the exported torchscript and onnxruntime graphs stay dense
+SPARSE_DECODING = True
+
+CUT_SIZE = 512
+
+OVERLAP = int(0.5 * CUT_SIZE)
+
+BOARDCACHE = 2
+
+# Inference mode: 'tiles' (sliding window of CUT_SIZE tiles letterboxed to the IMGSIZE
+# of the config file), 'chunks' (overlapping chunks of CHUNK_SIZE) or 'slide' (the
+# whole slide in a single forward pass). The chunks and slides are resized by
+# IMGSIZE / CUT_SIZE, like the tiles, and padded to a multiple of 32. CHUNK_OVERLAP
+# must be larger than the objects plus the context seen by the network around them.
+# The chunks and slide modes require the eager or compile backends
+INFERENCE_MODE = 'tiles'
+
+CHUNK_SIZE = 1024
+
+CHUNK_OVERLAP = 256
+
+# Number of tiles processed per forward pass. Tiles from consecutive images are
+# grouped together when an image does not fill a whole batch
+BATCH_SIZE = 8
+
+# Maximum number of bytes used to keep decoded slides in memory (LRU cache)
+DECODED_SLIDES_CACHE_SIZE = 1024**3
+
+# Segmentation.py pipeline: number of processes decoding the slides and preprocessing
+# their tiles, number of threads saving the predictions (NMS, XML and JPEG files)
+# and maximum number of slides waiting between the stages
+DECODING_WORKERS = 4
+
+OUTPUT_WORKERS = 2
+
+PIPELINE_QUEUE_SIZE = 4
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """ challenge utils  """
 
+from collections import namedtuple, OrderedDict
 from copy import deepcopy
 import os
 import shutil
+import threading
 
 import cv2
 import numpy as np
@@ -15,6 +17,110 @@ from utils.utils import nms
 from . import settings
 
 
+Tile = namedtuple('Tile', ['fileimg', 'x', 'y', 'width', 'height', 'image', 'is_last'])
+
+
+class SlideCache:
+    """
+    Decodes each slide from settings.INPUT_FOLDER only once and keeps the decoded
+    BGR arrays in a LRU cache bounded by max_bytes. The tiles are returned as
+    read-only numpy views of the cached slide (no copies). It can be shared by
+    several threads
+    """
+
+    def __init__(self, max_bytes=settings.DECODED_SLIDES_CACHE_SIZE):
+        """ Initializes the object """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.slides = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_slide(self, fileimg):
+        """
+        Returns the decoded slide. Least recently used slides are evicted when the
+        cache exceeds max_bytes (the requested slide is always kept)
+        """
+        with self.lock:
+            if fileimg in self.slides:
+                self.slides.move_to_end(fileimg)
+                return self.slides[fileimg]
+
+        # decoding outside the lock so other threads can use the cache meanwhile
+        img = cv2.imread(os.path.join(settings.INPUT_FOLDER, fileimg))
+
+        if img is None:
+            raise FileNotFoundError('{} could not be decoded'.format(fileimg))
+
+        img.setflags(write=False)
+
+        with self.lock:
+            if fileimg in self.slides:
+                self.slides.move_to_end(fileimg)
+                return self.slides[fileimg]
+
+            self.slides[fileimg] = img
+            self.nbytes += img.nbytes
+
+            while self.nbytes > self.max_bytes and len(self.slides) > 1:
+                _, evicted = self.slides.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return img
+
+    def get_tile(self, fileimg, x, y, cut_size):
+        """ Returns a view of the tile with top-left corner (x, y) """
+        return self.get_slide(fileimg)[y:y+cut_size, x:x+cut_size]
+
+    def clear(self):
+        """ Removes all the slides from the cache """
+        with self.lock:
+            self.slides.clear()
+            self.nbytes = 0
+
+
+slide_cache = SlideCache()
+
+
+class DetectionBuffer:
+    """
+    Growable array of detections [[x1, y1, x2, y2, score], ...]. The capacity is
+    doubled when it is exceeded, so appending the detections of a tile costs
+    amortized O(len(detections)) and the accumulated detections are exposed as
+    a view (no copies)
+    """
+
+    def __init__(self, num_columns=5, capacity=1024, dtype=np.float64):
+        """ Initializes the object """
+        self.data = np.empty((capacity, num_columns), dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        """ Returns the number of detections """
+        return self.size
+
+    def append(self, detections):
+        """ Appends the detections (numpy array with shape (K, num_columns)) """
+        end = self.size + len(detections)
+
+        if end > self.data.shape[0]:
+            data = np.empty((max(end, 2 * self.data.shape[0]), self.data.shape[1]),
+                            dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+        self.data[self.size:end] = detections
+        self.size = end
+
+    @property
+    def view(self):
+        """ Returns a view of the detections appended so far """
+        return self.data[:self.size]
+
+    def clear(self):
+        """ Removes all the detections keeping the allocated memory """
+        self.size = 0
+
+
 def initial_validation_cleaning():
     """ Verifies the input folder exists and cleans the output folder """
     if not os.path.exists(settings.INPUT_FOLDER):
@@ -85,129 +191,289 @@ def generate_save_xml(predictions, fileimg, img_width, img_height):
         file_.write('</annotation>')
 
 
-def evaluation(x, y, cut_size, w, h, fimg, model):
+def get_tile_origins(width, height, cut_size, overlap):
     """
-    Creates the mini-patch and gets its bounding boxes predictions, then transform them
-    into the right coordinates in the whole image and return them in a numpy array.
+    Returns the top-left (x, y) coordinates of the tiles used by the sliding window
+    technique. The last column and row of tiles are aligned with the right and bottom
+    borders of the image. Repeated origins are only returned once.
 
     Returns:
 
-    [[x1, y1, x2, y2, score], ...]
+    [(x, y), ...]
+    """
+    origins = []
+    y = 0
+
+    while y <= height - cut_size:
+        origins.extend((x, y) for x in range(0, width - cut_size + 1, overlap))
+        origins.append((width - cut_size, y))
+        y += overlap
+
+    y = height - cut_size
+    origins.extend((x, y) for x in range(0, width - cut_size + 1, overlap))
+    origins.append((width - cut_size, height - cut_size))
 
+    return list(OrderedDict.fromkeys(origins))
+
+
+def get_axis_origins(length, chunk_size, step):
+    """
+    Returns the starts of the chunks along an axis of the given length. The last chunk
+    is aligned with the end of the axis and a single chunk is used when the axis is
+    not longer than chunk_size
     """
-    fimg = cv2.imread(fimg.filename)
-    image = fimg[y:y+cut_size, x:x+cut_size]
-    # cv2.imshow("cropped", image)
+    if length <= chunk_size:
+        return [0]
 
-    results = model.get_predictions(image=image, plot=False)
+    return list(OrderedDict.fromkeys(
+        list(range(0, length - chunk_size + 1, step)) + [length - chunk_size]))
 
-    if len(results) == 0:
-        return None
 
-    c = results.cpu().numpy()
+def get_chunk_origins(width, height, chunk_size=None, chunk_overlap=0):
+    """
+    Returns the size and the top-left (x, y) coordinates of the chunks used by the
+    'chunks' and 'slide' inference modes (see settings.INFERENCE_MODE). Each axis is
+    chunked on its own, so the chunks are shorter than chunk_size along the axes that
+    are not larger than it (e.g. a 60000x900 slide has 900 pixels high chunks). The
+    whole image is a single chunk when chunk_size is None or both sides fit in
+    chunk_size
 
-    if(x != 0 and y != 0 and x+cut_size != w and y+cut_size != h):
-        i = 0
-        while i < c.shape[0]:
-            if(c[i, 0] < settings.BOARDCACHE or c[i, 1] < settings.BOARDCACHE or
-               c[i, 2] < settings.BOARDCACHE or c[i, 3] < settings.BOARDCACHE):
-                c = np.delete(c, i, axis=0)
-                i -= 1
-            i += 1
-    i = 0
+    Returns:
+
+    chunk_size, [(x, y), ...]
+    """
+    if chunk_size is None or max(width, height) <= chunk_size:
+        return max(width, height), [(0, 0)]
+
+    step = chunk_size - chunk_overlap
+    xs = get_axis_origins(width, chunk_size, step)
+    ys = get_axis_origins(height, chunk_size, step)
 
-    while i < c.shape[0]:
-        c[i, 0] += x
-        c[i, 1] += y
-        c[i, 2] += x
-        c[i, 3] += y
-        i += 1
+    return chunk_size, [(x, y) for y in ys for x in xs]
 
-    return c
+
+def stitch_chunks(origins, results, chunk_size, indexes=None):
+    """
+    Joins the predictions of the overlapping chunks of an image. The overlaps are split
+    in halves, so each chunk only keeps the detections whose centre lies in its own
+    part. Thus, every object is taken from the chunk that sees it farther from its
+    borders. Then, the predictions are transformed into the right coordinates in the
+    whole image. All the chunks are processed at once.
+
+    Args:
+        origins (list): top-left (x, y) coordinates of all the chunks of the image
+            (see get_chunk_origins)
+        results (list): numpy arrays with the predictions of each chunk
+        chunk_size (int): width and height of the chunks
+        indexes (list): indexes of the origins of the results (all if None)
+
+    Returns:
+        list with a numpy array per chunk: [[x1, y1, x2, y2, score], ...]
+    """
+    xs, ys = np.array(origins).T
+    indexes = np.arange(len(origins)) if indexes is None else np.asarray(indexes)
+    counts = [len(result) for result in results]
+    chunk_ids = np.repeat(indexes, counts)
+    c = np.concatenate(results)
+
+    c[:, [0, 2]] += xs[chunk_ids, None]
+    c[:, [1, 3]] += ys[chunk_ids, None]
+
+    keep = np.ones(len(c), dtype=bool)
+
+    for starts, centres in ((xs, c[:, [0, 2]].mean(axis=1)), (ys, c[:, [1, 3]].mean(axis=1))):
+        # the limits of each column (row) of chunks are the middles of the overlaps
+        unique_starts = np.unique(starts)
+        limits = np.concatenate((
+            [-np.inf], (unique_starts[1:] + unique_starts[:-1] + chunk_size) / 2, [np.inf]))
+        positions = np.searchsorted(unique_starts, starts[chunk_ids])
+        keep &= (centres >= limits[positions]) & (centres < limits[positions + 1])
+
+    result_ids = np.repeat(np.arange(len(results)), counts)[keep]
+
+    return np.split(c[keep], np.cumsum(np.bincount(result_ids, minlength=len(results)))[:-1])
+
+
+def get_chunk_predictions(model, img):
+    """
+    Returns the predictions of the whole image ([[x1, y1, x2, y2, score], ...]) using
+    the 'chunks' or 'slide' inference mode. The chunks are evaluated in batches of
+    settings.BATCH_SIZE
+    """
+    h, w, _ = img.shape
+    chunk_size, origins = get_chunk_origins(
+        w, h, settings.CHUNK_SIZE if settings.INFERENCE_MODE == 'chunks' else None,
+        settings.CHUNK_OVERLAP
+    )
+    chunks = [img[y:y+chunk_size, x:x+chunk_size] for x, y in origins]
+    results = []
+
+    for idx in range(0, len(chunks), settings.BATCH_SIZE):
+        results.extend(model.get_padded_batch_predictions(chunks[idx:idx+settings.BATCH_SIZE]))
+
+    return np.concatenate(stitch_chunks(origins, results, chunk_size))
+
+
+def get_tiles(fileimgs):
+    """
+    Generator that yields the tiles of the images from settings.INPUT_FOLDER. The
+    images are decoded once through slide_cache. The last tile of each image is flagged
+    with is_last=True
+    """
+    for fileimg in fileimgs:
+        h, w, _ = slide_cache.get_slide(fileimg).shape
+        origins = get_tile_origins(w, h, settings.CUT_SIZE, settings.OVERLAP)
+
+        for idx, (x, y) in enumerate(origins):
+            yield Tile(fileimg, x, y, w, h,
+                       slide_cache.get_tile(fileimg, x, y, settings.CUT_SIZE),
+                       idx == len(origins) - 1)
+
+
+def get_tile_batches(fileimgs, batch_size):
+    """
+    Generator that groups the tiles of the images into lists of batch_size tiles.
+    A batch can contain tiles from several images
+    """
+    batch = []
+
+    for tile in get_tiles(fileimgs):
+        batch.append(tile)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def evaluate_tiles(tiles, results, cut_size):
+    """
+    Removes the predictions too close to the borders of their tiles (only for tiles
+    not touching the borders of the whole image), then transforms them into the
+    right coordinates in the whole image. All the tiles are processed at once using
+    boolean masks and broadcasting.
+
+    Args:
+        tiles (list): Tile namedtuples
+        results (list): numpy arrays with the predictions of each tile
+        cut_size (int): width and height of the tiles
+
+    Returns:
+        list with a numpy array per tile: [[x1, y1, x2, y2, score], ...]
+    """
+    counts = [len(result) for result in results]
+    tile_ids = np.repeat(np.arange(len(tiles)), counts)
+    c = np.concatenate(results)
+
+    xs = np.array([tile.x for tile in tiles])
+    ys = np.array([tile.y for tile in tiles])
+    widths = np.array([tile.width for tile in tiles])
+    heights = np.array([tile.height for tile in tiles])
+    inner_tiles = (xs != 0) & (ys != 0) & (xs + cut_size != widths) & (ys + cut_size != heights)
+
+    keep = ~(inner_tiles[tile_ids] & (c[:, :4] < settings.BOARDCACHE).any(axis=1))
+    c = c[keep]
+    tile_ids = tile_ids[keep]
+
+    c[:, [0, 2]] += xs[tile_ids, None]
+    c[:, [1, 3]] += ys[tile_ids, None]
+
+    return np.split(c, np.cumsum(np.bincount(tile_ids, minlength=len(tiles)))[:-1])
 
 
 def process_input_files(model, create_save_img_predictions=False, draw_annotations=False):
     """
     * Iterates over the images in settings.INPUT_FOLDER
-    * Gets the bouding boxes predictions using the sliding window technique
+    * Gets the bouding boxes predictions using the sliding window technique. The tiles
+      are evaluated in batches of settings.BATCH_SIZE. The 'chunks' and 'slide'
+      modes (see settings.INFERENCE_MODE) evaluate larger chunks of the images instead
     * Applies non maximum suppression
     * Saves the predictions on settings.OUTPUT_FOLDER and optionally images with
       the predictions and ground truth bounding boxes
     """
-    for fileimg in tuple(filter(lambda x: x.endswith('.jpeg'), os.listdir(settings.INPUT_FOLDER))):
-        print(fileimg)
-        predictions = [[0, 0, 0, 0, 0]]
-        fimg = Image.open(os.path.join(settings.INPUT_FOLDER, fileimg))
-        w, h = fimg.size
-        y = 0
-
-        while(y <= (h-settings.CUT_SIZE)):
-            x = 0
-
-            while(x <= (w-settings.CUT_SIZE)):
-                eval_results = evaluation(x, y, settings.CUT_SIZE, w, h, fimg, model)
-                if eval_results is not None:
-                    predictions = np.vstack((predictions, eval_results))
-                x = x+settings.OVERLAP
-                # print(x)
-
-            x = w - settings.CUT_SIZE
-            eval_results = evaluation(x, y, settings.CUT_SIZE, w, h, fimg, model)
-            if eval_results is not None:
-                predictions = np.vstack((predictions, eval_results))
-            y = y+settings.OVERLAP
-            # print(y)
-
-        x = 0
-        y = h - settings.CUT_SIZE
-
-        while(x <= (w-settings.CUT_SIZE)):
-            eval_results = evaluation(x, y, settings.CUT_SIZE, w, h, fimg, model)
-            if eval_results is not None:
-                predictions = np.vstack((predictions, eval_results))
-            x = x+settings.OVERLAP
-            # print(x)
-
-        eval_results = evaluation(
-            w-settings.CUT_SIZE, h-settings.CUT_SIZE, settings.CUT_SIZE, w, h, fimg, model)
-        if eval_results is not None:
-            predictions = np.vstack((predictions, eval_results))
-
-        predictions = np.delete(predictions, 0, axis=0)
-
-        # applying non maximum suppression
-        selected_ids = nms(predictions[:, :4], model.nmsthre, predictions[:, 4])
-        predictions = predictions[selected_ids]
-
-        print('saving xml')
-        generate_save_xml(predictions, fileimg, fimg.width, fimg.height)
-
-        if create_save_img_predictions:
-            print('saving jpeg')
-            draw = ImageDraw.Draw(fimg)
-            i = 1
-
-            while(i < predictions.shape[0]):
-                colors = int(255*predictions[i, 4])
-                draw.rectangle(predictions[i, 0:4].tolist(), outline=(colors, colors, colors))
-                i += 1
-
-            annotations_path = os.path.join(settings.INPUT_FOLDER, fileimg.replace("jpeg", "xml"))
-            if draw_annotations and os.path.exists(annotations_path):
-                with open(annotations_path) as fd:
-                    doc = xmltodict.parse(fd.read(), dict_constructor=dict)
-                    doc1 = deepcopy(doc)
-                    obj = len(doc1['annotation']['object'])-1
-
-                    while(obj != -1):
-                        bx1 = int(doc1['annotation']['object'][obj]['bndbox']['xmin'])
-                        by1 = int(doc1['annotation']['object'][obj]['bndbox']['ymin'])
-                        bx2 = int(doc1['annotation']['object'][obj]['bndbox']['xmax'])
-                        by2 = int(doc1['annotation']['object'][obj]['bndbox']['ymax'])
-                        draw.rectangle([bx1, by1, bx2, by2], outline=(0, 255, 0))
-                        obj -= 1
-
-            fimg.save(os.path.join(settings.OUTPUT_FOLDER, fileimg))
+    fileimgs = tuple(filter(lambda x: x.endswith('.jpeg'), os.listdir(settings.INPUT_FOLDER)))
+    predictions = {}  # {fileimg: DetectionBuffer, ...}
+
+    if settings.INFERENCE_MODE != 'tiles':
+        for fileimg in fileimgs:
+            img = slide_cache.get_slide(fileimg)
+            save_predictions(
+                fileimg, get_chunk_predictions(model, img), model.nmsthre,
+                create_save_img_predictions, draw_annotations, img.shape[1::-1], img
+            )
+        return
+
+    for batch in get_tile_batches(fileimgs, settings.BATCH_SIZE):
+        batch_results = evaluate_tiles(
+            batch, model.get_batch_predictions([tile.image for tile in batch]), settings.CUT_SIZE)
+
+        for tile, results in zip(batch, batch_results):
+            predictions.setdefault(tile.fileimg, DetectionBuffer()).append(results)
+
+            if tile.is_last:
+                save_predictions(
+                    tile.fileimg, predictions.pop(tile.fileimg, DetectionBuffer()).view,
+                    model.nmsthre, create_save_img_predictions, draw_annotations,
+                    (tile.width, tile.height)
+                )
+
+
+def save_predictions(fileimg, predictions, nmsthre, create_save_img_predictions=False,
+                     draw_annotations=False, img_size=None, img=None):
+    """
+    * Applies non maximum suppression to the predictions of the whole image
+      ([[x1, y1, x2, y2, score], ...])
+    * Saves the predictions on settings.OUTPUT_FOLDER and optionally the image with
+      the predictions and ground truth bounding boxes
+
+    The decoded BGR image (img) is optional. When it is not provided, the image is
+    only decoded when it is going to be saved or when its img_size (width, height)
+    is not provided
+    """
+    print(fileimg)
+
+    if img is None and (create_save_img_predictions or img_size is None):
+        img = slide_cache.get_slide(fileimg)
+
+    if img_size is None:
+        img_size = img.shape[1::-1]
+
+    # applying non maximum suppression
+    selected_ids = nms(predictions[:, :4], nmsthre, predictions[:, 4])
+    predictions = predictions[selected_ids]
 
+    print('saving xml')
+    generate_save_xml(predictions, fileimg, *img_size)
+
+    if create_save_img_predictions:
+        print('saving jpeg')
+        fimg = Image.fromarray(img[:, :, ::-1])
+        draw = ImageDraw.Draw(fimg)
+        i = 1
+
+        while(i < predictions.shape[0]):
+            colors = int(255*predictions[i, 4])
+            draw.rectangle(predictions[i, 0:4].tolist(), outline=(colors, colors, colors))
+            i += 1
+
+        annotations_path = os.path.join(settings.INPUT_FOLDER, fileimg.replace("jpeg", "xml"))
+        if draw_annotations and os.path.exists(annotations_path):
+            with open(annotations_path) as fd:
+                doc = xmltodict.parse(fd.read(), dict_constructor=dict)
+                doc1 = deepcopy(doc)
+                obj = len(doc1['annotation']['object'])-1
+
+                while(obj != -1):
+                    bx1 = int(doc1['annotation']['object'][obj]['bndbox']['xmin'])
+                    by1 = int(doc1['annotation']['object'][obj]['bndbox']['ymin'])
+                    bx2 = int(doc1['annotation']['object'][obj]['bndbox']['xmax'])
+                    by2 = int(doc1['annotation']['object'][obj]['bndbox']['ymax'])
+                    draw.rectangle([bx1, by1, bx2, by2], outline=(0, 255, 0))
+                    obj -= 1
+
+        fimg.save(os.path.join(settings.OUTPUT_FOLDER, fileimg))
         fimg.close()
-        print('done saving')
+
+    print('done saving')
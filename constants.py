@@ -16,15 +16,18 @@ class Dataset:
     """ Holds the datasets to work with """
     COCO = 1
     SIGNET_RING = 2
+    SIGNET_RING_SHARDS = 3
 
     CHOICES = [
         DatasetItem(COCO, 'COCO'),
         DatasetItem(SIGNET_RING, 'Signet Ring'),
+        DatasetItem(SIGNET_RING_SHARDS, 'Signet Ring (memory-mapped shards)'),
     ]
 
     NUM_CLASSES = {
         COCO: 80,
         SIGNET_RING: 2,
+        SIGNET_RING_SHARDS: 2,
     }
 
     @classmethod
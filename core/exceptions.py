@@ -15,3 +15,33 @@ class DatasetIdInvalid(Exception):
             message = 'The id provided is not a the valid option: {}'.format(
                 Dataset.print_choices())
         super().__init__(message)
+
+
+class InferenceBackendInvalid(Exception):
+    """
+    Exception to be raised when the inference backend name provided does not belong
+    to any of the backends implemented
+    """
+
+    def __init__(self, message=''):
+        """  """
+        if not message:
+            from models.backends import print_backend_choices
+            message = 'The backend provided is not a valid option: {}'.format(
+                print_backend_choices())
+        super().__init__(message)
+
+
+class ModelTypeInvalid(Exception):
+    """
+    Exception to be raised when the model type provided does not belong to any of
+    the models implemented
+    """
+
+    def __init__(self, message=''):
+        """  """
+        if not message:
+            from models.yolov3 import print_model_choices
+            message = 'The model type provided is not a valid option: {}'.format(
+                print_model_choices())
+        super().__init__(message)
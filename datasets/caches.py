@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""datasets/caches"""
+
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+import os
+import uuid
+import weakref
+
+import cv2
+import numpy as np
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded uint8 images bounded by max_bytes. Each image is kept in a
+    shared memory block and the bookkeeping in shared arrays guarded by a lock, so
+    all the DataLoader workers (created after the cache) read and fill the same
+    cache. The blocks are removed when the process that created the cache exits
+    """
+
+    def __init__(self, num_images, max_bytes):
+        """
+        Initialization of SharedImageCache class.
+        Args:
+            num_images (int): number of images of the dataset (cache keys from 0 to
+                num_images - 1)
+            max_bytes (int): maximum number of bytes of the cached images
+        """
+        self.max_bytes = max_bytes
+        self.prefix = 'yolov3_{}_{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = mp.Lock()
+        # height, width, channels (0 if not cached) and last use of each image
+        self._images = mp.RawArray('q', num_images * 4)
+        # cached bytes and use counter
+        self._counters = mp.RawArray('q', 2)
+        # blocks of the views returned by get_image in this process (see _close_blocks)
+        self._blocks = []
+        weakref.finalize(self, self._unlink_blocks, os.getpid(), self.prefix, self._images)
+        # the workers must share the tracker of this process, otherwise their own trackers
+        # would remove the blocks they created when they exit
+        resource_tracker.ensure_running()
+
+    @property
+    def images(self):
+        """ Returns the bookkeeping of the images as a num_images x 4 array """
+        return np.frombuffer(self._images, dtype=np.int64).reshape(-1, 4)
+
+    @property
+    def counters(self):
+        """ Returns the cached bytes and the use counter """
+        return np.frombuffer(self._counters, dtype=np.int64)
+
+    @staticmethod
+    def _unlink_blocks(pid, prefix, images):
+        """ Removes the shared memory blocks left when the process pid exits """
+        if os.getpid() != pid:
+            return
+
+        for index in np.flatnonzero(np.frombuffer(images, dtype=np.int64)[::4]):
+            try:
+                block = shared_memory.SharedMemory('{}_{}'.format(prefix, index))
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
+
+    def _get_block_name(self, index):
+        """ Returns the name of the shared memory block of the image """
+        return '{}_{}'.format(self.prefix, index)
+
+    def _close_blocks(self):
+        """
+        Closes the blocks of the views returned by get_image that are no longer used.
+        A block cannot be closed while a view of it exists (BufferError)
+        """
+        blocks = []
+
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                blocks.append(block)
+
+        self._blocks = blocks
+
+    def _evict(self, nbytes):
+        """
+        Removes the least recently used images until nbytes more fit in the cache.
+        Must be called holding the lock
+        """
+        images, counters = self.images, self.counters
+
+        while counters[0] + nbytes > self.max_bytes:
+            cached = np.flatnonzero(images[:, 0])
+            index = cached[np.argmin(images[cached, 3])]
+            block = shared_memory.SharedMemory(self._get_block_name(index))
+            block.close()
+            block.unlink()
+            counters[0] -= np.prod(images[index, :3])
+            images[index] = 0
+
+    def get_image(self, index, img_file):
+        """
+        Returns a read-only view of the cached image, or decodes img_file and caches it
+        (evicting the least recently used images if needed). The view avoids copying
+        the image on every hit, so it must be copied before modifying it in place
+        Args:
+            index (int): cache key of the image
+            img_file (str): path to the image
+        Returns:
+            img (numpy.ndarray): decoded BGR image (None if it could not be decoded)
+        """
+        images, counters = self.images, self.counters
+
+        with self.lock:
+            if images[index, 0]:
+                counters[1] += 1
+                images[index, 3] = counters[1]
+                shape = tuple(images[index, :3])
+                # the block stays mapped even if another worker evicts it meanwhile
+                block = shared_memory.SharedMemory(self._get_block_name(index))
+            else:
+                block = None
+
+        self._close_blocks()
+
+        if block is not None:
+            # the view keeps the block mapped until it is released
+            img = np.frombuffer(block.buf, dtype=np.uint8, count=int(np.prod(shape)))
+            img = img.reshape(shape)
+            img.flags.writeable = False
+            self._blocks.append(block)
+            return img
+
+        img = cv2.imread(img_file)
+
+        if img is None or img.nbytes > self.max_bytes:
+            return img
+
+        with self.lock:
+            if not images[index, 0]:
+                self._evict(img.nbytes)
+                block = shared_memory.SharedMemory(
+                    self._get_block_name(index), create=True, size=img.nbytes)
+                np.ndarray(img.shape, dtype=np.uint8, buffer=block.buf)[:] = img
+                block.close()
+                counters[0] += img.nbytes
+                counters[1] += 1
+                images[index] = img.shape + (counters[1],)
+
+        return img
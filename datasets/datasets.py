@@ -8,13 +8,26 @@ import numpy as np
 from pycocotools.coco import COCO
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 
 import constants
 import settings
+from datasets.caches import SharedImageCache
 from utils.managers.signet_ring_cell_dataset import SignetRingMGR
 from utils.utils import label2yolobox, preprocess, random_distort
 
 
+def collate_channels_last(batch):
+    """
+    Same as the default collate function of the DataLoader, but the images (CHW views
+    of HWC arrays returned by the datasets) are stacked in HWC order, so the batch
+    is a channels_last NCHW tensor without extra copies
+    """
+    imgs = torch.stack([torch.from_numpy(np.transpose(item[0], (1, 2, 0))) for item in batch])
+
+    return [imgs.permute(0, 3, 1, 2)] + default_collate([item[1:] for item in batch])
+
+
 class COCODataset(Dataset):
     """
     COCO dataset class.
@@ -23,7 +36,7 @@ class COCODataset(Dataset):
     def __init__(self, model_type, data_dir=settings.COCO_PATH,
                  json_file='instances_train2017.json',
                  name='train2017', img_size=416,
-                 augmentation=None, min_size=1, debug=False):
+                 augmentation=None, min_size=1, debug=False, rect=False, uint8=False):
         """
         COCO dataset initialization. Annotation data are read into memory by COCO API.
         Args:
@@ -34,6 +47,10 @@ class COCODataset(Dataset):
             img_size (int): target image size after pre-processing
             min_size (int): bounding boxes smaller than this are ignored
             debug (bool): if True, only one data id is selected from the dataset
+            rect (bool): if True, rectangular letterbox (see utils.utils.preprocess).
+                Only for evaluation with batch_size 1
+            uint8 (bool): if True, the images are returned as uint8 arrays (0 to 255)
+                instead of float64 arrays (0 to 1)
 
         source: https://github.com/DeNA/PyTorch_YOLOv3/blob/master/dataset/cocodataset.py
         """
@@ -57,6 +74,8 @@ class COCODataset(Dataset):
         self.saturation = augmentation['SATURATION']
         self.exposure = augmentation['EXPOSURE']
         self.random_distort = augmentation['RANDOM_DISTORT']
+        self.rect = rect
+        self.uint8 = uint8
 
     def __len__(self):
         return len(self.ids)
@@ -66,9 +85,10 @@ class COCODataset(Dataset):
         One image / label pair for the given index is picked up \
         and pre-processed.
         Args:
-            index (int): data index
+            index (int or tuple): data index or (data index, img_size) pair to
+                overwrite the img_size of the dataset (see MultiScaleBatchSampler)
         Returns:
-            img (numpy.ndarray): pre-processed image
+            img (numpy.ndarray): pre-processed image (CHW, see uint8)
             padded_labels (torch.Tensor): pre-processed label data. \
                 The shape is :math:`[self.max_labels, 5]`. \
                 each label consists of [class, xc, yc, w, h]:
@@ -81,6 +101,7 @@ class COCODataset(Dataset):
                 dx, dy (int): pad size
             id_ (int): same as the input index. Used for evaluation.
         """
+        index, img_size = index if isinstance(index, tuple) else (index, self.img_size)
         id_ = self.ids[index]
 
         anno_ids = self.coco.getAnnIds(imgIds=[int(id_)], iscrowd=None)
@@ -101,16 +122,20 @@ class COCODataset(Dataset):
             img = cv2.imread(img_file)
         assert img is not None
 
-        img, info_img = preprocess(img, self.img_size, jitter=self.jitter,
-                                   random_placing=self.random_placing)
+        img, info_img = preprocess(img, img_size, jitter=self.jitter,
+                                   random_placing=self.random_placing, rect=self.rect)
 
         if self.random_distort:
             img = random_distort(img, self.hue, self.saturation, self.exposure)
 
-        img = np.transpose(img / 255., (2, 0, 1))
+        # uint8 images are scaled by the consumer (see utils.utils.normalize_images)
+        img = np.asarray(img, dtype=np.uint8) if self.uint8 else img / 255.
 
         if lrflip:
-            img = np.flip(img, axis=2).copy()
+            img = np.flip(img, axis=1).copy()
+
+        # CHW view of the HWC array (see collate_channels_last)
+        img = np.transpose(img, (2, 0, 1))
 
         # load labels
         labels = []
@@ -124,7 +149,7 @@ class COCODataset(Dataset):
         if len(labels) > 0:
             labels = np.stack(labels)
             if 'YOLO' in self.model_type:
-                labels = label2yolobox(labels, info_img, self.img_size, lrflip)
+                labels = label2yolobox(labels, info_img, img_size, lrflip)
             padded_labels[range(len(labels))[:self.max_labels]
                           ] = labels[:self.max_labels]
         padded_labels = torch.from_numpy(padded_labels)
@@ -139,7 +164,9 @@ class SignetRing(Dataset):
                  train_path=settings.SIGNET_TRAIN_PATH,
                  img_train_dir=settings.SIGNET_TRAIN_POS_IMG_PATH,
                  img_size=416,
-                 augmentation=None, min_size=1, debug=False):
+                 augmentation=None, min_size=1, debug=False, rect=False,
+                 cache_size=settings.SIGNET_DECODED_IMAGES_CACHE_SIZE,
+                 uint8=False):
         """
         SignetRing dataset initialization.
         Args:
@@ -149,16 +176,28 @@ class SignetRing(Dataset):
             img_size (int): target image size after pre-processing
             min_size (int): bounding boxes smaller than this are ignored
             debug (bool): if True, only one data id is selected from the dataset
+            rect (bool): if True, rectangular letterbox (see utils.utils.preprocess).
+                Only for evaluation with batch_size 1
+            uint8 (bool): if True, the images are returned as uint8 arrays (0 to 255)
+                instead of float64 arrays (0 to 1)
+            cache_size (int): maximum number of bytes of decoded images shared by the
+                DataLoader workers (see SharedImageCache). 0 disables the cache
 
         Inspired on: https://github.com/DeNA/PyTorch_YOLOv3/blob/master/dataset/cocodataset.py
         """
-        self.model_type = model_type
         self.img_train_dir = img_train_dir
         self.signet = SignetRingMGR(train_path)
         self.ids = self.signet.get_img_ids()
         if debug:
             self.ids = self.ids[1:2]
             print("debug mode...", self.ids)
+        self._set_options(model_type, img_size, augmentation, min_size, rect, uint8)
+        self.image_cache = SharedImageCache(len(self.ids), cache_size) if cache_size \
+            else None
+
+    def _set_options(self, model_type, img_size, augmentation, min_size, rect, uint8):
+        """ Sets the preprocessing and augmentation options (see __init__) """
+        self.model_type = model_type
         # TODO: Review if this max_labels is ok with the number of bndboxes per picture
         self.max_labels = 50
         self.img_size = img_size
@@ -170,6 +209,8 @@ class SignetRing(Dataset):
         self.saturation = augmentation['SATURATION']
         self.exposure = augmentation['EXPOSURE']
         self.random_distort = augmentation['RANDOM_DISTORT']
+        self.rect = rect
+        self.uint8 = uint8
 
     def __len__(self):
         return len(self.ids)
@@ -179,9 +220,10 @@ class SignetRing(Dataset):
         One image / label pair for the given index is picked up \
         and pre-processed.
         Args:
-            index (int): data index
+            index (int or tuple): data index or (data index, img_size) pair to
+                overwrite the img_size of the dataset (see MultiScaleBatchSampler)
         Returns:
-            img (numpy.ndarray): pre-processed image
+            img (numpy.ndarray): pre-processed image (CHW, see uint8)
             padded_labels (torch.Tensor): pre-processed label data. \
                 The shape is :math:`[self.max_labels, 5]`. \
                 each label consists of [class, xc, yc, w, h]:
@@ -194,55 +236,151 @@ class SignetRing(Dataset):
                 dx, dy (int): pad size
             id_ (int): same as the input index. Used for evaluation.
         """
+        index, img_size = index if isinstance(index, tuple) else (index, self.img_size)
         id_ = self.ids[index]
 
-        # anno_ids = self.coco.getAnnIds(imgIds=[int(id_)], iscrowd=None)
-        # annotations = self.coco.loadAnns(anno_ids)
-        annotations = self.signet.get_annotations(
-            id_,
-            filters=dict(pose='', truncated=None, occluded=None,  difficult=None)
-        )
-
         lrflip = False
         if np.random.rand() > 0.5 and self.lrflip is True:
             lrflip = True
 
-        img_file = os.path.join(self.img_train_dir, '{}.jpeg'.format(id_))
-        img = cv2.imread(img_file)
+        img = self.get_image(index)
 
         assert img is not None
 
-        img, info_img = preprocess(img, self.img_size, jitter=self.jitter,
-                                   random_placing=self.random_placing)
+        img, info_img = preprocess(img, img_size, jitter=self.jitter,
+                                   random_placing=self.random_placing, rect=self.rect)
 
         if self.random_distort:
             img = random_distort(img, self.hue, self.saturation, self.exposure)
 
-        img = np.transpose(img / 255., (2, 0, 1))
+        # uint8 images are scaled by the consumer (see utils.utils.normalize_images)
+        img = np.asarray(img, dtype=np.uint8) if self.uint8 else img / 255.
 
         if lrflip:
-            img = np.flip(img, axis=2).copy()
+            img = np.flip(img, axis=1).copy()
+
+        # CHW view of the HWC array (see collate_channels_last)
+        img = np.transpose(img, (2, 0, 1))
 
         # load labels
-        labels = []
-        for anno in annotations:
-            # if anno['bbox'][2] > self.min_size and anno['bbox'][3] > self.min_size:
-            if anno.width > self.min_size and anno.height > self.min_size:
-                labels.append([constants.SIGNET_RING_CLASS_ID])
-                labels[-1].extend([
-                    anno.bndbox.xmin,
-                    anno.bndbox.ymin,
-                    anno.width,
-                    anno.height,
-                ])
+        labels = self.get_labels(index)
 
         padded_labels = np.zeros((self.max_labels, 5))
         if len(labels) > 0:
             labels = np.stack(labels)
             if 'YOLO' in self.model_type:
-                labels = label2yolobox(labels, info_img, self.img_size, lrflip)
+                labels = label2yolobox(labels, info_img, img_size, lrflip)
             padded_labels[range(len(labels))[:self.max_labels]
                           ] = labels[:self.max_labels]
         padded_labels = torch.from_numpy(padded_labels)
 
         return img, padded_labels, info_img, id_
+
+    def get_image(self, index):
+        """
+        Returns the decoded BGR image (None if it could not be decoded). The images from
+        the cache are read-only views (see SharedImageCache.get_image)
+        """
+        img_file = os.path.join(self.img_train_dir, '{}.jpeg'.format(self.ids[index]))
+
+        if self.image_cache:
+            return self.image_cache.get_image(index, img_file)
+
+        return cv2.imread(img_file)
+
+    def get_labels(self, index):
+        """
+        Returns the labels [class, xmin, ymin, w, h] of the bounding boxes larger
+        than min_size
+        """
+        boxes = self.signet.get_boxes(
+            self.ids[index],
+            filters=dict(pose='', truncated=None, occluded=None,  difficult=None)
+        )
+        widths = np.abs(boxes['xmax'] - boxes['xmin'])
+        heights = np.abs(boxes['ymax'] - boxes['ymin'])
+        labels = np.stack([np.full(len(boxes), constants.SIGNET_RING_CLASS_ID, dtype=np.float64),
+                           boxes['xmin'], boxes['ymin'], widths, heights], axis=1)
+
+        return labels[(widths > self.min_size) & (heights > self.min_size)]
+
+
+class SignetRingShards(SignetRing):
+    """
+    SignetRing dataset read from the memory-mapped shards created by
+    utils.data.create_signet_shards. The images are read as views of the shards
+    (no copies, one open file per shard) and the labels from the index of the shards
+    """
+
+    def __init__(self, model_type,
+                 shards_dir=settings.SIGNET_TRAIN_SHARDS_PATH,
+                 img_size=416,
+                 augmentation=None, min_size=1, debug=False, rect=False, uint8=False):
+        """
+        SignetRingShards dataset initialization.
+        Args:
+            model_type (str): model name specified in config file
+            shards_dir (str): path to the folder containing the shards and their index
+            img_size (int): target image size after pre-processing
+            min_size (int): bounding boxes smaller than this are ignored
+            debug (bool): if True, only one data id is selected from the dataset
+            rect (bool): if True, rectangular letterbox (see utils.utils.preprocess).
+                Only for evaluation with batch_size 1
+            uint8 (bool): if True, the images are returned as uint8 arrays (0 to 255)
+                instead of float64 arrays (0 to 1)
+        """
+        self.shards_dir = shards_dir
+        self.index = dict(np.load(os.path.join(shards_dir, 'index.npz')))
+        self.ids = tuple(self.index['ids'])
+        self.positions = np.arange(len(self.ids))
+        if debug:
+            self.ids = self.ids[1:2]
+            self.positions = self.positions[1:2]
+            print("debug mode...", self.ids)
+        self._set_options(model_type, img_size, augmentation, min_size, rect, uint8)
+        # opened by each process on first use (see get_shard)
+        self.shards = dict()
+
+    def __getstate__(self):
+        """ The shards are not pickled (e.g. to the DataLoader workers) """
+        state = self.__dict__.copy()
+        state['shards'] = dict()
+
+        return state
+
+    def get_shard(self, shard):
+        """ Returns the shard as a read-only uint8 np.memmap """
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(
+                os.path.join(self.shards_dir, 'shard_{:04d}.bin'.format(shard)), dtype=np.uint8,
+                mode='r')
+
+        return self.shards[shard]
+
+    def get_image(self, index):
+        """
+        Returns the BGR image, a view of its shard or decoded from it if the shards
+        hold encoded images
+        """
+        position = self.positions[index]
+        offset = self.index['offsets'][position]
+        data = self.get_shard(self.index['shards'][position])[
+            offset:offset+self.index['nbytes'][position]]
+
+        if self.index['encoded']:
+            return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+        return data.reshape(self.index['shapes'][position])
+
+    def get_labels(self, index):
+        """
+        Returns the labels [class, xmin, ymin, w, h] of the bounding boxes larger
+        than min_size
+        """
+        position = self.positions[index]
+        boxes = self.index['labels'][
+            self.index['label_offsets'][position]:self.index['label_offsets'][position+1]]
+        boxes = boxes[(boxes[:, 2] > self.min_size) & (boxes[:, 3] > self.min_size)]
+
+        return np.hstack([np.full((len(boxes), 1), constants.SIGNET_RING_CLASS_ID),
+                          boxes]).astype(np.float64)
@@ -5,7 +5,7 @@ from collections import namedtuple
 
 from constants import Dataset
 from core.exceptions import DatasetIdInvalid
-from .datasets import COCODataset, SignetRing
+from .datasets import COCODataset, SignetRing, SignetRingShards
 
 
 def get_dataset_class(dataset_id):
@@ -18,6 +18,7 @@ def get_dataset_class(dataset_id):
     datasets = [
         DatasetItem(Dataset.COCO, COCODataset),
         DatasetItem(Dataset.SIGNET_RING, SignetRing),
+        DatasetItem(Dataset.SIGNET_RING_SHARDS, SignetRingShards),
     ]
 
     return tuple(filter(lambda x: x.id == dataset_id, datasets))[0].dataset_class
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""datasets/samplers"""
+
+import random
+
+import torch
+from torch.utils.data import Sampler
+
+
+class MultiScaleBatchSampler(Sampler):
+    """
+    Shuffled batch sampler whose batches are lists of (index, img_size) pairs. The
+    img_size is picked randomly from img_sizes at the start of every resize_interval
+    batches, including the first one (also across epochs), so the datasets (see COCODataset and SignetRing) can change the
+    input size without rebuilding the DataLoader and respawning its workers
+    """
+
+    def __init__(self, data_source, batch_size, img_size, img_sizes=None, resize_interval=1,
+                 drop_last=False):
+        """
+        Initialization of MultiScaleBatchSampler class.
+        Args:
+            data_source (Dataset): dataset to sample from
+            batch_size (int): size of the batches
+            img_size (int): input size used by all the batches if img_sizes is None
+            img_sizes (sequence): input sizes to choose from
+            resize_interval (int): number of consecutive batches with the same size
+            drop_last (bool): if True, drops the last incomplete batch of each epoch
+        """
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.img_size = img_size
+        self.img_sizes = img_sizes
+        self.resize_interval = resize_interval
+        self.drop_last = drop_last
+        self.num_batches = 0
+
+    def __iter__(self):
+        indexes = torch.randperm(len(self.data_source)).tolist()
+
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if self.img_sizes and self.num_batches % self.resize_interval == 0:
+                self.img_size = random.choice(self.img_sizes)
+            self.num_batches += 1
+
+            yield [(index, self.img_size) for index in indexes[start:start+self.batch_size]]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.data_source) // self.batch_size
+
+        return (len(self.data_source) + self.batch_size - 1) // self.batch_size
@@ -32,6 +32,8 @@ def main():
                         default=False, help='background(no-display mode. save "./output.png")')
     parser.add_argument('--detect_thresh', type=float,
                         default=None, help='confidence threshold')
+    parser.add_argument('--rect', action='store_true', default=False,
+                        help='rectangular letterbox padded to a multiple of 32 (see TEST RECT)')
     parser.add_argument(
         '--dataset', help='dataset to work with: {}'.format(Dataset.print_choices()),
         type=int, default=Dataset.SIGNET_RING)
@@ -52,7 +54,9 @@ def main():
 
     img = cv2.imread(args.image)
     img_raw = img.copy()[:, :, ::-1].transpose((2, 0, 1))
-    img, info_img = preprocess(img, imgsize, jitter=0)  # info = (h, w, nh, nw, dx, dy)
+    rect = args.rect or cfg['TEST'].get('RECT', False)
+    # info = (h, w, nh, nw, dx, dy)
+    img, info_img = preprocess(img, imgsize, jitter=0, rect=rect)
     img = np.transpose(img / 255., (2, 0, 1))
     img = torch.from_numpy(img).float().unsqueeze(0)
 
@@ -75,7 +79,7 @@ def main():
         else:
             model.load_state_dict(state)
 
-    model.eval()
+    model.fuse()
 
     with torch.no_grad():
         outputs = model(img)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+""" models/backends """
+
+from collections import namedtuple
+import os
+import tempfile
+
+import torch
+
+from core.exceptions import InferenceBackendInvalid
+
+
+class EagerBackend:
+    """
+    Runs the YOLOv3 module as it is. All the backends are callables receiving a batch
+    of images with shape (N, 3, imgsize, imgsize) and returning the same output as
+    YOLOv3.forward in evaluation mode
+    """
+
+    def __init__(self, model, imgsize, path=''):
+        """
+        Initializes the object
+        Args:
+            model (YOLOv3): model with the weights already loaded and in evaluation mode
+            imgsize (int): input image size
+            path (str): file with the exported model (not used by this backend)
+        """
+        self.model = model
+
+    def __call__(self, imgs):
+        """ Returns the model outputs for the images """
+        with torch.no_grad():
+            return self.model(imgs)
+
+
+class ExportedBackend(EagerBackend):
+    """
+    Base class of the backends running a graph exported from the model. The Python
+    control flow of YOLOv3 and YOLOLayer (route/YOLO layer indexes, grid construction)
+    is resolved while exporting, so the graph is only valid for the input size used to
+    export it. Thus, the rectangular letterboxes (RECT) and the 'chunks' and 'slide'
+    inference modes require the eager or compile backends
+    """
+
+    def check_input_size(self, imgs):
+        """ Raises a ValueError if the images are not imgsize x imgsize """
+        if tuple(imgs.shape[2:]) != (self.imgsize, self.imgsize):
+            raise ValueError(
+                '{} only accepts {}x{} images (the size used to export the model), got {}x{}. '
+                'Use the eager or compile backends for other sizes'.format(
+                    type(self).__name__, self.imgsize, self.imgsize, *imgs.shape[2:]))
+
+
+class TorchScriptBackend(ExportedBackend):
+    """
+    Runs a TorchScript graph traced from the model (see ExportedBackend)
+    """
+
+    def __init__(self, model, imgsize, path=''):
+        """
+        Initializes the object. The traced model is loaded from path if the file exists,
+        otherwise the model is traced and saved on path (if provided). Remove the file
+        to export it again after changing the checkpoint.
+        Args:
+            model (YOLOv3): model with the weights already loaded and in evaluation mode
+            imgsize (int): input image size
+            path (str): file with the exported model
+        """
+        device = next(model.parameters()).device
+        self.imgsize = imgsize
+
+        if path and os.path.isfile(path):
+            self.model = torch.jit.load(path, map_location=device)
+        else:
+            self.model = self.export(model, imgsize, path)
+
+    def __call__(self, imgs):
+        """ Returns the model outputs for the images """
+        self.check_input_size(imgs)
+
+        return super().__call__(imgs)
+
+    @staticmethod
+    def export(model, imgsize, path=''):
+        """ Traces the model, saves it on path (if provided) and returns it """
+        device = next(model.parameters()).device
+
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                model, torch.rand(2, 3, imgsize, imgsize, device=device), check_trace=False)
+
+        if path:
+            torch.jit.save(traced, path)
+
+        return traced
+
+
+class ONNXRuntimeBackend(ExportedBackend):
+    """
+    Runs the model exported to ONNX with ONNX Runtime (requires the onnx and
+    onnxruntime packages). The batch dimension is dynamic, the input size is fixed
+    (see ExportedBackend)
+    """
+
+    INPUT_NAME = 'images'
+
+    def __init__(self, model, imgsize, path=''):
+        """
+        Initializes the object. The ONNX file on path is used if it exists, otherwise the
+        model is exported to path (or to a temporary file removed once it is loaded if
+        path is not provided). Remove the file to export it again after changing the
+        checkpoint.
+        Args:
+            model (YOLOv3): model with the weights already loaded and in evaluation mode
+            imgsize (int): input image size
+            path (str): file with the exported model
+        """
+        import onnxruntime
+
+        self.imgsize = imgsize
+        providers = ['CPUExecutionProvider']
+        if next(model.parameters()).is_cuda:
+            providers.insert(0, 'CUDAExecutionProvider')
+
+        if not path:
+            # the session keeps the model in memory, so the temporary file is removed
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, 'yolov3.onnx')
+                self.export(model, imgsize, path)
+                self.session = onnxruntime.InferenceSession(path, providers=providers)
+            return
+
+        if not os.path.isfile(path):
+            self.export(model, imgsize, path)
+
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+
+    @classmethod
+    def export(cls, model, imgsize, path):
+        """ Exports the model to the ONNX file on path """
+        device = next(model.parameters()).device
+
+        with torch.no_grad():
+            torch.onnx.export(
+                model, torch.rand(1, 3, imgsize, imgsize, device=device), path,
+                input_names=[cls.INPUT_NAME], output_names=['output'],
+                dynamic_axes={cls.INPUT_NAME: {0: 'batch'}, 'output': {0: 'batch'}},
+                opset_version=11
+            )
+
+    def __call__(self, imgs):
+        """ Returns the model outputs for the images """
+        self.check_input_size(imgs)
+        output = self.session.run(None, {self.INPUT_NAME: imgs.cpu().numpy()})[0]
+
+        return torch.from_numpy(output).to(imgs.device)
+
+
+class CompiledBackend(EagerBackend):
+    """
+    Runs the model optimized by torch.compile (requires PyTorch 2.0 or newer). The
+    model is compiled during the first calls
+    """
+
+    def __init__(self, model, imgsize, path=''):
+        """
+        Initializes the object
+        Args:
+            model (YOLOv3): model with the weights already loaded and in evaluation mode
+            imgsize (int): input image size
+            path (str): file with the exported model (not used by this backend)
+        """
+        if not hasattr(torch, 'compile'):
+            raise ImportError('torch.compile requires PyTorch 2.0 or newer')
+
+        self.model = torch.compile(model)
+
+
+BackendItem = namedtuple('BackendItem', ['name', 'backend_class'])
+
+BACKENDS = [
+    BackendItem('eager', EagerBackend),
+    BackendItem('torchscript', TorchScriptBackend),
+    BackendItem('onnxruntime', ONNXRuntimeBackend),
+    BackendItem('compile', CompiledBackend),
+]
+
+
+def print_backend_choices():
+    """ Returns the available backends """
+    return ', '.join(backend.name for backend in BACKENDS)
+
+
+def get_backend_class(name):
+    """ Returns the inference backend corresponding to the name provided """
+    backends = tuple(filter(lambda x: x.name == name, BACKENDS))
+
+    if not backends:
+        raise InferenceBackendInvalid()
+
+    return backends[0].backend_class
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+""" models/quantization """
+
+import io
+
+import torch
+import torch.nn as nn
+
+from utils.utils import normalize_images
+
+
+class QuantizedConvBlock(nn.Module):
+    """
+    Wraps a conv2d / batchnorm / leaky ReLU block (see models.yolov3.add_conv) with
+    quantization stubs, so the block runs in INT8 while its inputs and outputs
+    remain float tensors. Therefore, residual additions, upsampling, route layers
+    and the YOLO layers keep working in float
+    """
+
+    def __init__(self, block):
+        """
+        Initializes the object
+        Args:
+            block (Sequential): conv / batchnorm / leaky ReLU block
+        """
+        super(QuantizedConvBlock, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.block = block
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.block(self.quant(x)))
+
+
+def wrap_conv_blocks(module):
+    """
+    Replaces in-place every conv / batchnorm / leaky ReLU block inside module by a
+    QuantizedConvBlock and returns the wrapped blocks
+    """
+    wrapped = []
+
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential) and hasattr(child, 'conv'):
+            setattr(module, name, QuantizedConvBlock(child))
+            wrapped.append(getattr(module, name))
+        else:
+            wrapped.extend(wrap_conv_blocks(child))
+
+    return wrapped
+
+
+def prepare_quantization(model, backend='fbgemm'):
+    """
+    Prepares the YOLOv3 model for post-training static quantization: folds the
+    batchnorm layers (YOLOv3.fuse), wraps the conv blocks of the backbone and heads
+    with quantization stubs and inserts the observers. The 1x1 convolutions of the
+    YOLO layers and their decoding stay in float.
+    Args:
+        model (YOLOv3): model with the float weights already loaded
+        backend (str): quantized engine, fbgemm (x86) or qnnpack (ARM)
+    Returns:
+        model (YOLOv3): the same model ready to be calibrated
+    """
+    torch.backends.quantized.engine = backend
+    model.cpu().fuse()
+
+    for block in wrap_conv_blocks(model.module_list):
+        block.qconfig = torch.quantization.get_default_qconfig(backend)
+
+    return torch.quantization.prepare(model, inplace=True)
+
+
+def calibrate(model, images, num_batches=None):
+    """
+    Runs the prepared model on the images so the observers record the ranges of the
+    activations
+    Args:
+        model (YOLOv3): model returned by prepare_quantization
+        images (iterable): batches of images (uint8 or float torch.Tensor with shape
+            (N, 3, H, W), see utils.utils.normalize_images) or
+            tuples whose first element is the batch (e.g. a SignetRing DataLoader)
+        num_batches (int): maximum number of batches used (all if None)
+    """
+    with torch.no_grad():
+        for idx, batch in enumerate(images):
+            if num_batches is not None and idx >= num_batches:
+                break
+            if isinstance(batch, (tuple, list)):
+                batch = batch[0]
+            model(normalize_images(batch))
+
+
+def convert(model):
+    """ Converts the calibrated model into an INT8 model (in-place) and returns it """
+    return torch.quantization.convert(model, inplace=True)
+
+
+def quantize_model(model, images, num_batches=None, backend='fbgemm'):
+    """
+    Post-training static quantization of YOLOv3 (see prepare_quantization)
+    Args:
+        model (YOLOv3): model with the float weights already loaded, modified in-place
+        images (iterable): calibration batches (see calibrate)
+        num_batches (int): maximum number of calibration batches (all if None)
+        backend (str): quantized engine, fbgemm (x86) or qnnpack (ARM)
+    Returns:
+        model (YOLOv3): quantized model
+    """
+    prepare_quantization(model, backend)
+    calibrate(model, images, num_batches)
+
+    return convert(model)
+
+
+def save_quantized_checkpoint(model, path, backend='fbgemm'):
+    """
+    Saves the quantized model as a checkpoint flagged as quantized, so it can be
+    loaded by challenge.classes.MyModel like any other checkpoint
+    """
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'quantized': True,
+        'quantization_backend': backend,
+    }, path)
+
+
+def load_quantized_state(model, state):
+    """
+    Turns the float YOLOv3 model into the quantized architecture and loads the state
+    of a checkpoint saved by save_quantized_checkpoint
+    Args:
+        model (YOLOv3): float model (randomly initialized)
+        state (dict): checkpoint
+    Returns:
+        model (YOLOv3): quantized model in evaluation mode
+    """
+    convert(prepare_quantization(model, state.get('quantization_backend', 'fbgemm')))
+    model.load_state_dict(state['model_state_dict'])
+
+    return model.eval()
+
+
+def get_model_size(model):
+    """ Returns the size in bytes of the serialized state dict of the model """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.tell()
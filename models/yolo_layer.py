@@ -1,13 +1,21 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import numpy as np
-from utils.utils import bboxes_iou
+from utils.utils import SparsePredictions, bboxes_iou
 
 
 class YOLOLayer(nn.Module):
     """
     detection layer corresponding to yolo_layer.c of darknet
     """
+    # number of predictions per image compared at once against the labels in build_targets
+    IOU_CHUNK_SIZE = 1024
+    # number of (fh, fw, device, dtype) grids kept by get_grids (multi-scale training
+    # uses up to 10 different sizes)
+    GRID_CACHE_SIZE = 16
+
     def __init__(self, config_model, layer_no, in_ch, ignore_thre=0.7):
         """
         Args:
@@ -35,9 +43,19 @@ class YOLOLayer(nn.Module):
                                  for w, h in self.anchors]
         self.masked_anchors = [self.all_anchors_grid[i]
                                for i in self.anch_mask]
-        self.ref_anchors = np.zeros((len(self.all_anchors_grid), 4))
-        self.ref_anchors[:, 2:] = np.array(self.all_anchors_grid)
-        self.ref_anchors = torch.FloatTensor(self.ref_anchors)
+        ref_anchors = np.zeros((len(self.all_anchors_grid), 4))
+        ref_anchors[:, 2:] = np.array(self.all_anchors_grid)
+        # position of each anchor inside anch_mask (-1 for anchors of other layers)
+        anch_positions = torch.full((len(self.anchors),), -1, dtype=torch.long)
+        anch_positions[self.anch_mask] = torch.arange(self.n_anchors)
+        # non-persistent buffers follow .to() / .cuda() without changing the state dict
+        self.register_buffer('ref_anchors', torch.FloatTensor(ref_anchors), persistent=False)
+        self.register_buffer(
+            'masked_anchors_wh', torch.FloatTensor(self.masked_anchors), persistent=False)
+        self.register_buffer('anch_positions', anch_positions, persistent=False)
+        self.grids = OrderedDict()
+        # objectness threshold of the sparse decoding (disabled if None)
+        self.sparse_conf_thre = None
         self.conv = nn.Conv2d(in_channels=in_ch,
                               out_channels=self.n_anchors * (self.n_classes + 5),
                               kernel_size=1, stride=1, padding=0)
@@ -66,13 +84,105 @@ class YOLOLayer(nn.Module):
         """
         output = self.conv(xin)
 
+        # the decoding and the losses (exp, sigmoid, BCE) run at least in fp32, even
+        # under reduced precision autocast
+        with torch.autocast(output.device.type, enabled=False):
+            output = output.to(torch.promote_types(output.dtype, torch.float32))
+
+            if labels is None:  # not training
+                if self.sparse_conf_thre is not None:
+                    return self.decode_sparse(output, self.sparse_conf_thre)
+                return self.decode(output)
+
+            return self.get_losses(output, labels)
+
+    def split_anchors(self, output):
+        """
+        Returns the convolution output :math:`(N, A * (5 + n_classes), H, W)` as a
+        :math:`(N, A, H, W, 5 + n_classes)` view (no copies) for both memory formats
+        """
+        batchsize, _, fh, fw = output.shape
+        n_ch = 5 + self.n_classes
+
+        if output.is_contiguous(memory_format=torch.channels_last) and not output.is_contiguous():
+            output = output.permute(0, 2, 3, 1).view(batchsize, fh, fw, self.n_anchors, n_ch)
+            return output.permute(0, 3, 1, 2, 4)
+
+        output = output.view(batchsize, self.n_anchors, n_ch, fh, fw)
+        return output.permute(0, 1, 3, 4, 2)
+
+    def decode(self, output):
+        """
+        Inference decoding of the convolution output. The result is allocated once and
+        every activation is written straight into it (no copies of the output, no
+        full-size temporaries). Rectangular feature maps are supported
+        Args:
+            output (torch.Tensor): convolution output whose size is
+                :math:`(N, A * (5 + n_classes), H, W)`
+        Returns:
+            pred (torch.Tensor): detections whose size is :math:`(N, A * H * W, 5 + n_classes)`.
+                Each one consists of [xc, yc, w, h, obj, cls_1, ...] in pixels of the
+                input image
+        """
+        batchsize, _, fh, fw = output.shape
+        n_ch = 5 + self.n_classes
+        output = self.split_anchors(output).detach()
+        x_shift, y_shift, w_anchors, h_anchors = self.get_grids(fh, fw, output)
+
+        pred = output.new_empty((batchsize, self.n_anchors, fh, fw, n_ch))
+        torch.sigmoid(output[..., :2], out=pred[..., :2])
+        pred[..., 0].add_(x_shift)
+        pred[..., 1].add_(y_shift)
+        torch.exp(output[..., 2:4], out=pred[..., 2:4])
+        pred[..., 2].mul_(w_anchors)
+        pred[..., 3].mul_(h_anchors)
+        pred[..., :4].mul_(self.stride)
+        torch.sigmoid(output[..., 4:], out=pred[..., 4:])
+
+        return pred.view(batchsize, -1, n_ch)
+
+    def decode_sparse(self, output, conf_thre):
+        """
+        Inference decoding of the cells whose objectness is at least conf_thre. As the
+        confidence of a detection is objectness * class confidence, the other cells can
+        never pass the confidence threshold of postprocess with the same conf_thre; so
+        they are neither decoded nor returned
+        Args:
+            output (torch.Tensor): convolution output whose size is
+                :math:`(N, A * (5 + n_classes), H, W)`
+            conf_thre (float): objectness threshold
+        Returns:
+            SparsePredictions: detections of the cells kept, ordered by image (see decode)
+        """
         batchsize = output.shape[0]
+        output = self.split_anchors(output).detach()
+
+        obj = torch.sigmoid(output[..., 4])
+        b, a, j, i = (obj >= conf_thre).nonzero(as_tuple=True)
+        cells = output[b, a, j, i]
+        anchors = self.masked_anchors_wh.to(output)[a]
+
+        pred = torch.sigmoid(cells)
+        pred[:, 0].add_(i.to(pred))
+        pred[:, 1].add_(j.to(pred))
+        torch.exp(cells[:, 2:4], out=pred[:, 2:4])
+        pred[:, 2:4].mul_(anchors)
+        pred[:, :4].mul_(self.stride)
+        pred[:, 4] = obj[b, a, j, i]
+
+        return SparsePredictions(pred, b, batchsize)
+
+    def get_losses(self, output, labels):
+        """
+        Decodes the convolution output and calculates the losses (see forward)
+        Args:
+            output (torch.Tensor): convolution output whose size is
+                :math:`(N, A * (5 + n_classes), H, W)`
+            labels (torch.Tensor): label data whose size is :math:`(N, K, 5)`
+        """
         fsize = output.shape[2]
         n_ch = 5 + self.n_classes
-        dtype = torch.cuda.FloatTensor if xin.is_cuda else torch.FloatTensor
-
-        output = output.view(batchsize, self.n_anchors, n_ch, fsize, fsize)
-        output = output.permute(0, 1, 3, 4, 2)  # .contiguous()
+        output = self.split_anchors(output)
 
         # logistic activation for xy, obj, cls
         output[..., np.r_[:2, 4:n_ch]] = torch.sigmoid(
@@ -80,17 +190,7 @@ class YOLOLayer(nn.Module):
 
         # calculate pred - xywh obj cls
 
-        x_shift = dtype(np.broadcast_to(
-            np.arange(fsize, dtype=np.float32), output.shape[:4]))
-        y_shift = dtype(np.broadcast_to(
-            np.arange(fsize, dtype=np.float32).reshape(fsize, 1), output.shape[:4]))
-
-        masked_anchors = np.array(self.masked_anchors)
-
-        w_anchors = dtype(np.broadcast_to(np.reshape(
-            masked_anchors[:, 0], (1, self.n_anchors, 1, 1)), output.shape[:4]))
-        h_anchors = dtype(np.broadcast_to(np.reshape(
-            masked_anchors[:, 1], (1, self.n_anchors, 1, 1)), output.shape[:4]))
+        x_shift, y_shift, w_anchors, h_anchors = self.get_grids(fsize, fsize, output)
 
         pred = output.clone()
         pred[..., 0] += x_shift
@@ -98,84 +198,7 @@ class YOLOLayer(nn.Module):
         pred[..., 2] = torch.exp(pred[..., 2]) * w_anchors
         pred[..., 3] = torch.exp(pred[..., 3]) * h_anchors
 
-        if labels is None:  # not training
-            pred[..., :4] *= self.stride
-            return pred.view(batchsize, -1, n_ch).data
-
-        pred = pred[..., :4].data
-
-        # target assignment
-
-        tgt_mask = torch.zeros(batchsize, self.n_anchors,
-                               fsize, fsize, 4 + self.n_classes).type(dtype)
-        obj_mask = torch.ones(batchsize, self.n_anchors,
-                              fsize, fsize).type(dtype)
-        tgt_scale = torch.zeros(batchsize, self.n_anchors,
-                                fsize, fsize, 2).type(dtype)
-
-        target = torch.zeros(batchsize, self.n_anchors,
-                             fsize, fsize, n_ch).type(dtype)
-
-        labels = labels.cpu().data
-        nlabel = (labels.sum(dim=2) > 0).sum(dim=1)  # number of objects
-
-        truth_x_all = labels[:, :, 1] * fsize
-        truth_y_all = labels[:, :, 2] * fsize
-        truth_w_all = labels[:, :, 3] * fsize
-        truth_h_all = labels[:, :, 4] * fsize
-        truth_i_all = truth_x_all.to(torch.int16).numpy()
-        truth_j_all = truth_y_all.to(torch.int16).numpy()
-
-        for b in range(batchsize):
-            n = int(nlabel[b])
-            if n == 0:
-                continue
-            truth_box = dtype(np.zeros((n, 4)))
-            truth_box[:n, 2] = truth_w_all[b, :n]
-            truth_box[:n, 3] = truth_h_all[b, :n]
-            truth_i = truth_i_all[b, :n]
-            truth_j = truth_j_all[b, :n]
-
-            # calculate iou between truth and reference anchors
-            anchor_ious_all = bboxes_iou(truth_box.cpu(), self.ref_anchors)
-            best_n_all = np.argmax(anchor_ious_all, axis=1)
-            best_n = best_n_all % 3
-            best_n_mask = ((best_n_all == self.anch_mask[0]) | (
-                best_n_all == self.anch_mask[1]) | (best_n_all == self.anch_mask[2]))
-
-            truth_box[:n, 0] = truth_x_all[b, :n]
-            truth_box[:n, 1] = truth_y_all[b, :n]
-
-            pred_ious = bboxes_iou(
-                pred[b].view(-1, 4), truth_box, xyxy=False)
-            pred_best_iou, _ = pred_ious.max(dim=1)
-            pred_best_iou = (pred_best_iou > self.ignore_thre)
-            pred_best_iou = pred_best_iou.view(pred[b].shape[:3])
-            # set mask to zero (ignore) if pred matches truth
-            obj_mask[b] = 1 - pred_best_iou
-
-            if sum(best_n_mask) == 0:
-                continue
-
-            for ti in range(best_n.shape[0]):
-                if best_n_mask[ti] == 1:
-                    i, j = truth_i[ti], truth_j[ti]
-                    a = best_n[ti]
-                    obj_mask[b, a, j, i] = 1
-                    tgt_mask[b, a, j, i, :] = 1
-                    target[b, a, j, i, 0] = truth_x_all[b, ti] - \
-                        truth_x_all[b, ti].to(torch.int16).to(torch.float)
-                    target[b, a, j, i, 1] = truth_y_all[b, ti] - \
-                        truth_y_all[b, ti].to(torch.int16).to(torch.float)
-                    target[b, a, j, i, 2] = torch.log(
-                        truth_w_all[b, ti] / torch.Tensor(self.masked_anchors)[best_n[ti], 0] + 1e-16)
-                    target[b, a, j, i, 3] = torch.log(
-                        truth_h_all[b, ti] / torch.Tensor(self.masked_anchors)[best_n[ti], 1] + 1e-16)
-                    target[b, a, j, i, 4] = 1
-                    target[b, a, j, i, 5 + labels[b, ti,
-                                                  0].to(torch.int16).numpy()] = 1
-                    tgt_scale[b, a, j, i, :] = torch.sqrt(
-                        2 - truth_w_all[b, ti] * truth_h_all[b, ti] / fsize / fsize)
+        target, tgt_mask, obj_mask, tgt_scale = self.build_targets(pred[..., :4].data, labels)
 
         # loss calculation
 
@@ -198,3 +221,130 @@ class YOLOLayer(nn.Module):
         loss = loss_xy + loss_wh + loss_obj + loss_cls
 
         return loss, loss_xy, loss_wh, loss_obj, loss_cls, loss_l2
+
+    def _apply(self, fn, *args, **kwargs):
+        """ Drops the cached grids when the module is moved or casted """
+        self.grids.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_grids(self, fh, fw, output):
+        """
+        Returns the grid offsets and anchor sizes used to decode the predictions of a
+        feature map of size (fh, fw). They are cached per (fh, fw, device, dtype).
+        Args:
+            fh (int): feature map height
+            fw (int): feature map width
+            output (torch.Tensor): tensor whose device and dtype are used
+        Returns:
+            x_shift (torch.Tensor): x offsets whose size is :math:`(1, 1, 1, W)`
+            y_shift (torch.Tensor): y offsets whose size is :math:`(1, 1, H, 1)`
+            w_anchors (torch.Tensor): anchor widths whose size is :math:`(1, A, 1, 1)`
+            h_anchors (torch.Tensor): anchor heights whose size is :math:`(1, A, 1, 1)`
+        """
+        key = (fh, fw, output.device, output.dtype)
+
+        if key in self.grids:
+            self.grids.move_to_end(key)
+            return self.grids[key]
+
+        anchors = self.masked_anchors_wh.to(output)
+        grids = (
+            torch.arange(fw, device=output.device, dtype=output.dtype).view(1, 1, 1, fw),
+            torch.arange(fh, device=output.device, dtype=output.dtype).view(1, 1, fh, 1),
+            anchors[:, 0].view(1, self.n_anchors, 1, 1),
+            anchors[:, 1].view(1, self.n_anchors, 1, 1),
+        )
+        self.grids[key] = grids
+
+        if len(self.grids) > self.GRID_CACHE_SIZE:
+            self.grids.popitem(last=False)
+
+        return grids
+
+    def build_targets(self, pred, labels):
+        """
+        Target assignment for all the images and labels at once. Everything is computed
+        on the device of pred.
+        Args:
+            pred (torch.Tensor): predicted boxes whose size is :math:`(N, A, F, F, 4)`. \
+                N, A and F denote batchsize, number of anchors and feature map size.
+                Each box consists of [xc, yc, w, h] in grid units.
+            labels (torch.Tensor): label data whose size is :math:`(N, K, 5)`. \
+                See forward method for details.
+        Returns:
+            target (torch.Tensor): target values whose size is :math:`(N, A, F, F, 5 + n_classes)`.
+            tgt_mask (torch.Tensor): mask of the assigned cells for the xywh and class \
+                losses whose size is :math:`(N, A, F, F, 4 + n_classes)`.
+            obj_mask (torch.Tensor): objectness loss mask whose size is :math:`(N, A, F, F)`.
+            tgt_scale (torch.Tensor): boxsize-dependent weights of the xywh losses \
+                whose size is :math:`(N, A, F, F, 2)`.
+        """
+        batchsize, fsize = pred.shape[0], pred.shape[2]
+        n_ch = 5 + self.n_classes
+
+        tgt_mask = pred.new_zeros(batchsize, self.n_anchors, fsize, fsize, 4 + self.n_classes)
+        obj_mask = pred.new_ones(batchsize, self.n_anchors, fsize, fsize)
+        tgt_scale = pred.new_zeros(batchsize, self.n_anchors, fsize, fsize, 2)
+        target = pred.new_zeros(batchsize, self.n_anchors, fsize, fsize, n_ch)
+
+        labels = labels.detach().to(pred)
+        nlabel = (labels.sum(dim=2) > 0).sum(dim=1)  # number of objects
+        max_nlabel = int(nlabel.max())
+
+        if max_nlabel == 0:
+            return target, tgt_mask, obj_mask, tgt_scale
+
+        # only the first nlabel labels of each image are taken into account
+        labels = labels[:, :max_nlabel]
+        valid = torch.arange(max_nlabel, device=pred.device)[None, :] < nlabel[:, None]
+        truth = labels[..., 1:] * fsize  # [xc, yc, w, h] in grid units
+        truth_ij = truth[..., :2].to(torch.int16).long()
+
+        # calculate iou between truth and reference anchors
+        truth_box = torch.zeros_like(truth)
+        truth_box[..., 2:] = truth[..., 2:]
+        anchor_ious_all = bboxes_iou(truth_box, self.ref_anchors.to(pred))
+        best_n_all = anchor_ious_all.argmax(dim=2)
+        best_n = self.anch_positions[best_n_all]
+        best_n_mask = valid & (best_n >= 0)
+
+        # set mask to zero (ignore) if pred matches truth. The predictions are processed
+        # in chunks to keep the pairwise IoU working set small
+        pred_best_iou = []
+        for pred_chunk in pred.reshape(batchsize, -1, 4).split(self.IOU_CHUNK_SIZE, dim=1):
+            pred_ious = bboxes_iou(pred_chunk, truth, xyxy=False)
+            pred_ious.masked_fill_(~valid[:, None, :], 0)
+            pred_best_iou.append(pred_ious.max(dim=2)[0] > self.ignore_thre)
+        obj_mask[torch.cat(pred_best_iou, dim=1).view(obj_mask.shape)] = 0
+
+        b, t = best_n_mask.nonzero(as_tuple=True)
+
+        if b.numel() == 0:
+            return target, tgt_mask, obj_mask, tgt_scale
+
+        a = best_n[b, t]
+        i, j = truth_ij[b, t, 0], truth_ij[b, t, 1]
+
+        # class targets are only ever set to one, so they are written for every label
+        target[b, a, j, i, 5 + labels[b, t, 0].to(torch.int16).long()] = 1
+
+        # when several labels fall into the same cell and anchor the last one is kept
+        cell = ((b * self.n_anchors + a) * fsize + j) * fsize + i
+        cell, order = torch.sort(cell, stable=True)
+        last = torch.ones_like(cell, dtype=torch.bool)
+        last[:-1] = cell[1:] != cell[:-1]
+        keep = order[last]
+        b, t, a, i, j = b[keep], t[keep], a[keep], i[keep], j[keep]
+
+        masked_anchors = self.masked_anchors_wh.to(pred)
+        truth = truth[b, t]
+
+        obj_mask[b, a, j, i] = 1
+        tgt_mask[b, a, j, i] = 1
+        target[b, a, j, i, :2] = truth[:, :2] - truth_ij[b, t].to(truth)
+        target[b, a, j, i, 2:4] = torch.log(truth[:, 2:] / masked_anchors[a] + 1e-16)
+        target[b, a, j, i, 4] = 1
+        tgt_scale[b, a, j, i] = torch.sqrt(
+            2 - truth[:, 2] * truth[:, 3] / fsize / fsize)[:, None]
+
+        return target, tgt_mask, obj_mask, tgt_scale
@@ -1,8 +1,12 @@
+import math
+
 import torch
 import torch.nn as nn
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from core.exceptions import ModelTypeInvalid
 from models.yolo_layer import YOLOLayer
+from utils.utils import SparsePredictions, cat_sparse_predictions
 
 def add_conv(in_ch, out_ch, ksize, stride):
     """
@@ -25,6 +29,25 @@ def add_conv(in_ch, out_ch, ksize, stride):
     return stage
 
 
+def fuse_conv_bn(conv, bn):
+    """
+    Folds a batchnorm layer (using its running statistics) into the weights and bias
+    of the preceding convolution layer. Only valid for inference.
+    Args:
+        conv (Conv2d): convolution layer, modified in-place.
+        bn (BatchNorm2d): batchnorm layer applied to the output of conv.
+    Returns:
+        conv (Conv2d): convolution layer equivalent to conv followed by bn.
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+    return conv
+
+
 class resblock(nn.Module):
     """
     Sequential residual blocks each of which consists of \
@@ -54,80 +77,253 @@ class resblock(nn.Module):
         return x
 
 
+def get_channels(ch, config_model):
+    """
+    Returns the number of channels ch scaled by the WIDTH_MULTIPLE of the model
+    configuration (1 by default) and rounded up to a multiple of 8
+    """
+    return max(8, int(math.ceil(ch * config_model.get('WIDTH_MULTIPLE', 1.) / 8)) * 8)
+
+
+def get_nblocks(nblocks, config_model):
+    """
+    Returns the number of residual blocks scaled by the DEPTH_MULTIPLE of the model
+    configuration (1 by default), at least one
+    """
+    return max(1, int(round(nblocks * config_model.get('DEPTH_MULTIPLE', 1.))))
+
+
 def create_yolov3_modules(config_model, ignore_thre):
     """
     Build yolov3 layer modules.
     Args:
         config_model (dict): model configuration.
-            See YOLOLayer class for details.
+            See YOLOLayer class for details. The optional WIDTH_MULTIPLE and
+            DEPTH_MULTIPLE scale the channels and residual blocks of the layers.
         ignore_thre (float): used in YOLOLayer.
     Returns:
         mlist (ModuleList): YOLOv3 module list.
     """
+    c32, c64, c128, c256, c512, c1024 = (
+        get_channels(ch, config_model) for ch in (32, 64, 128, 256, 512, 1024))
+    n1, n2, n4, n8 = (get_nblocks(nblocks, config_model) for nblocks in (1, 2, 4, 8))
 
     # DarkNet53
     mlist = nn.ModuleList()
-    mlist.append(add_conv(in_ch=3, out_ch=32, ksize=3, stride=1))
-    mlist.append(add_conv(in_ch=32, out_ch=64, ksize=3, stride=2))
-    mlist.append(resblock(ch=64))
-    mlist.append(add_conv(in_ch=64, out_ch=128, ksize=3, stride=2))
-    mlist.append(resblock(ch=128, nblocks=2))
-    mlist.append(add_conv(in_ch=128, out_ch=256, ksize=3, stride=2))
-    mlist.append(resblock(ch=256, nblocks=8))    # shortcut 1 from here
-    mlist.append(add_conv(in_ch=256, out_ch=512, ksize=3, stride=2))
-    mlist.append(resblock(ch=512, nblocks=8))    # shortcut 2 from here
-    mlist.append(add_conv(in_ch=512, out_ch=1024, ksize=3, stride=2))
-    mlist.append(resblock(ch=1024, nblocks=4))
+    mlist.append(add_conv(in_ch=3, out_ch=c32, ksize=3, stride=1))
+    mlist.append(add_conv(in_ch=c32, out_ch=c64, ksize=3, stride=2))
+    mlist.append(resblock(ch=c64, nblocks=n1))
+    mlist.append(add_conv(in_ch=c64, out_ch=c128, ksize=3, stride=2))
+    mlist.append(resblock(ch=c128, nblocks=n2))
+    mlist.append(add_conv(in_ch=c128, out_ch=c256, ksize=3, stride=2))
+    mlist.append(resblock(ch=c256, nblocks=n8))    # shortcut 1 from here
+    mlist.append(add_conv(in_ch=c256, out_ch=c512, ksize=3, stride=2))
+    mlist.append(resblock(ch=c512, nblocks=n8))    # shortcut 2 from here
+    mlist.append(add_conv(in_ch=c512, out_ch=c1024, ksize=3, stride=2))
+    mlist.append(resblock(ch=c1024, nblocks=n4))
 
     # YOLOv3
-    mlist.append(resblock(ch=1024, nblocks=2, shortcut=False))
-    mlist.append(add_conv(in_ch=1024, out_ch=512, ksize=1, stride=1))
+    mlist.append(resblock(ch=c1024, nblocks=n2, shortcut=False))
+    mlist.append(add_conv(in_ch=c1024, out_ch=c512, ksize=1, stride=1))
     # 1st yolo branch
-    mlist.append(add_conv(in_ch=512, out_ch=1024, ksize=3, stride=1))
+    mlist.append(add_conv(in_ch=c512, out_ch=c1024, ksize=3, stride=1))
     mlist.append(
-         YOLOLayer(config_model, layer_no=0, in_ch=1024, ignore_thre=ignore_thre))
+         YOLOLayer(config_model, layer_no=0, in_ch=c1024, ignore_thre=ignore_thre))
 
-    mlist.append(add_conv(in_ch=512, out_ch=256, ksize=1, stride=1))
+    mlist.append(add_conv(in_ch=c512, out_ch=c256, ksize=1, stride=1))
     mlist.append(nn.Upsample(scale_factor=2, mode='nearest'))
-    mlist.append(add_conv(in_ch=768, out_ch=256, ksize=1, stride=1))
-    mlist.append(add_conv(in_ch=256, out_ch=512, ksize=3, stride=1))
-    mlist.append(resblock(ch=512, nblocks=1, shortcut=False))
-    mlist.append(add_conv(in_ch=512, out_ch=256, ksize=1, stride=1))
+    mlist.append(add_conv(in_ch=c256 + c512, out_ch=c256, ksize=1, stride=1))
+    mlist.append(add_conv(in_ch=c256, out_ch=c512, ksize=3, stride=1))
+    mlist.append(resblock(ch=c512, nblocks=n1, shortcut=False))
+    mlist.append(add_conv(in_ch=c512, out_ch=c256, ksize=1, stride=1))
     # 2nd yolo branch
-    mlist.append(add_conv(in_ch=256, out_ch=512, ksize=3, stride=1))
+    mlist.append(add_conv(in_ch=c256, out_ch=c512, ksize=3, stride=1))
+    mlist.append(
+        YOLOLayer(config_model, layer_no=1, in_ch=c512, ignore_thre=ignore_thre))
+
+    mlist.append(add_conv(in_ch=c256, out_ch=c128, ksize=1, stride=1))
+    mlist.append(nn.Upsample(scale_factor=2, mode='nearest'))
+    mlist.append(add_conv(in_ch=c128 + c256, out_ch=c128, ksize=1, stride=1))
+    mlist.append(add_conv(in_ch=c128, out_ch=c256, ksize=3, stride=1))
+    mlist.append(resblock(ch=c256, nblocks=n2, shortcut=False))
     mlist.append(
-        YOLOLayer(config_model, layer_no=1, in_ch=512, ignore_thre=ignore_thre))
+         YOLOLayer(config_model, layer_no=2, in_ch=c256, ignore_thre=ignore_thre))
 
-    mlist.append(add_conv(in_ch=256, out_ch=128, ksize=1, stride=1))
+    return mlist
+
+
+def create_yolov3_tiny_modules(config_model, ignore_thre):
+    """
+    Build the layer modules of a tiny YOLOv3 with two YOLO layers (strides 32 and 16)
+    and a single residual block per stage. Only the first two groups of ANCH_MASK
+    are used.
+    Args:
+        config_model (dict): model configuration.
+            See create_yolov3_modules for details.
+        ignore_thre (float): used in YOLOLayer.
+    Returns:
+        mlist (ModuleList): tiny YOLOv3 module list.
+    """
+    c16, c32, c64, c128, c256, c512 = (
+        get_channels(ch, config_model) for ch in (16, 32, 64, 128, 256, 512))
+    n1 = get_nblocks(1, config_model)
+
+    mlist = nn.ModuleList()
+    mlist.append(add_conv(in_ch=3, out_ch=c16, ksize=3, stride=1))
+    mlist.append(add_conv(in_ch=c16, out_ch=c32, ksize=3, stride=2))
+    mlist.append(add_conv(in_ch=c32, out_ch=c64, ksize=3, stride=2))
+    mlist.append(resblock(ch=c64, nblocks=n1))
+    mlist.append(add_conv(in_ch=c64, out_ch=c128, ksize=3, stride=2))
+    mlist.append(resblock(ch=c128, nblocks=n1))
+    mlist.append(add_conv(in_ch=c128, out_ch=c256, ksize=3, stride=2))
+    mlist.append(resblock(ch=c256, nblocks=n1))    # shortcut from here
+    mlist.append(add_conv(in_ch=c256, out_ch=c512, ksize=3, stride=2))
+    mlist.append(resblock(ch=c512, nblocks=n1))
+    mlist.append(add_conv(in_ch=c512, out_ch=c256, ksize=1, stride=1))
+    # 1st yolo branch
+    mlist.append(add_conv(in_ch=c256, out_ch=c512, ksize=3, stride=1))
+    mlist.append(
+        YOLOLayer(config_model, layer_no=0, in_ch=c512, ignore_thre=ignore_thre))
+
+    mlist.append(add_conv(in_ch=c256, out_ch=c128, ksize=1, stride=1))
     mlist.append(nn.Upsample(scale_factor=2, mode='nearest'))
-    mlist.append(add_conv(in_ch=384, out_ch=128, ksize=1, stride=1))
-    mlist.append(add_conv(in_ch=128, out_ch=256, ksize=3, stride=1))
-    mlist.append(resblock(ch=256, nblocks=2, shortcut=False))
+    # 2nd yolo branch
+    mlist.append(add_conv(in_ch=c128 + c256, out_ch=c256, ksize=3, stride=1))
     mlist.append(
-         YOLOLayer(config_model, layer_no=2, in_ch=256, ignore_thre=ignore_thre))
+        YOLOLayer(config_model, layer_no=1, in_ch=c256, ignore_thre=ignore_thre))
 
     return mlist
 
 
+# create_modules builds the module list, yolo_layers holds the module indexes of the
+# YOLO layers (heads) and route_inputs the indexes of the modules whose outputs are
+# concatenated as the input of the modules not fed (only) by the previous one
+ModelItem = namedtuple('ModelItem', ['name', 'create_modules', 'yolo_layers', 'route_inputs'])
+
+MODELS = [
+    ModelItem('YOLOv3', create_yolov3_modules, (14, 22, 28),
+              {15: (12,), 17: (16, 8), 23: (20,), 25: (24, 6)}),
+    ModelItem('YOLOv3-tiny', create_yolov3_tiny_modules, (12, 16),
+              {13: (10,), 15: (14, 7)}),
+]
+
+
+def print_model_choices():
+    """ Returns the available model types """
+    return ', '.join(model.name for model in MODELS)
+
+
+def get_model_item(name):
+    """ Returns the ModelItem corresponding to the model type provided """
+    models = tuple(filter(lambda x: x.name == name, MODELS))
+
+    if not models:
+        raise ModelTypeInvalid()
+
+    return models[0]
+
+
 class YOLOv3(nn.Module):
     """
-    YOLOv3 model module. The module list is defined by create_yolov3_modules function. \
-    The network returns loss values from three YOLO layers during training \
-    and detection results during test.
+    YOLOv3 model module. The module list is defined by the create_modules function of \
+    the model type (see MODELS). The network returns loss values from the YOLO layers \
+    during training and detection results during test.
     """
     def __init__(self, config_model, ignore_thre=0.7):
         """
         Initialization of YOLOv3 class.
         Args:
-            config_model (dict): used in YOLOLayer.
+            config_model (dict): used in YOLOLayer. TYPE is one of the MODELS.
             ignore_thre (float): used in YOLOLayer.
         """
         super(YOLOv3, self).__init__()
 
-        if config_model['TYPE'] == 'YOLOv3':
-            self.module_list = create_yolov3_modules(config_model, ignore_thre)
-        else:
-            raise Exception('Model name {} is not available'.format(config_model['TYPE']))
+        model_item = get_model_item(config_model['TYPE'])
+        self.module_list = model_item.create_modules(config_model, ignore_thre)
+        # module indexes of the YOLO layers (heads) and inputs of the route layers
+        self.yolo_layers = model_item.yolo_layers
+        self.route_inputs = model_item.route_inputs
+
+        self.fused = False
+        self.select_heads()
+
+    def fuse(self):
+        """
+        Folds every batchnorm layer into its convolution layer (see fuse_conv_bn) and
+        replaces it by an identity, so each conv / batchnorm / leaky ReLU block runs as
+        a convolution followed by the activation. The model is set in evaluation mode
+        and must only be used for inference afterwards; therefore, the checkpoints
+        must be loaded before calling this method.
+        Returns:
+            self (YOLOv3): the fused model.
+        """
+        self.eval()
+
+        if self.fused:
+            return self
+
+        for module in self.modules():
+            if isinstance(module, nn.Sequential) and hasattr(module, 'batch_norm'):
+                fuse_conv_bn(module.conv, module.batch_norm)
+                module.batch_norm = nn.Identity()
+
+        self.fused = True
+
+        return self
+
+    def select_heads(self, heads=None):
+        """
+        Selects the YOLO layers (heads) evaluated during inference. The modules only
+        feeding the other heads are skipped, so their FLOPs are saved; their weights
+        are kept, so the checkpoints are loaded as usual. Training always uses all
+        the heads.
+        Args:
+            heads (list): heads to evaluate, 0 (stride 32), 1 (stride 16) and/or
+                2 (stride 8, not available in YOLOv3-tiny). All of them if None
+        Returns:
+            self (YOLOv3): the model.
+        """
+        heads = range(len(self.yolo_layers)) if heads is None else heads
+
+        if not heads or not set(heads).issubset(range(len(self.yolo_layers))):
+            raise Exception('Invalid YOLO heads {}'.format(heads))
+
+        self.heads = sorted(heads)
+        self.active_modules = set()
+        pending = [self.yolo_layers[head] for head in self.heads]
+
+        while pending:
+            idx = pending.pop()
+
+            if idx >= 0 and idx not in self.active_modules:
+                self.active_modules.add(idx)
+                pending.extend(self.route_inputs.get(idx, (idx - 1,)))
+
+        return self
+
+    def set_sparse_decoding(self, conf_thre=None):
+        """
+        Enables (or disables if conf_thre is None) the sparse decoding of the YOLO
+        layers (see YOLOLayer.decode_sparse). When enabled, the inference output is a
+        SparsePredictions with the cells whose objectness is at least conf_thre;
+        postprocess accepts it and, using the same threshold, returns the same detections
+        Args:
+            conf_thre (float): confidence threshold used by postprocess
+        Returns:
+            self (YOLOv3): the model.
+        """
+        for module in self.modules():
+            if isinstance(module, YOLOLayer):
+                module.sparse_conf_thre = conf_thre
+
+        return self
+
+    def train(self, mode=True):
+        """ Sets the module in training mode. Not allowed for fused models """
+        if mode and self.fused:
+            raise Exception('Fused models can only be used for inference')
+
+        return super(YOLOv3, self).train(mode)
 
     def forward(self, x, targets=None):
         """
@@ -141,15 +337,26 @@ class YOLOv3(nn.Module):
             training:
                 output (torch.Tensor): loss tensor for backpropagation.
             test:
-                output (torch.Tensor): concatenated detection results.
+                output (torch.Tensor): concatenated detection results of the selected
+                    heads (SparsePredictions if the sparse decoding is enabled).
         """
         train = targets is not None
         output = []
         self.loss_dict = defaultdict(float)
-        route_layers = []
+        route_sources = set(idx for inputs in self.route_inputs.values() for idx in inputs)
+        route_layers = {}
         for i, module in enumerate(self.module_list):
+            # modules only feeding the heads not selected are skipped (see select_heads)
+            if not train and i not in self.active_modules:
+                continue
+
+            # route layers
+            if i in self.route_inputs:
+                inputs = [route_layers[idx] for idx in self.route_inputs[i]]
+                x = inputs[0] if len(inputs) == 1 else torch.cat(inputs, 1)
+
             # yolo layers
-            if i in [14, 22, 28]:
+            if i in self.yolo_layers:
                 if train:
                     x, *loss_dict = module(x, targets)
                     for name, loss in zip(['xy', 'wh', 'conf', 'cls', 'l2'] , loss_dict):
@@ -160,19 +367,12 @@ class YOLOv3(nn.Module):
             else:
                 x = module(x)
 
-            # route layers
-            if i in [6, 8, 12, 20]:
-                route_layers.append(x)
-            if i == 14:
-                x = route_layers[2]
-            if i == 22:  # yolo 2nd
-                x = route_layers[3]
-            if i == 16:
-                x = torch.cat((x, route_layers[1]), 1)
-            if i == 24:
-                x = torch.cat((x, route_layers[0]), 1)
+            if i in route_sources:
+                route_layers[i] = x
         if train:
             return sum(output)
+        elif isinstance(output[0], SparsePredictions):
+            return cat_sparse_predictions(output)
         else:
             return torch.cat(output, 1)
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+""" quantize """
+
+import argparse
+import copy
+import time
+import yaml
+
+import torch
+
+from datasets.datasets import SignetRing
+from models.quantization import get_model_size, quantize_model, save_quantized_checkpoint
+from models.yolov3 import YOLOv3
+import settings
+from utils.evaluators.evaluators import SignetRingEvaluator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='config/yolov3_eval_digestpath.cfg',
+                        help='config file. see readme')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='pytorch checkpoint file path')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path of the quantized checkpoint')
+    parser.add_argument('--calibration_images', type=int, default=64,
+                        help='number of SignetRing training tiles used for calibration')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='calibration batch size')
+    parser.add_argument('--backend', type=str, default='fbgemm',
+                        help='quantized engine: fbgemm (x86) or qnnpack (ARM)')
+    parser.add_argument('--report', action='store_true',
+                        help='prints latency, model size and AP30 of both models')
+    return parser.parse_args()
+
+
+def get_latency(model, imgsize, batch_size=1, repeats=10):
+    """ Returns the mean seconds per forward pass of the model on CPU """
+    imgs = torch.rand(batch_size, 3, imgsize, imgsize)
+
+    with torch.no_grad():
+        model(imgs)
+        start = time.time()
+        for _ in range(repeats):
+            model(imgs)
+
+    return (time.time() - start) / repeats
+
+
+def main():
+    """
+    Post-training static INT8 quantization of a YOLOv3 checkpoint calibrated on a
+    sample of the SignetRing training tiles (see models.quantization)
+    """
+    args = parse_args()
+    print("Setting Arguments.. : ", args)
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f)
+
+    imgsize = cfg['TEST']['IMGSIZE']
+    model = YOLOv3(cfg['MODEL'])
+    state = torch.load(args.checkpoint, map_location='cpu')
+    if 'model_state_dict' in state.keys():
+        model.load_state_dict(state['model_state_dict'])
+    else:
+        model.load_state_dict(state)
+    model.eval()
+
+    augmentation = {'LRFLIP': False, 'JITTER': 0, 'RANDOM_PLACING': False,
+                    'HUE': 0, 'SATURATION': 0, 'EXPOSURE': 0, 'RANDOM_DISTORT': False}
+    dataset = SignetRing(model_type=cfg['MODEL']['TYPE'], train_path=settings.SIGNET_TRAIN_PATH,
+                         img_size=imgsize, augmentation=augmentation, uint8=True)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
+
+    float_model = copy.deepcopy(model).fuse() if args.report else None
+
+    print("calibrating with {} images...".format(args.calibration_images))
+    quantized_model = quantize_model(
+        model, dataloader, -(-args.calibration_images // args.batch_size), args.backend)
+    save_quantized_checkpoint(quantized_model, args.output, args.backend)
+    print("quantized checkpoint saved on {}".format(args.output))
+
+    if args.report:
+        evaluator = SignetRingEvaluator(model_type=cfg['MODEL']['TYPE'], img_size=imgsize,
+                                        confthre=cfg['TEST']['CONFTHRE'],
+                                        nmsthre=cfg['TEST']['NMSTHRE'],
+                                        rect=cfg['TEST'].get('RECT', False))
+        results = []
+
+        for net in (float_model, quantized_model):
+            ap30, _ = evaluator.evaluate(net)
+            results.append((get_latency(net, imgsize), get_model_size(net), ap30))
+
+        print('model | latency (ms) | size (MB) |  AP30')
+        for name, (latency, size, ap30) in zip(('fp32', 'int8'), results):
+            print('{:>5} | {:>12.2f} | {:>9.2f} | {:.4f}'.format(
+                name, latency * 1000, size / 1024**2, ap30))
+        print('AP30 delta: {:+.4f}'.format(results[1][2] - results[0][2]))
+
+
+if __name__ == '__main__':
+    main()
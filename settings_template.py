@@ -23,6 +23,11 @@ SIGNET_TRAIN_PATH = os.path.join(PICKLE_FILES_PATH, 'train.pickle')
 # serialized list
 SIGNET_TEST_PATH = os.path.join(PICKLE_FILES_PATH, 'test.pickle')
 
+# memory-mapped shards of the training set (see utils.data.create_signet_shards) and
+# maximum size of each shard in bytes
+SIGNET_TRAIN_SHARDS_PATH = os.path.join('data', 'shards', 'train')
+SIGNET_SHARD_SIZE = 1024**3
+
 ###############################################################################
 #                                   Evaluation
 ###############################################################################
@@ -49,3 +54,11 @@ EVAL_LINEAR_SPACE_STEP = 0.05  # spacing between samples
 
 TENSORBOARD_SIGNET_LOG_PATH = 'tensorboard_logs/signet_logs'
 TENSORBOARD_COCO_LOG_PATH = 'tensorboard_logs/coco_logs'
+
+###############################################################################
+#                                   Training
+###############################################################################
+
+# Maximum number of bytes of decoded SignetRing images kept in shared memory for all
+# the DataLoader workers (LRU cache, see datasets.caches.SharedImageCache). 0 disables it
+SIGNET_DECODED_IMAGES_CACHE_SIZE = 0
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+""" tests/test_backends """
+
+import unittest
+
+import torch
+
+from models.backends import ONNXRuntimeBackend, TorchScriptBackend
+from tests.test_yolov3 import create_model
+
+
+class ExportedBackendsTestCase(unittest.TestCase):
+    """ Outputs of the exported graphs compared against the eager model """
+
+    IMGSIZE = 64
+
+    def setUp(self):
+        self.model = create_model().fuse()
+        self.imgs = torch.rand(2, 3, self.IMGSIZE, self.IMGSIZE)
+
+        with torch.no_grad():
+            self.expected = self.model(self.imgs)
+
+    def check_backend(self, backend):
+        self.assertTrue(torch.allclose(backend(self.imgs), self.expected, rtol=1e-4, atol=1e-4))
+
+        with self.assertRaises(ValueError):
+            backend(torch.rand(1, 3, self.IMGSIZE, self.IMGSIZE + 32))
+
+    def test_torchscript(self):
+        self.check_backend(TorchScriptBackend(self.model, self.IMGSIZE))
+
+    def test_onnxruntime(self):
+        try:
+            backend = ONNXRuntimeBackend(self.model, self.IMGSIZE)
+        except ImportError as error:
+            self.skipTest(str(error))
+
+        self.check_backend(backend)
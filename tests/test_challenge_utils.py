@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+""" tests/test_challenge_utils """
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from challenge import settings
+from challenge.utils import Tile, evaluate_tiles, get_chunk_origins
+
+
+@mock.patch.object(settings, 'BOARDCACHE', 2)
+class EvaluateTilesTestCase(unittest.TestCase):
+    """ Hand-computed post-processing of 512x512 tiles of a 2048x2048 slide """
+
+    def setUp(self):
+        self.tiles = [
+            Tile('', 512, 512, 2048, 2048, None, False),  # inner tile
+            Tile('', 0, 0, 2048, 2048, None, False),      # touching the slide borders
+            Tile('', 1536, 1024, 2048, 2048, None, True),
+        ]
+        self.results = [
+            np.array([[1, 10, 20, 30, .9], [10, 10, 20, 30, .8]], dtype=np.float32),
+            np.array([[1, 10, 20, 30, .9]], dtype=np.float32),
+            np.zeros((0, 5), dtype=np.float32),
+        ]
+
+    def test_evaluate_tiles(self):
+        output = evaluate_tiles(self.tiles, self.results, 512)
+
+        self.assertEqual(len(output), 3)
+        # the first box of the inner tile is closer than BOARDCACHE to its left border
+        np.testing.assert_allclose(output[0], [[522, 522, 532, 542, .8]])
+        np.testing.assert_allclose(output[1], [[1, 10, 20, 30, .9]])
+        self.assertEqual(output[2].shape, (0, 5))
+
+
+class GetChunkOriginsTestCase(unittest.TestCase):
+    """ Chunks of 1024 pixels overlapping 256 pixels """
+
+    def test_single_chunk(self):
+        self.assertEqual(get_chunk_origins(900, 1024, 1024, 256), (1024, [(0, 0)]))
+        self.assertEqual(get_chunk_origins(3000, 900, None, 256), (3000, [(0, 0)]))
+
+    def test_chunks(self):
+        self.assertEqual(get_chunk_origins(2000, 1500, 1024, 256), (1024, [
+            (0, 0), (768, 0), (976, 0), (0, 476), (768, 476), (976, 476)]))
+
+    def test_axes_chunked_on_their_own(self):
+        # the chunks are only 900 pixels high
+        self.assertEqual(get_chunk_origins(3000, 900, 1024, 256), (1024, [
+            (0, 0), (768, 0), (1536, 0), (1976, 0)]))
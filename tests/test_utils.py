@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+""" tests/test_utils """
+
+import unittest
+
+import numpy as np
+import torch
+
+from utils.utils import SparsePredictions, batched_nms, nms, postprocess, preprocess, \
+    stack_letterboxes
+
+
+class NMSTestCase(unittest.TestCase):
+    """ Hand-computed non maximum suppression with an IoU threshold of .3 """
+
+    def setUp(self):
+        self.bbox = np.array([
+            [0, 0, 10, 10],      # 0: kept (.9)
+            [5, 0, 15, 10],      # 1: suppressed by 0 (IoU .33)
+            [10, 0, 20, 10],     # 2: kept (.7), only overlaps the suppressed box 1
+            [0, 1, 10, 11],      # 3: suppressed by 0 (IoU .82)
+            [100, 100, 110, 110],  # 4: kept (.95)
+        ], dtype=np.float32)
+        self.score = np.array([.9, .8, .7, .6, .95], dtype=np.float32)
+
+    def test_nms(self):
+        # the block boundaries do not change the selection
+        for block_size in (1, 2, 256):
+            np.testing.assert_array_equal(
+                nms(self.bbox, .3, self.score, block_size=block_size), [4, 0, 2])
+
+    def test_nms_limit(self):
+        np.testing.assert_array_equal(nms(self.bbox, .3, self.score, limit=2, block_size=1), [4, 0])
+
+    def test_nms_without_boxes(self):
+        self.assertEqual(len(nms(np.zeros((0, 4)), .3)), 0)
+
+    def test_batched_nms(self):
+        # boxes 1 and 2 belong to another group, so 1 is kept and suppresses 2
+        idxs = torch.tensor([0, 1, 1, 0, 0])
+        for block_size in (1, 2, 256):
+            self.assertEqual(batched_nms(
+                torch.from_numpy(self.bbox), torch.from_numpy(self.score), idxs, .3,
+                block_size=block_size).tolist(), [4, 0, 1])
+
+
+class PostprocessTestCase(unittest.TestCase):
+    """ Hand-computed postprocess of two images with two classes """
+
+    def setUp(self):
+        # [xc, yc, w, h, obj_conf, class 0 conf, class 1 conf]
+        self.prediction = torch.tensor([
+            [[10, 10, 4, 4, .9, .1, .9],     # kept (score .81)
+             [10.5, 10, 4, 4, .8, .2, .8],   # suppressed by the first box (IoU .78)
+             [10, 10, 4, 4, .7, .95, .05],   # kept, other class (score .665)
+             [30, 30, 4, 4, .3, .5, .5]],    # below the confidence threshold
+            [[10, 10, 4, 4, .2, .1, .9],
+             [20, 20, 4, 4, .1, .9, .1],
+             [30, 30, 4, 4, .9, .1, .1],
+             [40, 40, 4, 4, .0, .5, .5]],
+        ])
+        self.expected = torch.tensor([
+            [8, 8, 12, 12, .7, .95, 0],
+            [8, 8, 12, 12, .9, .9, 1],
+        ])
+
+    def check_output(self, output):
+        self.assertEqual(len(output), 2)
+        self.assertTrue(torch.allclose(output[0], self.expected))
+        self.assertIsNone(output[1])
+
+    def test_dense_predictions(self):
+        self.check_output(postprocess(self.prediction, 2, conf_thre=.5, nms_thre=.45))
+
+    def test_sparse_predictions(self):
+        prediction = SparsePredictions(
+            self.prediction.reshape(-1, 7), torch.arange(2).repeat_interleave(4), 2)
+        self.check_output(postprocess(prediction, 2, conf_thre=.5, nms_thre=.45))
+
+
+class StackLetterboxesTestCase(unittest.TestCase):
+    """ Rectangular letterboxes (see preprocess) of different shapes """
+
+    def test_stack_letterboxes(self):
+        wide, _ = preprocess(np.zeros((100, 400, 3), dtype=np.uint8), 128, jitter=0, rect=True)
+        tall, _ = preprocess(np.zeros((400, 100, 3), dtype=np.uint8), 128, jitter=0, rect=True)
+        self.assertEqual((wide.shape, tall.shape), ((32, 128, 3), (128, 32, 3)))
+
+        imgs = stack_letterboxes([wide, tall])
+
+        self.assertEqual(imgs.shape, (2, 128, 128, 3))
+        np.testing.assert_array_equal(imgs[0, :32], wide)
+        self.assertTrue((imgs[0, 32:] == 127).all())
+        np.testing.assert_array_equal(imgs[1, :, :32], tall)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+""" tests/test_yolo_layer """
+
+import math
+import unittest
+
+import torch
+
+from models.yolo_layer import YOLOLayer
+
+
+# anchors in pixels; the ones of the first YOLO layer (stride 32) are (3, 3), (4, 3) and
+# (3, 4) in grid units
+CONFIG_MODEL = dict(
+    ANCHORS=[[32, 32], [64, 32], [32, 64], [64, 64], [96, 64],
+             [64, 96], [96, 96], [128, 96], [96, 128]],
+    ANCH_MASK=[[6, 7, 8], [3, 4, 5], [0, 1, 2]],
+    N_CLASSES=2,
+)
+
+
+class BuildTargetsTestCase(unittest.TestCase):
+    """ Hand-computed target assignment of a 4x4 grid (128x128 input, stride 32) """
+
+    def setUp(self):
+        self.layer = YOLOLayer(CONFIG_MODEL, layer_no=0, in_ch=1)
+        self.pred = torch.zeros(1, 3, 4, 4, 4)
+        self.labels = torch.zeros(1, 50, 5)
+        # 4x3 grid units box centered at (2.4, 1.2): cell i=2, j=1 and anchor 7 (position 1)
+        self.labels[0, 0] = torch.tensor([1, .6, .3, 1., .75])
+        # 1x1 grid units box: its best anchor (0) belongs to another YOLO layer
+        self.labels[0, 1] = torch.tensor([0, .1, .1, .25, .25])
+
+    def test_assigned_label(self):
+        target, tgt_mask, obj_mask, tgt_scale = self.layer.build_targets(self.pred, self.labels)
+
+        expected = torch.tensor([.4, .2, 0, 0, 1, 0, 1])
+        self.assertTrue(torch.allclose(target[0, 1, 1, 2], expected, atol=1e-5))
+        self.assertTrue(torch.allclose(tgt_scale[0, 1, 1, 2], torch.full((2,), math.sqrt(1.25))))
+        self.assertTrue(bool(tgt_mask[0, 1, 1, 2].all()))
+        # nothing else is assigned, the second label included
+        self.assertEqual(int(tgt_mask.sum()), 6)
+        self.assertEqual(int((target != 0).sum()), 4)
+        self.assertEqual(int((tgt_scale != 0).sum()), 2)
+        self.assertTrue(bool(obj_mask.all()))
+
+    def test_ignored_prediction(self):
+        # prediction of another anchor matching the label (IoU 1 > ignore_thre)
+        self.pred[0, 0, 1, 2] = torch.tensor([2.4, 1.2, 4, 3])
+        _, _, obj_mask, _ = self.layer.build_targets(self.pred, self.labels)
+
+        self.assertEqual(float(obj_mask[0, 0, 1, 2]), 0)
+        self.assertEqual(int((obj_mask == 0).sum()), 1)
+
+    def test_no_labels(self):
+        target, tgt_mask, obj_mask, tgt_scale = self.layer.build_targets(
+            self.pred, torch.zeros(1, 50, 5))
+
+        self.assertEqual(int(target.abs().sum() + tgt_mask.sum() + tgt_scale.sum()), 0)
+        self.assertTrue(bool(obj_mask.all()))
+
+
+class DecodeTestCase(unittest.TestCase):
+    """ Hand-computed decoding of a 2x3 feature map (64x96 input, stride 32) """
+
+    def setUp(self):
+        self.layer = YOLOLayer(CONFIG_MODEL, layer_no=0, in_ch=1)
+        self.output = torch.zeros(1, 3 * 7, 2, 3)
+
+    def test_decode(self):
+        # anchor 1, cell j=1, i=2: tx=ln(3) (sigmoid .75), tw=ln(2), obj and class 1 logits
+        self.output[0, 7 + 0, 1, 2] = math.log(3)
+        self.output[0, 7 + 2, 1, 2] = math.log(2)
+        self.output[0, 7 + 4, 1, 2] = 100
+        self.output[0, 7 + 6, 1, 2] = -100
+        pred = self.layer.decode(self.output)
+
+        self.assertEqual(pred.shape, (1, 3 * 2 * 3, 7))
+        # [xc, yc, w, h] in pixels: (cell + sigmoid) * stride and exp * anchors
+        expected = torch.tensor([(2 + .75) * 32, 1.5 * 32, 2 * 128, 96, 1, .5, 0])
+        self.assertTrue(torch.allclose(pred[0, 6 + 3 + 2], expected))
+        # first cell of anchor 2 (3x4 grid units anchor)
+        self.assertTrue(torch.allclose(
+            pred[0, 12], torch.tensor([16., 16, 96, 128, .5, .5, .5])))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""" tests/test_yolov3 """
+
+import copy
+import unittest
+
+import torch
+
+from models.yolov3 import YOLOv3
+
+
+CONFIG_MODEL = dict(
+    TYPE='YOLOv3',
+    ANCHORS=[[27, 50], [42, 40], [42, 62], [51, 24], [52, 51],
+             [58, 72], [64, 41], [69, 58], [85, 86]],
+    ANCH_MASK=[[6, 7, 8], [3, 4, 5], [0, 1, 2]],
+    WIDTH_MULTIPLE=.25,
+    DEPTH_MULTIPLE=.34,
+    N_CLASSES=2,
+)
+
+
+def create_model(config_model=CONFIG_MODEL, seed=0):
+    """
+    Returns a small YOLOv3 in evaluation mode whose batchnorm layers have non-trivial
+    running statistics and affine parameters
+    """
+    torch.manual_seed(seed)
+    model = YOLOv3(config_model)
+
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-.1, .1)
+            module.running_var.uniform_(.5, 1.5)
+            module.weight.data.uniform_(.5, 1.5)
+            module.bias.data.uniform_(-.1, .1)
+
+    return model.eval()
+
+
+class FuseTestCase(unittest.TestCase):
+    """ Batchnorm folding of YOLOv3.fuse """
+
+    def test_fuse(self):
+        model = create_model()
+        fused = copy.deepcopy(model).fuse()
+        imgs = torch.rand(2, 3, 64, 96)
+
+        self.assertFalse(any(isinstance(module, torch.nn.BatchNorm2d)
+                             for module in fused.modules()))
+
+        with torch.no_grad():
+            expected, obtained = model(imgs), fused(imgs)
+
+        self.assertEqual(expected.shape, obtained.shape)
+        # objectness and class scores in [0, 1], boxes in pixels
+        self.assertTrue(torch.allclose(expected[..., 4:], obtained[..., 4:], atol=1e-5))
+        self.assertTrue(torch.allclose(expected[..., :4], obtained[..., :4], rtol=1e-5, atol=1e-4))
@@ -5,7 +5,6 @@ from __future__ import division
 import argparse
 import distutils
 import os
-import random
 import time
 import yaml
 
@@ -15,11 +14,13 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 from constants import Dataset as dataset_option
+from datasets.datasets import collate_channels_last
 from datasets.managers import get_dataset_class
+from datasets.samplers import MultiScaleBatchSampler
 from models.yolov3 import YOLOv3
 from utils.evaluators.managers import get_evaluator_class
 from utils.parse_yolo_weights import parse_yolo_weights
-from utils.utils import get_tensorboard_log_path
+from utils.utils import get_autocast, get_tensorboard_log_path, normalize_images
 
 
 torch.backends.cudnn.benchmark = True
@@ -85,6 +86,8 @@ def main():
     subdivision = cfg['TRAIN']['SUBDIVISION']
     ignore_thre = cfg['TRAIN']['IGNORETHRE']
     random_resize = cfg['AUGMENTATION']['RANDRESIZE']
+    precision = cfg['TRAIN'].get('PRECISION', 'fp32')
+    channels_last = cfg['TRAIN'].get('CHANNELS_LAST', False)
     base_lr = cfg['TRAIN']['LR'] / batch_size / subdivision
 
     print('effective_batch_size = batch_size * iter_size = %d * %d' %
@@ -120,6 +123,12 @@ def main():
         print("using cuda")
         model = model.cuda()
 
+    if channels_last:
+        print("using channels_last memory format")
+        model = model.to(memory_format=torch.channels_last)
+
+    collate_fn = collate_channels_last if channels_last else None
+
     if args.tfboard:
         print("using tfboard")
         tblogger = SummaryWriter(get_tensorboard_log_path(args.dataset))
@@ -131,18 +140,30 @@ def main():
     dataset = get_dataset_class(args.dataset)(model_type=cfg['MODEL']['TYPE'],
                                               img_size=imgsize,
                                               augmentation=cfg['AUGMENTATION'],
-                                              debug=args.debug)
-
+                                              debug=args.debug,
+                                              uint8=True)
+
+    # random resizing every 10 iterations, the workers keep running across the resizes
+    # and epochs
+    batch_sampler = MultiScaleBatchSampler(
+        dataset, batch_size, imgsize, range(320, 609, 32) if random_resize else None,
+        resize_interval=10 * subdivision)
     dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, shuffle=True, num_workers=args.n_cpu)
+        dataset, batch_sampler=batch_sampler, num_workers=args.n_cpu,
+        collate_fn=collate_fn, persistent_workers=args.n_cpu > 0)
     dataiterator = iter(dataloader)
 
     evaluator = get_evaluator_class(args.dataset)(model_type=cfg['MODEL']['TYPE'],
                                                   img_size=cfg['TEST']['IMGSIZE'],
                                                   confthre=cfg['TEST']['CONFTHRE'],
-                                                  nmsthre=cfg['TEST']['NMSTHRE'])
+                                                  nmsthre=cfg['TEST']['NMSTHRE'],
+                                                  precision=cfg['TEST'].get('PRECISION', 'fp32'),
+                                                  rect=cfg['TEST'].get('RECT', False))
 
     dtype = torch.cuda.FloatTensor if cuda else torch.FloatTensor
+    device_type = 'cuda' if cuda else 'cpu'
+    # loss scaling avoids the underflow of fp16 gradients (bf16 has the range of fp32)
+    scaler = torch.amp.GradScaler(device_type, enabled=precision == 'fp16')
 
     # optimizer setup
     # set weight decay only on conv.weight
@@ -189,12 +210,15 @@ def main():
             except StopIteration:
                 dataiterator = iter(dataloader)
                 imgs, targets, _, _ = next(dataiterator)  # load a batch
-            imgs = Variable(imgs.type(dtype))
+            imgsize = imgs.shape[-1]
+            imgs = Variable(normalize_images(imgs, device_type))
             targets = Variable(targets.type(dtype), requires_grad=False)
-            loss = model(imgs, targets)
-            loss.backward()
+            with get_autocast(precision, device_type):
+                loss = model(imgs, targets)
+            scaler.scale(loss).backward()
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
 
         if iter_i % 10 == 0:
@@ -211,15 +235,6 @@ def main():
             if args.tfboard:
                 tblogger.add_scalar('train/total_loss', model.loss_dict['l2'], iter_i)
 
-            # random resizing
-            if random_resize:
-                imgsize = (random.randint(0, 9) % 10 + 10) * 32
-                dataset.img_shape = (imgsize, imgsize)
-                dataset.img_size = imgsize
-                dataloader = torch.utils.data.DataLoader(
-                    dataset, batch_size=batch_size, shuffle=True, num_workers=args.n_cpu)
-                dataiterator = iter(dataloader)
-
         # save checkpoint
         if iter_i > 0 and (iter_i % args.checkpoint_interval == 0):
             torch.save({'iter': iter_i,
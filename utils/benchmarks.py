@@ -0,0 +1,816 @@
+# -*- coding: utf-8 -*-
+""" utils/benchmarks """
+
+import contextlib
+import copy
+import io
+import os
+import time
+
+import numpy as np
+import torch
+
+from models.yolo_layer import YOLOLayer
+from utils.utils import bboxes_iou, cat_sparse_predictions, get_conv_flops, nms, postprocess
+
+
+def benchmark_batched_inference(model, batch_sizes=(1, 2, 4, 8, 16), num_tiles=32, tile_size=512):
+    """
+    Measures the tiles per second processed by model.get_batch_predictions using
+    different batch sizes and prints a summary table
+    Args:
+        model (challenge.classes.MyModel): loaded model
+        batch_sizes (tuple): batch sizes to evaluate
+        num_tiles (int): number of random tiles processed per batch size
+        tile_size (int): width and height of the tiles
+    Returns:
+        results (dict): {batch_size: tiles_per_second, ...}
+    """
+    tiles = np.random.randint(0, 256, size=(num_tiles, tile_size, tile_size, 3), dtype=np.uint8)
+    results = dict()
+
+    # warm up
+    model.get_batch_predictions(tiles[:1])
+
+    for batch_size in batch_sizes:
+        start = time.time()
+        for idx in range(0, num_tiles, batch_size):
+            model.get_batch_predictions(tiles[idx:idx+batch_size])
+        results[batch_size] = num_tiles / (time.time() - start)
+
+    print('batch size | tiles/s')
+    for batch_size, tiles_per_second in results.items():
+        print('{:>10} | {:.2f}'.format(batch_size, tiles_per_second))
+
+    return results
+
+
+def benchmark_target_assignment(config_model, labels_per_image=(1, 16, 50), batchsize=4,
+                                imgsize=512, repeats=10):
+    """
+    Measures the mean time per call of YOLOLayer.build_targets for each YOLO layer and
+    number of labels per image and prints a summary table (the assignment itself is
+    covered by tests/test_yolo_layer.py)
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        labels_per_image (tuple): numbers of labels per image to evaluate
+        batchsize (int): number of images per batch
+        imgsize (int): input image size
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (dict): {(layer_no, nlabels): seconds, ...}
+    """
+    results = dict()
+
+    print('layer | labels | build_targets (ms)')
+    for layer_no, stride in enumerate((32, 16, 8)):
+        layer = YOLOLayer(config_model, layer_no=layer_no, in_ch=1)
+        fsize = imgsize // stride
+
+        for nlabels in labels_per_image:
+            pred = torch.rand(batchsize, layer.n_anchors, fsize, fsize, 4) * fsize
+            labels = torch.zeros(batchsize, 50, 5)
+            labels[:, :nlabels, 0] = torch.randint(0, layer.n_classes, (batchsize, nlabels))
+            labels[:, :nlabels, 1:3] = torch.rand(batchsize, nlabels, 2) * .98
+            labels[:, :nlabels, 3:] = torch.rand(batchsize, nlabels, 2) * .2 + .02
+
+            start = time.time()
+            for _ in range(repeats):
+                layer.build_targets(pred, labels)
+            results[(layer_no, nlabels)] = (time.time() - start) / repeats
+            print('{:>5} | {:>6} | {:>18.2f}'.format(
+                layer_no, nlabels, results[(layer_no, nlabels)] * 1000))
+
+    return results
+
+
+def get_random_slide_predictions(num_boxes=20000, slide_size=2048, box_size=(30, 90)):
+    """
+    Returns random [[x1, y1, x2, y2, score], ...] predictions of a whole slide like the
+    ones accumulated from all its tiles before the slide-level NMS
+    """
+    predictions = np.random.rand(num_boxes, 5)
+    predictions[:, :2] *= slide_size
+    predictions[:, 2:4] = predictions[:, :2] + \
+        np.random.uniform(box_size[0], box_size[1], (num_boxes, 2))
+
+    return predictions
+
+
+def benchmark_nms(num_boxes=(1000, 10000, 30000), thresh=0.45, limits=(None, 100), repeats=1):
+    """
+    Measures the mean time per call of utils.utils.nms using random slide-level
+    predictions and prints a summary table
+    Args:
+        num_boxes (tuple): numbers of boxes to evaluate
+        thresh (float): IoU threshold of the NMS
+        limits (tuple): values of the limit argument to evaluate
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (dict): {(num_boxes, limit): seconds, ...}
+    """
+    results = dict()
+
+    print('  boxes | limit | nms (ms)')
+    for num in num_boxes:
+        predictions = get_random_slide_predictions(num)
+
+        for limit in limits:
+            start = time.time()
+            for _ in range(repeats):
+                nms(predictions[:, :4], thresh, predictions[:, 4], limit)
+            results[(num, limit)] = (time.time() - start) / repeats
+            print('{:>7} | {:>5} | {:>8.2f}'.format(num, str(limit), results[(num, limit)] * 1000))
+
+    return results
+
+
+def get_random_predictions(batchsize=8, imgsize=416, num_classes=2, num_clusters=40):
+    """
+    Returns a random YOLOv3-like raw output whose shape is :math:`(N, B, 5 + num_classes)`
+    with boxes clustered around num_clusters objects per image, like the output of
+    a model evaluated with a low confidence threshold
+    """
+    num_boxes = sum(3 * (imgsize // stride) ** 2 for stride in (32, 16, 8))
+    centers = torch.rand(batchsize, num_clusters, 2) * imgsize
+    cluster_ids = torch.randint(0, num_clusters, (batchsize, num_boxes))
+    prediction = torch.rand(batchsize, num_boxes, 5 + num_classes)
+    prediction[:, :, :2] = torch.gather(centers, 1, cluster_ids[..., None].expand(-1, -1, 2)) + \
+        torch.randn(batchsize, num_boxes, 2) * 8
+    prediction[:, :, 2:4] = torch.rand(batchsize, num_boxes, 2) * 60 + 30
+
+    return prediction
+
+
+def benchmark_postprocess(num_classes=2, batchsize=8, imgsize=416, conf_thres=(0.005, 0.1, 0.5),
+                          nms_thre=0.45, repeats=3):
+    """
+    Measures the mean time per call of utils.utils.postprocess using random clustered
+    predictions and prints a summary table
+    Args:
+        num_classes (int): number of classes
+        batchsize (int): number of images per batch
+        imgsize (int): input image size
+        conf_thres (tuple): confidence thresholds to evaluate
+        nms_thre (float): IoU threshold of the NMS
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (dict): {conf_thre: (candidates, seconds), ...}
+    """
+    prediction = get_random_predictions(batchsize, imgsize, num_classes)
+    results = dict()
+
+    print('conf_thre | candidates | postprocess (ms)')
+    for conf_thre in conf_thres:
+        candidates = int(
+            (prediction[:, :, 4] * prediction[:, :, 5:].max(2)[0] >= conf_thre).sum())
+
+        start = time.time()
+        for _ in range(repeats):
+            postprocess(prediction.clone(), num_classes, conf_thre, nms_thre)
+        results[conf_thre] = (candidates, (time.time() - start) / repeats)
+        print('{:>9} | {:>10} | {:>16.2f}'.format(
+            conf_thre, candidates, results[conf_thre][1] * 1000))
+
+    return results
+
+
+def benchmark_tile_postprocessing(detections_per_tile=(10, 100, 1000), num_tiles=64, cut_size=512,
+                                  repeats=3):
+    """
+    Measures the mean time per batch of tiles of challenge.utils.evaluate_tiles using
+    random tile predictions and prints a summary table
+    Args:
+        detections_per_tile (tuple): numbers of detections per tile to evaluate
+        num_tiles (int): number of tiles per batch
+        cut_size (int): width and height of the tiles
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (dict): {detections_per_tile: seconds, ...}
+    """
+    from challenge.utils import Tile, evaluate_tiles
+
+    slide_size = cut_size * 4
+    origins = np.random.randint(0, 4, (num_tiles, 2)) * cut_size
+    tiles = [Tile('', x, y, slide_size, slide_size, None, False) for x, y in origins]
+    results = dict()
+
+    print('detections | evaluate_tiles (ms)')
+    for num in detections_per_tile:
+        tile_results = [np.random.rand(num, 5).astype(np.float32) for _ in tiles]
+        for result in tile_results:
+            result[:, :4] *= cut_size
+
+        start = time.time()
+        for _ in range(repeats):
+            evaluate_tiles(tiles, tile_results, cut_size)
+        results[num] = (time.time() - start) / repeats
+        print('{:>10} | {:>19.2f}'.format(num, results[num] * 1000))
+
+    return results
+
+
+def benchmark_slide_pipeline(model, decoding_workers=(1, 2, 4, 8), output_workers=2):
+    """
+    Measures the slides per second processed by challenge.utils.process_input_files
+    (sequential) and challenge.pipeline.run_pipeline using different numbers of
+    decoding processes on the images from challenge.settings.INPUT_FOLDER, and prints
+    a summary table. The predictions are saved on challenge.settings.OUTPUT_FOLDER
+    (only XML files)
+    Args:
+        model (challenge.classes.MyModel): loaded model
+        decoding_workers (tuple): numbers of decoding processes to evaluate
+        output_workers (int): number of threads saving the predictions
+    Returns:
+        results (dict): {decoding_workers: slides_per_second, ...} (0 for sequential)
+    """
+    from challenge import settings as challenge_settings
+    from challenge.pipeline import run_pipeline
+    from challenge.utils import initial_validation_cleaning, process_input_files, slide_cache
+
+    num_slides = len([f for f in os.listdir(challenge_settings.INPUT_FOLDER) if f.endswith('.jpeg')])
+    settings_backup = (challenge_settings.DECODING_WORKERS, challenge_settings.OUTPUT_WORKERS)
+    challenge_settings.OUTPUT_WORKERS = output_workers
+    results = dict()
+
+    try:
+        for workers in (0, ) + tuple(decoding_workers):
+            initial_validation_cleaning()
+            slide_cache.clear()
+            challenge_settings.DECODING_WORKERS = workers
+            start = time.time()
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                if workers:
+                    run_pipeline(model)
+                else:
+                    process_input_files(model)
+
+            results[workers] = num_slides / (time.time() - start)
+    finally:
+        challenge_settings.DECODING_WORKERS, challenge_settings.OUTPUT_WORKERS = settings_backup
+
+    print('decoding workers | slides/s')
+    for workers, slides_per_second in results.items():
+        print('{:>16} | {:.3f}'.format(workers if workers else 'sequential', slides_per_second))
+
+    return results
+
+
+def benchmark_fused_inference(config_model, batch_sizes=(1, 8), imgsize=416, repeats=5,
+                              rtol=1e-3, atol=1e-3):
+    """
+    Compares the CPU latency of YOLOv3 before and after folding the batchnorm layers
+    into the convolutions (YOLOv3.fuse) using random weights and inputs, verifies both
+    outputs are equal within the tolerance and prints the mean time per forward pass
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        batch_sizes (tuple): batch sizes to evaluate
+        imgsize (int): input image size
+        repeats (int): number of forward passes used to calculate the mean time
+        rtol (float): relative tolerance of the outputs comparison
+        atol (float): absolute tolerance of the outputs comparison
+    Returns:
+        results (dict): {batch_size: (eager_seconds, fused_seconds), ...}
+    """
+    from models.yolov3 import YOLOv3
+
+    model = YOLOv3(config_model)
+
+    # non trivial batchnorm statistics
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            torch.nn.init.uniform_(module.weight, .5, 1.5)
+            torch.nn.init.uniform_(module.bias, -.1, .1)
+            torch.nn.init.uniform_(module.running_mean, -.1, .1)
+            torch.nn.init.uniform_(module.running_var, .5, 1.5)
+
+    model.eval()
+    fused_model = copy.deepcopy(model).fuse()
+    results = dict()
+
+    print('batch size | eager (ms) | fused (ms) | speedup')
+    for batch_size in batch_sizes:
+        imgs = torch.rand(batch_size, 3, imgsize, imgsize)
+        timings = []
+
+        with torch.no_grad():
+            assert torch.allclose(model(imgs), fused_model(imgs), rtol=rtol, atol=atol)
+
+            for net in (model, fused_model):
+                start = time.time()
+                for _ in range(repeats):
+                    net(imgs)
+                timings.append((time.time() - start) / repeats)
+
+        results[batch_size] = tuple(timings)
+        print('{:>10} | {:>10.2f} | {:>10.2f} | {:.2f}x'.format(
+            batch_size, timings[0] * 1000, timings[1] * 1000, timings[0] / timings[1]))
+
+    return results
+
+
+def benchmark_inference_backends(config_model, backends=('eager', 'torchscript', 'onnxruntime',
+                                                         'compile'),
+                                 batch_sizes=(1, 8), imgsize=416, repeats=5, rtol=1e-3, atol=1e-3):
+    """
+    Compares the inference backends from models.backends against the eager YOLOv3
+    (with batchnorm folded) using random weights and inputs, verifies their outputs
+    are equal within the tolerance and prints the latency and throughput on CPU.
+    Backends whose optional dependencies are not installed are skipped
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        backends (tuple): names of the backends to evaluate
+        batch_sizes (tuple): batch sizes to evaluate
+        imgsize (int): input image size
+        repeats (int): number of calls used to calculate the mean time
+        rtol (float): relative tolerance of the outputs comparison
+        atol (float): absolute tolerance of the outputs comparison
+    Returns:
+        results (dict): {(backend, batch_size): seconds_per_call, ...}
+    """
+    from models.backends import get_backend_class
+    from models.yolov3 import YOLOv3
+
+    model = YOLOv3(config_model).fuse()
+    results = dict()
+
+    print('    backend | batch size | latency (ms) | images/s')
+    for name in backends:
+        try:
+            backend = get_backend_class(name)(model, imgsize)
+        except ImportError as error:
+            print('{:>11} | skipped: {}'.format(name, error))
+            continue
+
+        for batch_size in batch_sizes:
+            imgs = torch.rand(batch_size, 3, imgsize, imgsize)
+
+            with torch.no_grad():
+                # the first call also warms up the backend
+                assert torch.allclose(model(imgs), backend(imgs), rtol=rtol, atol=atol)
+                start = time.time()
+                for _ in range(repeats):
+                    backend(imgs)
+
+            results[(name, batch_size)] = (time.time() - start) / repeats
+            print('{:>11} | {:>10} | {:>12.2f} | {:.2f}'.format(
+                name, batch_size, results[(name, batch_size)] * 1000,
+                batch_size / results[(name, batch_size)]))
+
+    return results
+
+
+def benchmark_precision(config_model, precisions=('fp32', 'bf16'), batchsize=2, imgsize=416,
+                        repeats=3):
+    """
+    Measures the CPU time of a training step (forward with labels, backward and SGD
+    step through a GradScaler, like train.py) and of an inference forward pass of
+    YOLOv3 under each autocast precision (see utils.utils.get_autocast) and prints the
+    relative error of the detections and of the loss of the first step against fp32.
+    Each precision trains its own copy of the model, so the inference and the first
+    step always use the initial weights and batchnorm statistics
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        precisions (tuple): precisions to evaluate
+        batchsize (int): number of images per batch
+        imgsize (int): input image size
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (dict): {precision: (train_seconds, inference_seconds), ...}
+    """
+    from models.yolov3 import YOLOv3
+    from utils.utils import get_autocast
+
+    model = YOLOv3(config_model).eval()
+    imgs = torch.rand(batchsize, 3, imgsize, imgsize)
+    labels = torch.zeros(batchsize, 50, 5)
+    labels[:, :10, 0] = 1
+    labels[:, :10, 1:3] = torch.rand(batchsize, 10, 2) * .9 + .05
+    labels[:, :10, 3:] = torch.rand(batchsize, 10, 2) * .1 + .02
+    results = dict()
+    reference = None
+
+    print('precision | train step (ms) | inference (ms) | loss error | output error')
+    for precision in precisions:
+        timings = []
+
+        with torch.no_grad(), get_autocast(precision):
+            start = time.time()
+            for _ in range(repeats):
+                output = model(imgs)
+            timings.append((time.time() - start) / repeats)
+
+        train_model = copy.deepcopy(model).train()
+        optimizer = torch.optim.SGD(train_model.parameters(), lr=1e-6)
+        scaler = torch.amp.GradScaler('cpu', enabled=precision == 'fp16')
+        losses = []
+        start = time.time()
+        for _ in range(repeats):
+            optimizer.zero_grad()
+            with get_autocast(precision):
+                loss = train_model(imgs, labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            losses.append(loss.item())
+        timings.insert(0, (time.time() - start) / repeats)
+
+        if reference is None:
+            reference = (losses[0], output)
+
+        results[precision] = tuple(timings)
+        print('{:>9} | {:>15.2f} | {:>14.2f} | {:>10.4f} | {:>12.4f}'.format(
+            precision, timings[0] * 1000, timings[1] * 1000,
+            abs(losses[0] - reference[0]) / reference[0],
+            float((output[..., :4] - reference[1][..., :4]).norm() / reference[1][..., :4].norm())))
+
+    return results
+
+
+def benchmark_channels_last(config_model, batch_sizes=(1, 8), imgsize=416, repeats=3,
+                            rtol=1e-3, atol=1e-3):
+    """
+    Compares the CPU time of YOLOv3 inference and training steps using the NCHW
+    (contiguous) and channels_last (NHWC) memory formats for the weights and the
+    inputs, verifies both produce the same detections and prints the mean times
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        batch_sizes (tuple): batch sizes to evaluate
+        imgsize (int): input image size
+        repeats (int): number of calls used to calculate the mean time
+        rtol (float): relative tolerance of the outputs comparison
+        atol (float): absolute tolerance of the outputs comparison
+    Returns:
+        results (dict): {(memory_format, batch_size): (inference_seconds, train_seconds), ...}
+    """
+    from models.yolov3 import YOLOv3
+
+    model = YOLOv3(config_model)
+    results = dict()
+
+    formats = (('NCHW', torch.contiguous_format), ('channels_last', torch.channels_last))
+
+    print('memory format | batch size | inference (ms) | train step (ms)')
+    for batch_size in batch_sizes:
+        imgs = torch.rand(batch_size, 3, imgsize, imgsize)
+        labels = torch.zeros(batch_size, 50, 5)
+        labels[:, :10, 1:3] = torch.rand(batch_size, 10, 2) * .9 + .05
+        labels[:, :10, 3:] = torch.rand(batch_size, 10, 2) * .1 + .02
+        outputs = []
+
+        # inference first, the training steps update the batchnorm statistics
+        model.eval()
+        for name, memory_format in formats:
+            model = model.to(memory_format=memory_format)
+            inputs = imgs.contiguous(memory_format=memory_format)
+
+            with torch.no_grad():
+                outputs.append(model(inputs))
+                start = time.time()
+                for _ in range(repeats):
+                    model(inputs)
+                results[(name, batch_size)] = ((time.time() - start) / repeats, )
+
+        assert torch.allclose(outputs[0], outputs[1], rtol=rtol, atol=atol)
+
+        model.train()
+        for name, memory_format in formats:
+            model = model.to(memory_format=memory_format)
+            inputs = imgs.contiguous(memory_format=memory_format)
+
+            start = time.time()
+            for _ in range(repeats):
+                model.zero_grad()
+                model(inputs, labels).backward()
+            results[(name, batch_size)] += ((time.time() - start) / repeats, )
+
+            print('{:>13} | {:>10} | {:>14.2f} | {:>15.2f}'.format(
+                name, batch_size, results[(name, batch_size)][0] * 1000,
+                results[(name, batch_size)][1] * 1000))
+
+    return results
+
+
+def _get_decode_inputs(config_model, batchsize, imgsize):
+    """ Returns the YOLO layers and random raw outputs of their convolutions """
+    layers = [YOLOLayer(config_model, layer_no=layer_no, in_ch=1)
+              for layer_no in range(len(config_model['ANCH_MASK']))]
+    outputs = [torch.randn(batchsize, layer.n_anchors * (5 + layer.n_classes),
+                           imgsize // layer.stride, imgsize // layer.stride)
+               for layer in layers]
+
+    return layers, outputs
+
+
+def _get_rss(field):
+    """ Returns the VmRSS or VmHWM (peak) field of /proc/self/status in bytes """
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+    raise ValueError('{} not found in /proc/self/status'.format(field))
+
+
+def _measure_decode_peak_rss(config_model, batchsize, imgsize):
+    """
+    Returns the increase of the peak resident set size (bytes) caused by decoding the
+    outputs of the YOLO layers. Runs on a child process (Linux only)
+    """
+    torch.manual_seed(0)
+    layers, outputs = _get_decode_inputs(config_model, batchsize, imgsize)
+
+    def decode():
+        return torch.cat([layer.decode(output) for layer, output in zip(layers, outputs)], 1)
+
+    # warm-up (grids, allocator) with the first image only
+    with torch.no_grad():
+        full_outputs, outputs = outputs, [output[:1].clone() for output in outputs]
+        decode()
+        outputs = full_outputs
+
+    # resets the peak resident set size (VmHWM) to the current one
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    baseline = _get_rss('VmRSS')
+
+    with torch.no_grad():
+        decode()
+
+    return _get_rss('VmHWM') - baseline
+
+
+def benchmark_decode(config_model, batchsize=16, imgsize=608, repeats=5):
+    """
+    Measures the mean time of YOLOLayer.decode using random convolution outputs of the
+    YOLO layers and the peak RSS increase (on a fresh child process) and prints them
+    (the decoding itself is covered by tests/test_yolo_layer.py)
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        batchsize (int): number of images per batch
+        imgsize (int): input image size
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        results (tuple): (seconds, peak_rss_bytes)
+    """
+    import multiprocessing as mp
+
+    layers, outputs = _get_decode_inputs(config_model, batchsize, imgsize)
+
+    start = time.time()
+    with torch.no_grad():
+        for _ in range(repeats):
+            for layer, output in zip(layers, outputs):
+                layer.decode(output)
+    seconds = (time.time() - start) / repeats
+
+    with mp.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        peak_rss = pool.apply(_measure_decode_peak_rss, (config_model, batchsize, imgsize))
+
+    print('time (ms) | peak RSS increase (MB)')
+    print('{:>9.2f} | {:.1f}'.format(seconds * 1000, peak_rss / 1024**2))
+
+    return seconds, peak_rss
+
+
+def get_sparse_head_outputs(config_model, batchsize, imgsize, obj_scale=3., obj_bias=-6.):
+    """
+    Returns the YOLO layers and random raw outputs of their convolutions whose
+    objectness logits are scaled by obj_scale and shifted by obj_bias, so only a few
+    cells are confident like on the mostly empty tiles of the slides
+    """
+    layers, outputs = _get_decode_inputs(config_model, batchsize, imgsize)
+
+    for layer, output in zip(layers, outputs):
+        n_ch = 5 + layer.n_classes
+        obj = output.view(batchsize, layer.n_anchors, n_ch, *output.shape[2:])[:, :, 4]
+        obj.mul_(obj_scale).add_(obj_bias)
+
+    return layers, outputs
+
+
+def benchmark_sparse_decoding(config_model, batchsize=8, imgsize=416, conf_thre=.8,
+                              nms_thre=.45, repeats=10):
+    """
+    Compares the dense decoding + postprocess against the sparse decoding
+    (YOLOLayer.decode_sparse) + postprocess for the three YOLO layers, verifies both
+    produce the same detections and prints the mean time of the post-forward work and
+    the size of the predictions passed to postprocess
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        batchsize (int): number of images per batch
+        imgsize (int): input image size
+        conf_thre (float): confidence threshold
+        nms_thre (float): IoU threshold of the NMS
+        repeats (int): number of calls used to calculate the mean time
+    Returns:
+        timings (dict): {'dense'|'sparse': seconds, ...}
+    """
+    torch.manual_seed(0)
+    layers, outputs = get_sparse_head_outputs(config_model, batchsize, imgsize)
+    num_classes = config_model['N_CLASSES']
+
+    def dense():
+        prediction = torch.cat([layer.decode(output) for layer, output in zip(layers, outputs)], 1)
+        return prediction, postprocess(prediction, num_classes, conf_thre, nms_thre)
+
+    def sparse():
+        prediction = cat_sparse_predictions(
+            [layer.decode_sparse(output, conf_thre) for layer, output in zip(layers, outputs)])
+        return prediction, postprocess(prediction, num_classes, conf_thre, nms_thre)
+
+    timings = dict()
+    sizes = dict()
+
+    with torch.no_grad():
+        (dense_prediction, expected), (sparse_prediction, obtained) = dense(), sparse()
+
+        for dets_a, dets_b in zip(expected, obtained):
+            if dets_a is None or dets_b is None:
+                assert dets_a is None and dets_b is None
+            else:
+                assert torch.allclose(dets_a, dets_b, rtol=1e-5, atol=1e-6)
+
+        sizes['dense'] = dense_prediction.numel() * dense_prediction.element_size()
+        sizes['sparse'] = sparse_prediction.prediction.numel() * \
+            sparse_prediction.prediction.element_size()
+
+        for name, func in (('dense', dense), ('sparse', sparse)):
+            start = time.time()
+            for _ in range(repeats):
+                func()
+            timings[name] = (time.time() - start) / repeats
+
+    print('{} of {} cells kept'.format(
+        len(sparse_prediction.img_ids), dense_prediction.shape[0] * dense_prediction.shape[1]))
+    print('decoding | time (ms) | predictions (KB)')
+    for name, seconds in timings.items():
+        print('{:>8} | {:>9.2f} | {:.1f}'.format(name, seconds * 1000, sizes[name] / 1024))
+
+    return timings
+
+
+def _get_matched_share(bboxes_a, bboxes_b, iou_thre, block_size=1024):
+    """
+    Returns the share of the boxes from bboxes_a overlapping a box from bboxes_b with an
+    IoU of at least iou_thre (1 if bboxes_a is empty). The IoUs are computed in blocks
+    """
+    if not len(bboxes_a):
+        return 1.
+    if not len(bboxes_b):
+        return 0.
+
+    matched = sum(int((bboxes_iou(block, bboxes_b).max(1)[0] >= iou_thre).sum())
+                  for block in bboxes_a.split(block_size))
+
+    return matched / len(bboxes_a)
+
+
+def benchmark_whole_slide_inference(model, num_slides=1, chunk_size=1024, chunk_overlap=256,
+                                    iou_thre=.5):
+    """
+    Compares the sliding window of tiles against the 'chunks' and 'slide' inference
+    modes (see challenge.settings.INFERENCE_MODE) on the first num_slides images from
+    challenge.settings.INPUT_FOLDER, and prints the FLOPs of the convolutions, the wall
+    time and the share of the tiles detections found by each mode (and vice versa)
+    after the slide-level NMS
+    Args:
+        model (challenge.classes.MyModel): loaded model (eager or compile backend)
+        num_slides (int): number of slides to evaluate
+        chunk_size (int): size of the chunks
+        chunk_overlap (int): overlap between consecutive chunks
+        iou_thre (float): minimum IoU of two matching detections
+    Returns:
+        results (dict): {mode: (gflops, seconds, tiles_matched, mode_matched), ...}
+    """
+    from challenge import settings as challenge_settings
+    from challenge.utils import Tile, evaluate_tiles, get_chunk_origins, \
+        get_chunk_predictions, get_tile_origins, slide_cache
+
+    fileimgs = sorted(f for f in os.listdir(challenge_settings.INPUT_FOLDER)
+                      if f.endswith('.jpeg'))[:num_slides]
+    settings_backup = (challenge_settings.INFERENCE_MODE, challenge_settings.CHUNK_SIZE,
+                       challenge_settings.CHUNK_OVERLAP)
+    challenge_settings.CHUNK_SIZE = chunk_size
+    challenge_settings.CHUNK_OVERLAP = chunk_overlap
+    scale = model.imgsize / challenge_settings.CUT_SIZE
+    results = {mode: [0, 0, 0, 0] for mode in ('tiles', 'chunks', 'slide')}
+
+    def get_tiles_predictions(img):
+        h, w, _ = img.shape
+        cut_size = challenge_settings.CUT_SIZE
+        tiles = [Tile('', x, y, w, h, img[y:y+cut_size, x:x+cut_size], False)
+                 for x, y in get_tile_origins(w, h, cut_size, challenge_settings.OVERLAP)]
+        predictions = []
+
+        for idx in range(0, len(tiles), challenge_settings.BATCH_SIZE):
+            batch = tiles[idx:idx+challenge_settings.BATCH_SIZE]
+            predictions.extend(evaluate_tiles(
+                batch, model.get_batch_predictions([tile.image for tile in batch]), cut_size))
+
+        return np.concatenate(predictions), len(tiles), (model.imgsize, model.imgsize)
+
+    def get_mode_predictions(img):
+        h, w, _ = img.shape
+        chunk_size, origins = get_chunk_origins(
+            w, h, challenge_settings.CHUNK_SIZE if challenge_settings.INFERENCE_MODE == 'chunks'
+            else None, challenge_settings.CHUNK_OVERLAP)
+        padded = [-(-int(round(size * scale)) // 32) * 32 for size in
+                  (min(chunk_size, h), min(chunk_size, w))]
+
+        return get_chunk_predictions(model, img), len(origins), padded
+
+    try:
+        for fileimg in fileimgs:
+            img = slide_cache.get_slide(fileimg)
+            detections = dict()
+
+            for mode in results:
+                challenge_settings.INFERENCE_MODE = mode
+                start = time.time()
+                predictions, num_inputs, input_size = get_tiles_predictions(img) \
+                    if mode == 'tiles' else get_mode_predictions(img)
+                predictions = predictions[nms(predictions[:, :4], model.nmsthre, predictions[:, 4])]
+                results[mode][1] += time.time() - start
+                results[mode][0] += num_inputs * get_conv_flops(model.model, *input_size) / 1e9
+                detections[mode] = torch.from_numpy(predictions[:, :4].astype(np.float32))
+
+            for mode in results:
+                results[mode][2] += _get_matched_share(detections['tiles'], detections[mode], iou_thre)
+                results[mode][3] += _get_matched_share(detections[mode], detections['tiles'], iou_thre)
+    finally:
+        challenge_settings.INFERENCE_MODE, challenge_settings.CHUNK_SIZE, \
+            challenge_settings.CHUNK_OVERLAP = settings_backup
+
+    print('  mode | GFLOPs/slide | seconds/slide | tiles found | mode found in tiles')
+    for mode, (gflops, seconds, tiles_matched, mode_matched) in results.items():
+        results[mode] = tuple(value / len(fileimgs) for value in (gflops, seconds, tiles_matched,
+                                                                  mode_matched))
+        print('{:>6} | {:>12.1f} | {:>13.2f} | {:>11.3f} | {:.3f}'.format(mode, *results[mode]))
+
+    return results
+
+
+MODEL_VARIANTS = {
+    'YOLOv3': dict(),
+    'YOLOv3 x0.5': dict(WIDTH_MULTIPLE=.5, DEPTH_MULTIPLE=.33),
+    'YOLOv3-tiny': dict(TYPE='YOLOv3-tiny', ANCH_MASK=[[3, 4, 5, 6, 7, 8], [0, 1, 2]]),
+    'YOLOv3-tiny x0.5': dict(TYPE='YOLOv3-tiny', ANCH_MASK=[[3, 4, 5, 6, 7, 8], [0, 1, 2]],
+                             WIDTH_MULTIPLE=.5),
+}
+
+
+def benchmark_model_variants(config_model, variants=MODEL_VARIANTS, batchsize=1, imgsize=416,
+                             repeats=3, evaluator=None, checkpoints=None):
+    """
+    Compares the model variants (see models.yolov3.MODELS and the WIDTH_MULTIPLE and
+    DEPTH_MULTIPLE keys of the config files) and prints the FLOPs of the convolutions,
+    the number of parameters, the mean CPU time per forward pass and the AP30 of the
+    trained variants
+    Args:
+        config_model (dict): model configuration (MODEL section of the config file)
+        variants (dict): {name: config_model keys overwritten, ...}
+        batchsize (int): number of images per forward pass
+        imgsize (int): input image size
+        repeats (int): number of forward passes used to calculate the mean time
+        evaluator (SignetRingEvaluator): evaluator used to calculate the AP30 (optional)
+        checkpoints (dict): {name: checkpoint path, ...} of the trained variants. The
+            AP30 of the variants without checkpoint is NaN
+    Returns:
+        results (dict): {name: (gflops, params, seconds, ap30), ...}
+    """
+    from models.yolov3 import YOLOv3
+
+    checkpoints = checkpoints or dict()
+    imgs = torch.rand(batchsize, 3, imgsize, imgsize)
+    results = dict()
+
+    print('{:>16} | GFLOPs | params (M) | CPU (ms) | AP30'.format('variant'))
+    for name, overrides in variants.items():
+        model = YOLOv3({**config_model, **overrides})
+        ap30 = float('nan')
+
+        if name in checkpoints:
+            state = torch.load(checkpoints[name], map_location='cpu')
+            model.load_state_dict(state.get('model_state_dict', state))
+
+        model.eval()
+        model.fuse()
+
+        if name in checkpoints and evaluator is not None:
+            ap30 = evaluator.evaluate(model)[0]
+
+        with torch.no_grad():
+            model(imgs)
+            start = time.time()
+            for _ in range(repeats):
+                model(imgs)
+            seconds = (time.time() - start) / repeats
+
+        results[name] = (get_conv_flops(model, imgsize, imgsize) / 1e9,
+                         sum(param.numel() for param in model.parameters()), seconds, ap30)
+        print('{:>16} | {:>6.2f} | {:>10.2f} | {:>8.1f} | {:.4f}'.format(
+            name, results[name][0], results[name][1] / 1e6, seconds * 1000, ap30))
+
+    return results
@@ -6,11 +6,14 @@ import os
 import pickle
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+import cv2
+import numpy as np
 from sklearn.model_selection import train_test_split
 
 from core.classes import SignetBox
 import settings
 from .files import get_name_and_extension
+from .managers.signet_ring_cell_dataset import SignetRingMGR
 
 
 def create_bndbox_file_from_file(file_path, output_file_name):
@@ -139,3 +142,78 @@ def get_or_create_train_test_files(
             lists.append(content)
 
     return lists[0], lists[1]
+
+
+def create_annotation_stores(
+        pickle_files=(settings.SIGNET_BOUNDING_BOXES_PATH, settings.SIGNET_TRAIN_PATH,
+                      settings.SIGNET_TEST_PATH)):
+    """
+    - Converts the pickle files with the SignetBoxes of each image (see
+      get_or_create_train_test_files) into columnar annotation stores (see SignetRingMGR)
+      saved as .npz files next to them
+    - Update the paths on settings.py to the .npz files to use them
+    """
+    for pickle_file in pickle_files:
+        SignetRingMGR(pickle_file).save('{}.npz'.format(os.path.splitext(pickle_file)[0]))
+
+
+def create_signet_shards(
+        pickle_file=settings.SIGNET_TRAIN_PATH, img_dir=settings.SIGNET_TRAIN_POS_IMG_PATH,
+        output_dir=settings.SIGNET_TRAIN_SHARDS_PATH, shard_size=settings.SIGNET_SHARD_SIZE,
+        encoded=False):
+    """
+    - Packs the images of the pickle file (see get_or_create_train_test_files) into
+      shard files of up to shard_size bytes (shard_0000.bin, shard_0001.bin, ...) at
+      output_dir, as decoded BGR pixels or, if encoded is True, as the JPEG files
+    - Saves the index of the shards at output_dir/index.npz: ids, shards, offsets,
+      nbytes and shapes of the images, their bounding boxes (labels [xmin, ymin, w, h]
+      of the image i at label_offsets[i]:label_offsets[i+1]) and encoded
+    - The shards are read by datasets.datasets.SignetRingShards
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    mgr = SignetRingMGR(pickle_file)
+    ids = mgr.get_img_ids()
+    shards, offsets, nbytes, shapes, label_offsets, labels = [], [], [], [], [0], []
+    shard, offset = 0, 0
+    shard_file = open(os.path.join(output_dir, 'shard_{:04d}.bin'.format(shard)), 'wb')
+
+    try:
+        for id_ in ids:
+            img_file = os.path.join(img_dir, '{}.jpeg'.format(id_))
+            img = cv2.imread(img_file)
+            assert img is not None, '{} could not be decoded'.format(img_file)
+
+            if encoded:
+                with open(img_file, 'rb') as file_:
+                    data = file_.read()
+            else:
+                data = img.tobytes()
+
+            if offset and offset + len(data) > shard_size:
+                shard_file.close()
+                shard, offset = shard + 1, 0
+                shard_file = open(os.path.join(output_dir, 'shard_{:04d}.bin'.format(shard)), 'wb')
+
+            shard_file.write(data)
+            shards.append(shard)
+            offsets.append(offset)
+            nbytes.append(len(data))
+            shapes.append(img.shape)
+            offset += len(data)
+
+            boxes = mgr.get_boxes(id_)
+            labels.extend(zip(boxes['xmin'], boxes['ymin'], np.abs(boxes['xmax'] - boxes['xmin']),
+                              np.abs(boxes['ymax'] - boxes['ymin'])))
+            label_offsets.append(len(labels))
+    finally:
+        shard_file.close()
+
+    np.savez(
+        os.path.join(output_dir, 'index.npz'), ids=np.array(ids), shards=np.array(shards),
+        offsets=np.array(offsets, dtype=np.int64), nbytes=np.array(nbytes, dtype=np.int64),
+        shapes=np.array(shapes, dtype=np.int64).reshape(-1, 3),
+        label_offsets=np.array(label_offsets, dtype=np.int64),
+        labels=np.array(labels, dtype=np.float64).reshape(-1, 4), encoded=encoded
+    )
@@ -12,7 +12,7 @@ from constants import Dataset
 from datasets.datasets import COCODataset, SignetRing
 import settings
 from utils.evaluators.detection_evaluators import SignetRingEval
-from utils.utils import postprocess, yolobox2label
+from utils.utils import get_autocast, normalize_images, postprocess, yolobox2label
 
 
 # TODO: If there's time refactor these two evaluators to inherit from a base evaluator...
@@ -26,7 +26,8 @@ class COCOAPIEvaluator():
     source: https://github.com/DeNA/PyTorch_YOLOv3/blob/master/utils/cocoapi_evaluator.py
     """
 
-    def __init__(self, model_type, img_size, confthre, nmsthre, data_dir=settings.COCO_PATH):
+    def __init__(self, model_type, img_size, confthre, nmsthre, data_dir=settings.COCO_PATH,
+                 precision='fp32', rect=False):
         """
         Args:
             model_type (str): model name specified in config file
@@ -38,6 +39,8 @@ class COCOAPIEvaluator():
                 which is defined in the config file.
             nmsthre (float):
                 IoU threshold of non-max supression ranging from 0 to 1.
+            precision (str): autocast precision used by the model (see utils.utils.PRECISIONS)
+            rect (bool): if True, rectangular letterbox inference (see utils.utils.preprocess)
         """
 
         augmentation = {'LRFLIP': False, 'JITTER': 0, 'RANDOM_PLACING': False,
@@ -48,12 +51,15 @@ class COCOAPIEvaluator():
                                    img_size=img_size,
                                    augmentation=augmentation,
                                    json_file='instances_val2017.json',
-                                   name='val2017')
+                                   name='val2017',
+                                   rect=rect,
+                                   uint8=True)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset, batch_size=1, shuffle=False, num_workers=0)
         self.img_size = img_size
         self.confthre = confthre  # 0.005 # from darknet
         self.nmsthre = nmsthre  # 0.45 (darknet)
+        self.precision = precision
 
     def evaluate(self, model):
         """
@@ -67,7 +73,6 @@ class COCOAPIEvaluator():
         """
         model.eval()
         cuda = torch.cuda.is_available()
-        Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
         ids = []
         data_dict = []
         dataiterator = iter(self.dataloader)
@@ -80,8 +85,9 @@ class COCOAPIEvaluator():
             id_ = int(id_)
             ids.append(id_)
             with torch.no_grad():
-                img = Variable(img.type(Tensor))
-                outputs = model(img)
+                img = Variable(normalize_images(img, 'cuda' if cuda else 'cpu'))
+                with get_autocast(self.precision, img.device.type):
+                    outputs = model(img)
                 outputs = postprocess(
                     outputs, Dataset.NUM_CLASSES[Dataset.COCO], self.confthre, self.nmsthre)
                 if outputs[0] is None:
@@ -129,7 +135,8 @@ class SignetRingEvaluator:
     Inspired on: https://github.com/DeNA/PyTorch_YOLOv3/blob/master/utils/cocoapi_evaluator.py
     """
 
-    def __init__(self, model_type, img_size, confthre, nmsthre, data_dir=settings.SIGNET_TEST_PATH):
+    def __init__(self, model_type, img_size, confthre, nmsthre, data_dir=settings.SIGNET_TEST_PATH,
+                 precision='fp32', rect=False):
         """
         Args:
             model_type (str): model name specified in config file
@@ -141,6 +148,8 @@ class SignetRingEvaluator:
                 which is defined in the config file.
             nmsthre (float):
                 IoU threshold of non-max supression ranging from 0 to 1.
+            precision (str): autocast precision used by the model (see utils.utils.PRECISIONS)
+            rect (bool): if True, rectangular letterbox inference (see utils.utils.preprocess)
         """
 
         augmentation = {'LRFLIP': False, 'JITTER': 0, 'RANDOM_PLACING': False,
@@ -151,12 +160,16 @@ class SignetRingEvaluator:
                                   img_train_dir=settings.SIGNET_TRAIN_POS_IMG_PATH,
                                   img_size=img_size,
                                   augmentation=augmentation,
+                                  rect=rect,
+                                  cache_size=0,
+                                  uint8=True,
                                   )
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset, batch_size=1, shuffle=False, num_workers=0)
         self.img_size = img_size
         self.confthre = confthre  # 0.005  # from darknet
         self.nmsthre = nmsthre  # 0.45 (darknet)
+        self.precision = precision
 
     def evaluate(self, model):
         """
@@ -169,8 +182,8 @@ class SignetRingEvaluator:
         ap50 (float) : calculated SignetRing AP for IoU=50
         """
         model.eval()
-        cuda = torch.cuda.is_available()
-        Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
+        # the inputs follow the model (quantized models only run on CPU)
+        cuda = next(model.parameters()).is_cuda
         ids = []
         data_dict = []
         dataiterator = iter(self.dataloader)
@@ -187,8 +200,9 @@ class SignetRingEvaluator:
             id_ = id_[0]
             ids.append(id_)
             with torch.no_grad():
-                img = Variable(img.type(Tensor))
-                outputs = model(img)
+                img = Variable(normalize_images(img, 'cuda' if cuda else 'cpu'))
+                with get_autocast(self.precision, img.device.type):
+                    outputs = model(img)
                 outputs = postprocess(
                     outputs, Dataset.NUM_CLASSES[Dataset.SIGNET_RING], self.confthre, self.nmsthre)
                 if outputs[0] is None:
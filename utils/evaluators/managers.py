@@ -18,6 +18,7 @@ def get_evaluator_class(dataset_id):
     datasets = [
         DatasetItem(Dataset.COCO, COCOAPIEvaluator),
         DatasetItem(Dataset.SIGNET_RING, SignetRingEvaluator),
+        DatasetItem(Dataset.SIGNET_RING_SHARDS, SignetRingEvaluator),
     ]
 
     return tuple(filter(lambda x: x.id == dataset_id, datasets))[0].evaluator_class
@@ -4,25 +4,99 @@
 import os
 import pickle
 
+import numpy as np
+
+from core.classes import SignetBox
 import settings
 
 
+# columns of the bounding boxes of the columnar annotation store
+ANNOTATION_DTYPE = np.dtype([
+    ('id', np.int64), ('xmin', np.float64), ('ymin', np.float64), ('xmax', np.float64),
+    ('ymax', np.float64), ('pose', 'U16'), ('truncated', np.int8), ('occluded', np.int8),
+    ('difficult', np.int8),
+])
+
+
 class SignetRingMGR:
-    """ Handles read operations over signet data """
+    """
+    Handles read operations over signet data. The annotations are kept in a columnar
+    store: a structured array with the bounding boxes of all the images (see
+    ANNOTATION_DTYPE) and the offsets of the boxes of each image
+    (img_ids[i] boxes are boxes[offsets[i]:offsets[i+1]])
+    """
 
     def __init__(self, pickle_file=settings.SIGNET_TRAIN_PATH):
         """
         Initializes the object loading the data from the pickle file provided
+        (dict with lists of SignetBoxes per image) or from a .npz file created by save
         """
         if not os.path.isfile(pickle_file):
             raise FileNotFoundError('{} not found'.format(pickle_file))
 
-        with open(pickle_file, 'rb') as file_:
-            self.data = pickle.load(file_)
+        if pickle_file.endswith('.npz'):
+            with np.load(pickle_file) as store:
+                self.img_ids = store['img_ids']
+                self.offsets = store['offsets']
+                self.boxes = store['boxes']
+        else:
+            with open(pickle_file, 'rb') as file_:
+                data = pickle.load(file_)
+
+            self.img_ids = np.array(list(data.keys()), dtype=str)
+            self.offsets = np.cumsum([0] + [len(signetboxes) for signetboxes in data.values()])
+            self.boxes = np.array([
+                (signetbox.id, *signetbox.bndbox[:4], *signetbox.details)
+                for signetboxes in data.values() for signetbox in signetboxes
+            ], dtype=ANNOTATION_DTYPE)
+
+        self.positions = {img_id: position for position, img_id in enumerate(self.img_ids)}
+
+    def save(self, npz_file):
+        """ Saves the columnar store into the .npz file provided """
+        np.savez(npz_file, img_ids=self.img_ids, offsets=self.offsets, boxes=self.boxes)
 
     def get_img_ids(self):
         """ Returns a tuple containing the keys/image names """
-        return tuple(self.data.keys())
+        return tuple(self.img_ids)
+
+    def get_rows(self, index, filters=None):
+        """
+        Returns the rows of the boxes belonging to the index provided, filtered by the
+        filters provided (see get_annotations)
+        """
+        assert isinstance(index, (str, list, tuple))
+        index_list = [index] if isinstance(index, str) else index
+
+        if filters is None:
+            filters = dict(pose='', truncated=None, occluded=None,  difficult=None)
+
+        options = (1, 0, None)
+
+        assert isinstance(filters['pose'], str)
+        assert filters['truncated'] in options
+        assert filters['occluded'] in options
+        assert filters['difficult'] in options
+
+        positions = np.array([self.positions[index_] for index_ in index_list], dtype=np.int64)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # consecutive rows of each image, in the order of index_list
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+            np.arange(lengths.sum())
+
+        for key, value in filters.items():
+            if value not in (None, ''):
+                rows = rows[self.boxes[key][rows] == value]
+
+        return rows
+
+    def get_boxes(self, index, filters=None):
+        """
+        Returns the bounding boxes (structured array, see ANNOTATION_DTYPE) belonging to
+        the index provided filtered by the filters provided (see get_annotations)
+        """
+        return self.boxes[self.get_rows(index, filters)]
 
     def get_annotations(self, index, filters=None, to_dict=False):
         """
@@ -41,30 +115,19 @@ class SignetRingMGR:
           Or if to_dict=True
           [dict, dict, dict, ...]
         """
-        assert isinstance(index, (str, list, tuple))
-        index_list = [index] if isinstance(index, str) else index
-
-        if filters is None:
-            filters = dict(pose='', truncated=None, occluded=None,  difficult=None)
-
-        options = (1, 0, None)
-
-        assert isinstance(filters['pose'], str)
-        assert filters['truncated'] in options
-        assert filters['occluded'] in options
-        assert filters['difficult'] in options
-
-        filters = tuple(filter(lambda x: x[1] not in (None, ''), filters.items()))
+        rows = self.get_rows(index, filters)
+        img_ids = self.img_ids[np.searchsorted(self.offsets, rows, side='right') - 1]
         filtered_bndboxes = []
 
-        for index_ in index_list:
-            for signetbox in self.data[index_]:
-                for key, value in filters:
-                    if getattr(signetbox.details, key) != value:
-                        break
-                else:
-                    if to_dict:
-                        signetbox = signetbox.to_dict()
-                    filtered_bndboxes.append(signetbox)
+        for img_id, box in zip(img_ids.tolist(), self.boxes[rows].tolist()):
+            id_, xmin, ymin, xmax, ymax, pose, truncated, occluded, difficult = box
+            signetbox = SignetBox(
+                id_, img_id,
+                dict(pose=pose, truncated=truncated, occluded=occluded, difficult=difficult),
+                dict(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+            )
+            if to_dict:
+                signetbox = signetbox.to_dict()
+            filtered_bndboxes.append(signetbox)
 
         return filtered_bndboxes
@@ -2,6 +2,8 @@
 """ utils/utils """
 
 from __future__ import division
+from collections import namedtuple
+import contextlib
 import os
 
 import cv2
@@ -19,8 +21,124 @@ from utils.managers.signet_ring_cell_dataset import SignetRingMGR
 from .kmeans_iou import kmeans, avg_iou
 
 
-def nms(bbox, thresh, score=None, limit=None):
+# torch dtypes of the precisions available for autocast (fp32 disables autocast)
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+# Ragged detections of a batch returned by YOLOv3 when the sparse decoding is enabled
+# (see YOLOv3.set_sparse_decoding). prediction (K, 5 + n_classes) holds the decoded
+# [xc, yc, w, h, obj, cls_1, ...] of the cells whose objectness passed the threshold,
+# img_ids (K,) the image of each one and batchsize the number of images
+SparsePredictions = namedtuple('SparsePredictions', ['prediction', 'img_ids', 'batchsize'])
+
+
+def get_autocast(precision='fp32', device_type='cpu'):
+    """
+    Returns the autocast context manager for the precision
+    Args:
+        precision (str): one from PRECISIONS
+        device_type (str): 'cpu' or 'cuda'
+    Returns:
+        context manager running the eligible ops (convolutions, matmuls) in the
+        reduced precision (no-op context manager for fp32)
+    """
+    if precision not in PRECISIONS:
+        raise Exception('Precision {} is not available: {}'.format(
+            precision, ', '.join(PRECISIONS)))
+
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+
+    return torch.autocast(device_type, dtype=PRECISIONS[precision])
+
+
+def normalize_images(imgs, device='cpu'):
+    """
+    Returns the batch of images as a float tensor on the device with values from 0 to 1.
+    The uint8 batches (see the uint8 option of the datasets) are moved to the device
+    before being scaled and cast, once per batch
+    Args:
+        imgs (torch.Tensor): uint8 (0 to 255) or float (0 to 1) batch of images
+        device (str or torch.device): device of the returned tensor
+    Returns:
+        imgs (torch.Tensor): float32 batch of images
+    """
+    imgs = imgs.to(device)
+
+    if imgs.dtype == torch.uint8:
+        return imgs.float().div_(255.)
+
+    return imgs.float()
+
+
+def get_conv_flops(model, height, width):
+    """
+    Returns the floating point operations of the convolutions of the model (multiply
+    and add counted as two) for an input image of height x width pixels (multiples of
+    32). They are counted on a 64 x 64 forward pass and scaled by the number of pixels,
+    as every feature map of the fully convolutional network is proportional to the input
+    """
+    flops = []
+
+    def count_flops(module, inputs, output):
+        flops.append(2 * output.numel() * module.in_channels // module.groups *
+                     module.kernel_size[0] * module.kernel_size[1])
+
+    handles = [module.register_forward_hook(count_flops) for module in model.modules()
+               if isinstance(module, torch.nn.Conv2d)]
+
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 3, 64, 64, device=next(model.parameters()).device))
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return sum(flops) * height * width / 64**2
+
+
+def _pairwise_iou(bbox_a, area_a, bbox_b, area_b):
+    """Returns the IoU matrix of shape :math:`(N, K)` between the numpy boxes bbox_a
+    :math:`(N, 4)` and bbox_b :math:`(K, 4)` given their precomputed areas"""
+    inter = np.maximum(
+        np.minimum(bbox_a[:, None, 2], bbox_b[None, :, 2]) -
+        np.maximum(bbox_a[:, None, 0], bbox_b[None, :, 0]), 0)
+    inter *= np.maximum(
+        np.minimum(bbox_a[:, None, 3], bbox_b[None, :, 3]) -
+        np.maximum(bbox_a[:, None, 1], bbox_b[None, :, 1]), 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def _suppress_overlaps(overlaps):
+    """
+    Returns the mask of the boxes kept by the greedy suppression of a block of boxes
+    sorted by score given their overlaps matrix (lower triangular, overlaps[i, j] is
+    True if the higher scored box j would suppress box i). Works with numpy arrays
+    and torch tensors
+    """
+    # the greedy selection is the only fixed point of this iteration and it is
+    # reached after a number of steps bounded by the longest suppression chain
+    keep = ~overlaps.any(1)
+    while True:
+        new_keep = ~(overlaps & keep[None, :]).any(1)
+        if (new_keep == keep).all():
+            return keep
+        keep = new_keep
+
+
+def nms(bbox, thresh, score=None, limit=None, block_size=256):
     """Suppress bounding boxes according to their IoUs and confidence scores.
+
+    The boxes are processed in blocks of block_size: each block is compared
+    against all the boxes already selected and the greedy suppression inside the
+    block is solved with its pairwise IoU matrix, so the Python work grows with the
+    number of blocks instead of the number of boxes.
+
     Args:
         bbox (array): Bounding boxes to be transformed. The shape is
             :math:`(R, 4)`. :math:`R` is the number of bounding boxes.
@@ -28,7 +146,9 @@ def nms(bbox, thresh, score=None, limit=None):
         score (array): An array of confidences whose shape is :math:`(R,)`.
         limit (int): The upper bound of the number of the output bounding
             boxes. If it is not specified, this method selects as many
-            bounding boxes as possible.
+            bounding boxes as possible. The remaining blocks are not
+            evaluated once the limit is reached.
+        block_size (int): Number of boxes processed per block.
     Returns:
         array:
         An array with indices of bounding boxes that are selected. \
@@ -48,37 +168,116 @@ def nms(bbox, thresh, score=None, limit=None):
         bbox = bbox[order]
     bbox_area = np.prod(bbox[:, 2:] - bbox[:, :2], axis=1)
 
-    selec = np.zeros(bbox.shape[0], dtype=bool)
-    for i, b in enumerate(bbox):
-        tl = np.maximum(b[:2], bbox[selec, :2])
-        br = np.minimum(b[2:], bbox[selec, 2:])
-        area = np.prod(br - tl, axis=1) * (tl < br).all(axis=1)
-        iou = area / (bbox_area[i] + bbox_area[selec] - area)
+    selec = np.zeros((0,), dtype=np.int64)
+    for start in range(0, bbox.shape[0], block_size):
+        block_ids = np.arange(start, min(start + block_size, bbox.shape[0]))
+
+        # only the boxes not suppressed by the already selected ones compete inside the block
+        if len(selec):
+            iou = _pairwise_iou(
+                bbox[block_ids], bbox_area[block_ids], bbox[selec], bbox_area[selec])
+            block_ids = block_ids[~(iou >= thresh).any(axis=1)]
 
-        if (iou >= thresh).any():
-            continue
+        # overlaps[i, j] is True if the higher scored box j would suppress box i
+        overlaps = _pairwise_iou(
+            bbox[block_ids], bbox_area[block_ids], bbox[block_ids], bbox_area[block_ids]) >= thresh
+        overlaps = np.tril(overlaps, k=-1)
 
-        selec[i] = True
-        if limit is not None and np.count_nonzero(selec) >= limit:
+        block_ids = block_ids[_suppress_overlaps(overlaps)]
+        if limit is not None:
+            block_ids = block_ids[:limit - len(selec)]
+        selec = np.concatenate((selec, block_ids))
+
+        if limit is not None and len(selec) >= limit:
             break
 
-    selec = np.where(selec)[0]
     if score is not None:
         selec = order[selec]
     return selec.astype(np.int32)
 
 
+def batched_nms(bbox, score, idxs, thresh, block_size=256):
+    """Class-aware non maximum suppression over several groups of boxes at once
+    (e.g. one group per image and class). Boxes from different groups never suppress
+    each other, which is equivalent to the class-offset trick without shifting the
+    coordinates (so no float precision is lost). Pure PyTorch, runs on any device.
+
+    The boxes are sorted by group and score and processed in blocks: each block
+    is compared against the boxes kept from previous blocks and the greedy
+    suppression inside the block is solved with its pairwise IoU matrix.
+
+    Args:
+        bbox (torch.Tensor): Bounding boxes whose shape is :math:`(R, 4)`. Each
+            box consists of :math:`x1, y1, x2, y2`.
+        score (torch.Tensor): Confidences whose shape is :math:`(R,)`.
+        idxs (torch.Tensor): Integer group ids whose shape is :math:`(R,)`.
+        thresh (float): Threshold of IoUs.
+        block_size (int): Number of boxes processed per block.
+    Returns:
+        torch.Tensor:
+        Indices of the selected bounding boxes. They are sorted by group id and \
+        then by score in descending order. The shape is :math:`(K,)`.
+    """
+    if bbox.shape[0] == 0:
+        return torch.zeros((0,), dtype=torch.long, device=bbox.device)
+
+    order = torch.argsort(score, descending=True)
+    order = order[torch.argsort(idxs[order], stable=True)]
+    bbox = bbox[order]
+    idxs = idxs[order]
+    keep = torch.zeros(bbox.shape[0], dtype=torch.bool, device=bbox.device)
+
+    for start in range(0, bbox.shape[0], block_size):
+        end = min(start + block_size, bbox.shape[0])
+        block = bbox[start:end]
+        block_idxs = idxs[start:end]
+        candidates = torch.ones(end - start, dtype=torch.bool, device=bbox.device)
+
+        # boxes kept in previous blocks that belong to the groups of this block
+        prev = keep[:start] & (idxs[:start] >= block_idxs[0])
+        if prev.any():
+            same_group = block_idxs[:, None] == idxs[:start][prev][None, :]
+            candidates = ~((bboxes_iou(block, bbox[:start][prev]) >= thresh) & same_group).any(1)
+
+        # only the boxes that survived the previous blocks compete inside the block
+        candidates = candidates.nonzero(as_tuple=True)[0]
+        block = block[candidates]
+        block_idxs = block_idxs[candidates]
+
+        # overlaps[i, j] is True if the higher scored box j would suppress box i
+        overlaps = (bboxes_iou(block, block) >= thresh) & (block_idxs[:, None] == block_idxs[None, :])
+        overlaps.tril_(diagonal=-1)
+
+        keep[start + candidates[_suppress_overlaps(overlaps)]] = True
+
+    return order[keep]
+
+
+def cat_sparse_predictions(predictions):
+    """
+    Concatenates the SparsePredictions of several YOLO layers. The detections of
+    each image are kept together and in the order of the layers, like the dense output
+    """
+    prediction = torch.cat([pred.prediction for pred in predictions])
+    img_ids, order = torch.sort(torch.cat([pred.img_ids for pred in predictions]), stable=True)
+
+    return SparsePredictions(prediction[order], img_ids, predictions[0].batchsize)
+
+
 def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45):
     """
     Postprocess for the output of YOLO model
     perform box transformation, specify the class for each detection,
     and perform class-wise non-maximum suppression.
+    All the images are processed at once: the filtering and the class-aware NMS
+    are done in a single tensor pipeline (see batched_nms).
     Args:
-        prediction (torch tensor): The shape is :math:`(N, B, 4)`.
+        prediction (torch tensor or SparsePredictions): The shape is :math:`(N, B, 4)`.
             :math:`N` is the number of predictions,
             :math:`B` the number of boxes. The last axis consists of
             :math:`xc, yc, w, h` where `xc` and `yc` represent a center
-            of a bounding box.
+            of a bounding box. The ragged output of the sparse decoding
+            (see YOLOv3.set_sparse_decoding) is also accepted.
         num_classes (int):
             number of dataset classes.
         conf_thre (float):
@@ -88,51 +287,51 @@ def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45):
             IoU threshold of non-max suppression ranging from 0 to 1.
 
     Returns:
-        output (list of torch tensor):
-
-    """
-    box_corner = prediction.new(prediction.shape)
-    box_corner[:, :, 0] = prediction[:, :, 0] - prediction[:, :, 2] / 2
-    box_corner[:, :, 1] = prediction[:, :, 1] - prediction[:, :, 3] / 2
-    box_corner[:, :, 2] = prediction[:, :, 0] + prediction[:, :, 2] / 2
-    box_corner[:, :, 3] = prediction[:, :, 1] + prediction[:, :, 3] / 2
-    prediction[:, :, :4] = box_corner[:, :, :4]
-
-    output = [None for _ in range(len(prediction))]
-    for i, image_pred in enumerate(prediction):
-        # Filter out confidence scores below threshold
-        class_pred = torch.max(image_pred[:, 5:5 + num_classes], 1)
-        class_pred = class_pred[0]
-        conf_mask = (image_pred[:, 4] * class_pred >= conf_thre).squeeze()
-        image_pred = image_pred[conf_mask]
-
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Get score and class with highest confidence
-        class_conf, class_pred = torch.max(
-            image_pred[:, 5:5 + num_classes], 1,  keepdim=True)
-
-        # Detections ordered as (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
-        detections = torch.cat(
-            (image_pred[:, :5], class_conf.float(), class_pred.float()), 1)
-        # Iterate through all predicted classes
-        unique_labels = detections[:, -1].cpu().unique()
-        if prediction.is_cuda:
-            unique_labels = unique_labels.cuda()
-        for c in unique_labels:
-            # Get the detections with the particular class
-            detections_class = detections[detections[:, -1] == c]
-            nms_in = detections_class.cpu().numpy()
-            nms_out_index = nms(
-                nms_in[:, :4], nms_thre, score=nms_in[:, 4]*nms_in[:, 5])
-            detections_class = detections_class[nms_out_index]
-            if output[i] is None:
-                output[i] = detections_class
-            else:
-                output[i] = torch.cat((output[i], detections_class))
-
-    return output
+        output (list of torch tensor): one tensor (or None if there are no detections)
+            per image. Detections are ordered by class and score and consist of
+            (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
+
+    """
+    # Filter out confidence scores below threshold
+    if isinstance(prediction, SparsePredictions):
+        prediction, img_ids, batchsize = prediction
+        class_conf, class_pred = torch.max(prediction[:, 5:5 + num_classes], 1)
+        box_ids = (prediction[:, 4] * class_conf >= conf_thre).nonzero(as_tuple=True)[0]
+        img_ids = img_ids[box_ids]
+        prediction = prediction[box_ids]
+        class_conf = class_conf[box_ids]
+        class_pred = class_pred[box_ids]
+    else:
+        batchsize = len(prediction)
+        class_conf, class_pred = torch.max(prediction[:, :, 5:5 + num_classes], 2)
+        img_ids, box_ids = (prediction[:, :, 4] * class_conf >= conf_thre).nonzero(as_tuple=True)
+        prediction = prediction[img_ids, box_ids]
+        class_conf = class_conf[img_ids, box_ids]
+        class_pred = class_pred[img_ids, box_ids]
+
+    # box transformation of the remaining predictions only
+    box_corner = torch.cat((
+        prediction[:, :2] - prediction[:, 2:4] / 2,
+        prediction[:, :2] + prediction[:, 2:4] / 2
+    ), 1)
+
+    # Detections ordered as (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
+    detections = torch.cat((
+        box_corner,
+        prediction[:, 4:5],
+        class_conf[:, None].float(),
+        class_pred[:, None].float()
+    ), 1)
+
+    # class-aware NMS for all the images
+    keep = batched_nms(
+        detections[:, :4], detections[:, 4] * detections[:, 5],
+        img_ids * num_classes + class_pred, nms_thre
+    )
+    detections = detections[keep]
+    counts = torch.bincount(img_ids[keep], minlength=batchsize).tolist()
+
+    return [dets if len(dets) else None for dets in torch.split(detections, counts)]
 
 
 def bboxes_iou(bboxes_a, bboxes_b, xyxy=True):
@@ -144,40 +343,47 @@ def bboxes_iou(bboxes_a, bboxes_b, xyxy=True):
         bbox_a (array): An array whose shape is :math:`(N, 4)`.
             :math:`N` is the number of bounding boxes.
             The dtype should be :obj:`numpy.float32`.
+            Leading batch dimensions are supported, e.g. :math:`(B, N, 4)`.
         bbox_b (array): An array similar to :obj:`bbox_a`,
-            whose shape is :math:`(K, 4)`.
+            whose shape is :math:`(K, 4)` or :math:`(B, K, 4)`.
             The dtype should be :obj:`numpy.float32`.
     Returns:
         array:
-        An array whose shape is :math:`(N, K)`. \
+        An array whose shape is :math:`(N, K)` (or :math:`(B, N, K)`). \
         An element at index :math:`(n, k)` contains IoUs between \
         :math:`n` th bounding box in :obj:`bbox_a` and :math:`k` th bounding \
         box in :obj:`bbox_b`.
 
     from: https://github.com/chainer/chainercv
     """
-    if bboxes_a.shape[1] != 4 or bboxes_b.shape[1] != 4:
+    if bboxes_a.shape[-1] != 4 or bboxes_b.shape[-1] != 4:
         raise IndexError
 
-    # top left
     if xyxy:
-        tl = torch.max(bboxes_a[:, None, :2], bboxes_b[:, :2])
-        # bottom right
-        br = torch.min(bboxes_a[:, None, 2:], bboxes_b[:, 2:])
-        area_a = torch.prod(bboxes_a[:, 2:] - bboxes_a[:, :2], 1)
-        area_b = torch.prod(bboxes_b[:, 2:] - bboxes_b[:, :2], 1)
+        tl_a, br_a = bboxes_a[..., :2], bboxes_a[..., 2:]
+        tl_b, br_b = bboxes_b[..., :2], bboxes_b[..., 2:]
+        area_a = torch.prod(br_a - tl_a, -1)
+        area_b = torch.prod(br_b - tl_b, -1)
     else:
-        tl = torch.max((bboxes_a[:, None, :2] - bboxes_a[:, None, 2:] / 2),
-                       (bboxes_b[:, :2] - bboxes_b[:, 2:] / 2))
+        tl_a = bboxes_a[..., :2] - bboxes_a[..., 2:] / 2
+        br_a = bboxes_a[..., :2] + bboxes_a[..., 2:] / 2
+        tl_b = bboxes_b[..., :2] - bboxes_b[..., 2:] / 2
+        br_b = bboxes_b[..., :2] + bboxes_b[..., 2:] / 2
+        area_a = torch.prod(bboxes_a[..., 2:], -1)
+        area_b = torch.prod(bboxes_b[..., 2:], -1)
+
+    # the pairwise operations are done per coordinate so the broadcasting is done over
+    # contiguous (N, K) planes. Boxes without intersection are clamped to zero width or height
+    area_i = None
+    for dim in range(2):
+        # top left
+        tl = torch.max(tl_a[..., :, None, dim], tl_b[..., None, :, dim])
         # bottom right
-        br = torch.min((bboxes_a[:, None, :2] + bboxes_a[:, None, 2:] / 2),
-                       (bboxes_b[:, :2] + bboxes_b[:, 2:] / 2))
+        br = torch.min(br_a[..., :, None, dim], br_b[..., None, :, dim])
+        side = (br - tl).clamp_(min=0)
+        area_i = side if area_i is None else area_i * side
 
-        area_a = torch.prod(bboxes_a[:, 2:], 1)
-        area_b = torch.prod(bboxes_b[:, 2:], 1)
-    en = (tl < br).type(tl.type()).prod(dim=2)
-    area_i = torch.prod(br - tl, 2) * en  # * ((tl < br).all())
-    return area_i / (area_a[:, None] + area_b - area_i)
+    return area_i / (area_a[..., :, None] + area_b[..., None, :] - area_i)
 
 
 def label2yolobox(labels, info_img, maxsize, lrflip):
@@ -242,7 +448,7 @@ def yolobox2label(box, info_img):
     return label
 
 
-def preprocess(img, imgsize, jitter, random_placing=False):
+def preprocess(img, imgsize, jitter, random_placing=False, rect=False):
     """
     Image preprocess for yolo input
     Pad the shorter side of the image and resize to (imgsize, imgsize)
@@ -252,6 +458,8 @@ def preprocess(img, imgsize, jitter, random_placing=False):
         imgsize (int): target image size after pre-processing
         jitter (float): amplitude of jitter for resizing
         random_placing (bool): if True, place the image at random position
+        rect (bool): if True, the shorter side is only padded up to the next multiple
+            of 32 (rectangular letterbox, for inference)
 
     Returns:
         img (numpy.ndarray): input image whose shape is :math:`(C, imgsize, imgsize)`.
@@ -282,21 +490,67 @@ def preprocess(img, imgsize, jitter, random_placing=False):
         nh = nw / new_ar
     nw, nh = int(nw), int(nh)
 
+    if rect:
+        height, width = -(-nh // 32) * 32, -(-nw // 32) * 32
+    else:
+        height = width = imgsize
+
     if random_placing:
-        dx = int(np.random.uniform(imgsize - nw))
-        dy = int(np.random.uniform(imgsize - nh))
+        dx = int(np.random.uniform(width - nw))
+        dy = int(np.random.uniform(height - nh))
     else:
-        dx = (imgsize - nw) // 2
-        dy = (imgsize - nh) // 2
+        dx = (width - nw) // 2
+        dy = (height - nh) // 2
 
     img = cv2.resize(img, (nw, nh))
-    sized = np.ones((imgsize, imgsize, 3), dtype=np.uint8) * 127
+    sized = np.ones((height, width, 3), dtype=np.uint8) * 127
     sized[dy:dy+nh, dx:dx+nw, :] = img
 
     info_img = (h, w, nh, nw, dx, dy)
     return sized, info_img
 
 
+def stack_letterboxes(imgs):
+    """
+    Stacks the letterboxed images (see preprocess) into an uint8 numpy array with shape
+    (N, H, W, 3). Rectangular letterboxes of different shapes are padded to the
+    largest one
+    """
+    if len(set(img.shape for img in imgs)) > 1:
+        height, width = np.max([img.shape[:2] for img in imgs], axis=0)
+        imgs = [np.pad(img, ((0, height - img.shape[0]), (0, width - img.shape[1]), (0, 0)),
+                       constant_values=127) for img in imgs]
+
+    return np.stack(imgs)
+
+
+def preprocess_padded(img, scale, stride=32):
+    """
+    Image preprocess for the fully convolutional inference on images of any size
+    (e.g. whole slides). The image is resized by scale and padded on the right and
+    bottom up to a multiple of stride
+    Args:
+        img (numpy.ndarray): input image whose shape is :math:`(H, W, C)`.
+            Values range from 0 to 255.
+        scale (float): resize factor
+        stride (int): the height and width after pre-processing are multiple of stride
+
+    Returns:
+        img (numpy.ndarray): input image whose shape is :math:`(H', W', C)`.
+            Values range from 0 to 255.
+        info_img : tuple of h, w, nh, nw, dx, dy (see preprocess), dx and dy are zero
+    """
+    h, w, _ = img.shape
+    nh, nw = int(round(h * scale)), int(round(w * scale))
+    img = cv2.resize(img[:, :, ::-1], (nw, nh))
+
+    sized = np.ones((-(-nh // stride) * stride, -(-nw // stride) * stride, 3), dtype=np.uint8) * 127
+    sized[:nh, :nw, :] = img
+
+    info_img = (h, w, nh, nw, 0, 0)
+    return sized, info_img
+
+
 def rand_scale(s):
     """
     calculate random scaling factor
@@ -389,6 +643,7 @@ def get_tensorboard_log_path(option):
     log_paths = {
         Dataset.COCO: settings.TENSORBOARD_COCO_LOG_PATH,
         Dataset.SIGNET_RING: settings.TENSORBOARD_SIGNET_LOG_PATH,
+        Dataset.SIGNET_RING_SHARDS: settings.TENSORBOARD_SIGNET_LOG_PATH,
     }
 
     return log_paths[option]
@@ -410,10 +665,10 @@ def recalculate_anchor_boxes(option, plot_charts=False, round_centroid_values=Tr
 
     if option == Dataset.SIGNET_RING:
         mgr = SignetRingMGR(settings.SIGNET_BOUNDING_BOXES_PATH)
-        boundingboxes_dimentions = tuple([
-            (bbox.width, bbox.height) for bbox in mgr.get_annotations(mgr.get_img_ids())])
+        boxes = mgr.get_boxes(mgr.get_img_ids())
+        boundingboxes_dimentions = np.stack([np.abs(boxes['xmax'] - boxes['xmin']),
+                                             np.abs(boxes['ymax'] - boxes['ymin'])], axis=1)
         kmeans = KMeans(n_clusters=9, random_state=42).fit(boundingboxes_dimentions)
-        boundingboxes_dimentions = np.array(boundingboxes_dimentions)
         x_min, y_min = boundingboxes_dimentions[:, 0].min() - 1, \
             boundingboxes_dimentions[:, 1].min() - 1
         x_max, y_max = boundingboxes_dimentions[:, 0].max() + 1, \